@@ -0,0 +1,173 @@
+# adaptive_batcher.py
+import time
+import logging
+import configparser
+from collections import deque
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+class AdaptiveBatcher:
+    """
+    Decides when to cut a batch from the files waiting to be processed, aiming for a
+    target end-to-end latency instead of a fixed batch_interval_seconds.
+
+    Recent batches are used to fit pipeline time as `overhead + seconds_per_byte * bytes`.
+    Under load the batch interval grows to the smallest value that keeps up with the
+    arrival rate, spreading the fixed Nextflow/Bracken overhead over more data; when the
+    flow cell is quiet and nothing is running, files are sent on almost immediately.
+    The target bounds both: the wait is capped so waiting plus the predicted pipeline and
+    aggregation time fits it, and batches are capped at the bytes the pipeline can process
+    within it.
+    """
+    # Safety margin on the smallest interval that keeps up with the arrival rate
+    HEADROOM = 1.2
+    # Smoothing factor for the arrival rate estimate
+    RATE_ALPHA = 0.3
+
+    def __init__(self, target_latency: float, min_files: int = 1, max_files: int = 500,
+                 min_bytes: int = 0, max_bytes: int = 2 * 1024**3,
+                 min_wait: float = 2.0, max_wait: float = 300.0, history_size: int = 20):
+        self.target_latency = target_latency
+        self.min_files = min_files
+        self.max_files = max_files
+        self.min_bytes = min_bytes
+        self.max_bytes = max_bytes
+        self.min_wait = min_wait
+        self.max_wait = max_wait
+
+        self.pipeline_history = deque(maxlen=history_size)     # (bytes, seconds)
+        self.aggregation_history = deque(maxlen=history_size)  # seconds
+        self.arrival_rate = 0.0  # bytes per second
+        self._last_arrival_check = time.monotonic()
+        self._last_enqueued_bytes = 0
+        self._warned_target = False
+        self._lock = Lock()
+
+    @classmethod
+    def from_config(cls, config: configparser.ConfigParser) -> "AdaptiveBatcher":
+        section = 'Batching'
+        return cls(
+            target_latency=config.getfloat(section, 'target_latency_seconds', fallback=300.0),
+            min_files=config.getint(section, 'min_batch_files', fallback=1),
+            max_files=config.getint(section, 'max_batch_files', fallback=500),
+            min_bytes=config.getint(section, 'min_batch_bytes', fallback=0),
+            max_bytes=config.getint(section, 'max_batch_bytes', fallback=2 * 1024**3),
+            min_wait=config.getfloat(section, 'min_wait_seconds', fallback=2.0),
+            max_wait=config.getfloat(section, 'max_wait_seconds', fallback=300.0),
+            history_size=config.getint(section, 'history_size', fallback=20),
+        )
+
+    # --- Inputs ---
+
+    def record_pipeline(self, batch_bytes: int, seconds: float):
+        with self._lock:
+            self.pipeline_history.append((batch_bytes, seconds))
+
+    def record_aggregation(self, seconds: float):
+        with self._lock:
+            self.aggregation_history.append(seconds)
+
+    # --- Model ---
+
+    def _fit_pipeline(self):
+        """Least-squares fit of pipeline seconds against batch bytes. Returns (overhead, seconds_per_byte)."""
+        if not self.pipeline_history:
+            return 0.0, 0.0
+        xs = [b for b, _ in self.pipeline_history]
+        ys = [s for _, s in self.pipeline_history]
+        n = len(xs)
+        mean_x, mean_y = sum(xs) / n, sum(ys) / n
+        var_x = sum((x - mean_x) ** 2 for x in xs)
+        if n < 3 or var_x == 0:
+            return mean_y, 0.0
+        slope = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / var_x
+        slope = max(slope, 0.0)
+        overhead = max(mean_y - slope * mean_x, 0.0)
+        return overhead, slope
+
+    def _update_arrival_rate(self, enqueued_bytes: int):
+        now = time.monotonic()
+        elapsed = now - self._last_arrival_check
+        if elapsed < 1.0:
+            return
+        instant_rate = (enqueued_bytes - self._last_enqueued_bytes) / elapsed
+        self.arrival_rate = self.RATE_ALPHA * instant_rate + (1 - self.RATE_ALPHA) * self.arrival_rate
+        self._last_enqueued_bytes = enqueued_bytes
+        self._last_arrival_check = now
+
+    def _mean_aggregation(self) -> float:
+        return sum(self.aggregation_history) / len(self.aggregation_history) if self.aggregation_history else 0.0
+
+    def batch_bytes_limit(self) -> int:
+        """Largest batch whose predicted pipeline plus aggregation time fits the latency target."""
+        overhead, per_byte = self._fit_pipeline()
+        if not per_byte:
+            return self.max_bytes
+        budget = self.target_latency - overhead - self._mean_aggregation()
+        # A target the fixed overhead alone exceeds still gets batches of min_bytes
+        return int(min(max(budget / per_byte, self.min_bytes, 1), self.max_bytes))
+
+    def planned_wait(self) -> float:
+        """Seconds the oldest pending file may wait while the pipeline is busy."""
+        overhead, per_byte = self._fit_pipeline()
+        aggregation = self._mean_aggregation()
+        load = per_byte * self.arrival_rate
+        if load >= 1.0:
+            # The pipeline cannot keep up; batches are bounded by the byte limits instead
+            wait = self.max_wait
+        else:
+            wait = self.HEADROOM * overhead / (1.0 - load)
+        # Bytes arriving during the wait add per_byte * arrival_rate * wait of pipeline time:
+        # wait + overhead + aggregation + load * wait must fit the target
+        wait = min(wait, (self.target_latency - overhead - aggregation) / (1.0 + load))
+        wait = min(max(wait, self.min_wait), self.max_wait)
+
+        expected_latency = wait + overhead + per_byte * self.arrival_rate * wait + aggregation
+        if expected_latency > self.target_latency and not self._warned_target:
+            logger.warning(f"Expected latency {expected_latency:.0f}s exceeds the {self.target_latency:.0f}s target at the current arrival rate.")
+            self._warned_target = True
+        elif expected_latency <= self.target_latency:
+            self._warned_target = False
+        return wait
+
+    def estimated_seconds(self, batch_bytes: int):
+        """Predicted pipeline time for batch_bytes, or None until a per-byte cost has been measured."""
+        with self._lock:
+            overhead, per_byte = self._fit_pipeline()
+        if not per_byte:
+            return None
+        return overhead + per_byte * batch_bytes
+
+    # --- Output ---
+
+    def next_batch(self, scheduler, busy: bool = False, max_files_per_barcode: int = None) -> list:
+        """
+        Returns the next batch of file paths from the scheduler if one should be cut now,
+        otherwise []. The scheduler picks which files go in; the batcher decides when and
+        how many. `busy` tells the batcher that earlier batches are still in the pipeline.
+        """
+        with self._lock:
+            self._update_arrival_rate(scheduler.enqueued_bytes)
+            pending_files = scheduler.qsize()
+            if not pending_files:
+                return []
+            pending_bytes = scheduler.total_bytes
+            max_bytes = self.batch_bytes_limit()
+
+            oldest_age = scheduler.oldest_age()
+            full = pending_files >= self.max_files or pending_bytes >= max_bytes
+            below_min = pending_files < self.min_files or pending_bytes < self.min_bytes
+
+            if full:
+                pass
+            elif below_min and oldest_age < self.max_wait:
+                return []
+            elif not busy:
+                if oldest_age < self.min_wait:
+                    return []
+            elif oldest_age < self.planned_wait():
+                return []
+
+        return scheduler.get_batch(max_files=self.max_files, max_bytes=max_bytes,
+                                   max_files_per_barcode=max_files_per_barcode)
@@ -0,0 +1,280 @@
+# async_backend.py
+import os
+import time
+import signal
+import asyncio
+import logging
+import itertools
+import configparser
+from threading import Thread
+from concurrent.futures import ThreadPoolExecutor
+
+import pipeline_runner
+import child_processes
+import result_aggregator
+from batch_engine import run_aggregation_unit, _batch_bytes
+from barcode_scheduler import barcode_of
+from inotify_watcher import InotifyWatcher
+from metrics import REGISTRY, publish_queue_metrics, record_batch
+
+logger = logging.getLogger(__name__)
+
+async def run_pipeline_unit_async(files: list, config: configparser.ConfigParser, journal=None, run_name: str = None):
+    """
+    asyncio counterpart of batch_engine.run_pipeline_unit. A cancelled run is left in the
+    journal as queued, so its files are re-queued on the next start.
+    """
+    batch_id = journal.begin(files) if journal else None
+    try:
+        batch_result_directory = await pipeline_runner.run_batch_async(files, config, run_name=run_name)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.error(f"Pipeline crashed for a batch of {len(files)} files: {e}", exc_info=True)
+        batch_result_directory = None
+    if journal:
+        if batch_result_directory:
+            journal.pipeline_done(batch_id, batch_result_directory)
+        else:
+            journal.abandon(batch_id)
+    return batch_id, batch_result_directory
+
+async def _in_daemon_thread(func, *args):
+    """
+    Awaits blocking work (the pandas-heavy aggregation) run on a daemon thread, so an
+    interrupted shutdown never has to wait for it to finish.
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def resolve(result=None, error=None):
+        if future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def target():
+        try:
+            result, error = func(*args), None
+        except Exception as e:
+            result, error = None, e
+        try:
+            loop.call_soon_threadsafe(resolve, result, error)
+        except RuntimeError:
+            pass  # the event loop has already closed
+
+    Thread(target=target, name=f"{func.__name__}-worker", daemon=True).start()
+    return await future
+
+class AsyncBackend:
+    """
+    Single-threaded asyncio version of the backend loop. Watching, the batch timer, the
+    Nextflow runs and aggregation are tasks on one event loop:
+
+      - inotify events are read straight off the loop (watchdog keeps its own thread)
+      - Nextflow runs are awaitable subprocesses, at most `pipeline_slots` at a time, split
+        per barcode when there is more than one slot; a barcode never runs twice at once
+      - aggregation is a single FIFO consumer, so per-barcode results stay in order
+      - blocking directory scans and gzip checks use a two-thread pool, aggregation one
+        daemon thread, so the thread count does not grow with the number of barcodes
+
+    SIGINT/SIGTERM cancel every task and stop all child process groups within a second.
+    """
+    def __init__(self, config: configparser.ConfigParser, file_queue, processed_files, journal, dir_index,
+                 watcher, batcher=None, metrics_path: str = None, backpressure=None):
+        self.config = config
+        self.file_queue = file_queue
+        self.processed_files = processed_files
+        self.journal = journal
+        self.dir_index = dir_index
+        self.watcher = watcher
+        self.batcher = batcher
+        self.metrics_path = metrics_path
+        self.backpressure = backpressure
+        self.slots = max(1, config.getint('Settings', 'pipeline_slots', fallback=1))
+        self.queue_size = max(1, config.getint('Settings', 'stage_queue_size', fallback=2))
+        self._unit_ids = itertools.count(1)
+        self._barcode_locks = {}
+        self._units = set()
+        self._waiting = 0        # units admitted but not yet holding a pipeline slot
+        self._aggregating = False
+        self._io_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="backend-io")
+
+    # --- State used by the batcher and the metrics ---
+
+    def pending(self) -> int:
+        """Number of units waiting for a pipeline slot plus batches waiting for aggregation."""
+        return self._waiting + self.aggregation_queue.qsize()
+
+    def saturated(self) -> bool:
+        """True while every unit slot is taken; new batches are then left in the scheduler."""
+        return self._admission.locked()
+
+    def busy(self) -> bool:
+        return bool(self._units or self._aggregating or self.aggregation_queue.qsize())
+
+    # --- Entry point ---
+
+    async def run(self, resume_aggregation: list = ()):
+        loop = asyncio.get_running_loop()
+        self._stop = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self._stop.set)
+
+        self._pipeline_slots = asyncio.Semaphore(self.slots)
+        # Bounds the units in flight; the batch timer blocks on it, applying backpressure to ingestion
+        self._admission = asyncio.Semaphore(self.slots + self.queue_size)
+        self.aggregation_queue = asyncio.Queue(maxsize=self.queue_size)
+
+        tasks = [asyncio.create_task(self._aggregation_worker(), name="aggregation")]
+        if isinstance(self.watcher, InotifyWatcher):
+            self.watcher.attach(loop)
+            tasks.append(asyncio.create_task(self._flush_watcher(), name="inotify-flush"))
+        tasks.append(asyncio.create_task(self._resume_then_batch(resume_aggregation), name="batch-timer"))
+        logger.info(f"Async backend running ({self.slots} pipeline slot(s)). Press Ctrl+C to stop.")
+
+        try:
+            await self._stop.wait()
+            logger.info("Shutdown signal received.")
+        finally:
+            await self._shutdown(loop, tasks)
+
+    async def _shutdown(self, loop, tasks: list):
+        everything = tasks + list(self._units)
+        for task in everything:
+            task.cancel()
+        # Cancelled Nextflow tasks stop their own process groups; the aggregator's children are stopped here
+        await asyncio.gather(_in_daemon_thread(child_processes.terminate_all, 0.5),
+                             asyncio.wait(everything, timeout=0.8), return_exceptions=True)
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.remove_signal_handler(sig)
+        if isinstance(self.watcher, InotifyWatcher):
+            self.watcher.detach(loop)
+        else:
+            self.watcher.stop()
+            self.watcher.join(timeout=0.2)
+        self._io_pool.shutdown(wait=False, cancel_futures=True)
+        result_aggregator.shutdown_pools()
+
+    # --- Tasks ---
+
+    async def _flush_watcher(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.watcher.settle_seconds / 2)
+            await loop.run_in_executor(self._io_pool, self.watcher.flush_settled)
+
+    async def _resume_then_batch(self, resume_aggregation: list):
+        for batch_id, batch_dir, remaining in resume_aggregation:
+            await self.aggregation_queue.put((batch_id, batch_dir, remaining))
+        await self._batch_timer()
+
+    async def _batch_timer(self):
+        loop = asyncio.get_running_loop()
+        last_sweep = time.monotonic()
+        while True:
+            batch_interval = self.config.getint('Settings', 'batch_interval_seconds')
+            if self.batcher:
+                # Poll frequently; the batcher decides when a batch is worth cutting
+                await asyncio.sleep(self.config.getfloat('Batching', 'poll_seconds', fallback=1.0))
+            else:
+                logger.info(f"Waiting for {batch_interval} seconds to gather next batch...")
+                await asyncio.sleep(batch_interval)
+
+            # Failsafe sweep, as in the threaded loop
+            if time.monotonic() - last_sweep >= batch_interval:
+                last_sweep = time.monotonic()
+                if isinstance(self.watcher, InotifyWatcher):
+                    self.watcher.retry_abandoned()
+                found = await loop.run_in_executor(self._io_pool, self.dir_index.scan, self.processed_files)
+                for file_path in found:
+                    if isinstance(self.watcher, InotifyWatcher):
+                        self.watcher.notify(file_path)
+                        continue
+                    logger.info(f"Failsafe scanner queued file: {os.path.basename(file_path)}")
+                    if self.file_queue.put(file_path):
+                        self.processed_files.add(file_path)
+
+            publish_queue_metrics(self.file_queue, self)
+            if self.metrics_path:
+                REGISTRY.write_textfile(self.metrics_path)
+
+            if self.backpressure:
+                self.backpressure.apply(self.file_queue, self.batcher)
+            if self.saturated():
+                continue
+            per_barcode_cap = self.backpressure.max_files_per_barcode if self.backpressure else None
+            if self.batcher:
+                batch = self.batcher.next_batch(self.file_queue, busy=self.busy(), max_files_per_barcode=per_barcode_cap)
+            else:
+                limits = self.backpressure.batch_limits() if self.backpressure else {}
+                batch = self.file_queue.get_batch(**limits)
+            if not batch:
+                if not self.batcher:
+                    logger.info("No new files detected in this interval.")
+                continue
+
+            logger.info(f"Collected a batch of {len(batch)} new files. Starting analysis.")
+            record_batch(batch)
+            await self._submit(batch)
+
+    async def _submit(self, batch: list):
+        if self.slots > 1:
+            units = {}
+            for file_path in batch:
+                units.setdefault(barcode_of(file_path), []).append(file_path)
+        else:
+            units = {None: batch}
+        for barcode, files in units.items():
+            await self._admission.acquire()
+            task = asyncio.create_task(self._run_unit(barcode, files))
+            self._units.add(task)
+            task.add_done_callback(self._units.discard)
+
+    async def _run_unit(self, barcode: str, files: list):
+        lock = self._barcode_locks.setdefault(barcode, asyncio.Lock())
+        try:
+            async with lock:
+                self._waiting += 1
+                try:
+                    await self._pipeline_slots.acquire()
+                finally:
+                    self._waiting -= 1
+                try:
+                    run_name = f"{barcode}_{next(self._unit_ids)}" if barcode else None
+                    if run_name:
+                        logger.info(f"Dispatching {len(files)} file(s) for {barcode} ({run_name}).")
+                    start = time.monotonic()
+                    batch_id, batch_result_directory = await run_pipeline_unit_async(
+                        files, self.config, journal=self.journal, run_name=run_name)
+                finally:
+                    self._pipeline_slots.release()
+
+                if not batch_result_directory:
+                    logger.error("Skipping result aggregation due to a pipeline failure.")
+                    return
+                if self.batcher:
+                    self.batcher.record_pipeline(_batch_bytes(files), time.monotonic() - start)
+                # Queued before the barcode is released, so its next unit is always aggregated after this one
+                await self.aggregation_queue.put((batch_id, batch_result_directory, None))
+        finally:
+            self._admission.release()
+
+    async def _aggregation_worker(self):
+        while True:
+            batch_id, batch_result_directory, barcodes = await self.aggregation_queue.get()
+            self._aggregating = True
+            start = time.monotonic()
+            try:
+                await _in_daemon_thread(run_aggregation_unit, batch_id, batch_result_directory, self.config,
+                                        self.journal, barcodes)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Aggregation crashed for {batch_result_directory}: {e}", exc_info=True)
+            finally:
+                self._aggregating = False
+            if self.batcher:
+                self.batcher.record_aggregation(time.monotonic() - start)
@@ -0,0 +1,138 @@
+# backpressure.py
+import os
+import logging
+import configparser
+from collections import deque
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+class BackpressurePolicy:
+    """
+    Keeps a backlog from turning into one huge, slow Nextflow run when classification
+    falls behind:
+
+      - every batch (and every per-barcode unit) is capped at max_batch_files /
+        max_batch_bytes / max_files_per_barcode; the remainder stays queued for later
+        batches, where priorities still apply
+      - optional degraded mode: once a barcode's queued work exceeds
+        degrade_after_minutes, its queue is thinned back to that budget by deferring
+        evenly spaced files. Abundances are estimated from a subsample rather than
+        stalling every other barcode. The barcode leaves degraded mode when its backlog
+        drops below half the budget, and its deferred files are then queued again as
+        the backlog leaves room. Urgent barcodes are never shed.
+
+    Deferred files are never recorded as processed, so files still deferred when the
+    service stops are found again by the next startup's catch-up scan.
+
+    Queued work is estimated with the adaptive batcher's per-byte cost when available,
+    otherwise with assumed_bytes_per_second.
+    """
+    # Leave degraded mode once the backlog is below this fraction of the budget
+    RECOVER_RATIO = 0.5
+
+    def __init__(self, max_files: int = None, max_bytes: int = None, max_files_per_barcode: int = None,
+                 degrade_after_seconds: float = 0, assumed_bytes_per_second: float = 5e6):
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self.max_files_per_barcode = max_files_per_barcode
+        self.degrade_after_seconds = degrade_after_seconds
+        self.assumed_bytes_per_second = assumed_bytes_per_second
+        self.degraded = set()
+        self.deferred = {}  # barcode -> deque of deferred file paths, oldest first
+
+    @classmethod
+    def from_config(cls, config: configparser.ConfigParser) -> "BackpressurePolicy":
+        section = 'Backpressure'
+        # 0 means "no limit" for every cap
+        def optional_int(key):
+            return config.getint(section, key, fallback=0) or None
+        return cls(
+            max_files=optional_int('max_batch_files'),
+            max_bytes=optional_int('max_batch_bytes'),
+            max_files_per_barcode=optional_int('max_files_per_barcode'),
+            degrade_after_seconds=config.getfloat(section, 'degrade_after_minutes', fallback=0) * 60,
+            assumed_bytes_per_second=config.getfloat(section, 'assumed_bytes_per_second', fallback=5e6),
+        )
+
+    def batch_limits(self) -> dict:
+        """Keyword arguments for BarcodeScheduler.get_batch."""
+        return {'max_files': self.max_files, 'max_bytes': self.max_bytes,
+                'max_files_per_barcode': self.max_files_per_barcode}
+
+    def work_seconds(self, backlog_bytes: int, batcher=None) -> float:
+        estimate = batcher.estimated_seconds(backlog_bytes) if batcher else None
+        if estimate is None:
+            estimate = backlog_bytes / self.assumed_bytes_per_second
+        return estimate
+
+    def apply(self, scheduler, batcher=None) -> list:
+        """
+        Updates each barcode's degraded state, defers files from degraded backlogs and
+        requeues deferred files where the backlog has drained. Returns the files deferred.
+        Deferred files stay marked as queued in the ledger, so sweeps do not queue them twice.
+        """
+        if not self.degrade_after_seconds:
+            return []
+        shed_files = []
+        backlog = scheduler.backlog_by_barcode()
+        for barcode in list(self.degraded):
+            if barcode not in backlog:
+                self._set_degraded(barcode, False, 0.0)
+
+        for barcode, (_, backlog_bytes) in backlog.items():
+            if barcode in scheduler.urgent:
+                continue
+            work = self.work_seconds(backlog_bytes, batcher)
+            if barcode not in self.degraded and work > self.degrade_after_seconds:
+                self._set_degraded(barcode, True, work)
+            elif barcode in self.degraded and work < self.RECOVER_RATIO * self.degrade_after_seconds:
+                self._set_degraded(barcode, False, work)
+
+            if barcode in self.degraded and work > self.degrade_after_seconds:
+                dropped = scheduler.shed(barcode, self.degrade_after_seconds / work)
+                if dropped:
+                    self.deferred.setdefault(barcode, deque()).extend(dropped)
+                    REGISTRY.inc("nanort_files_shed_total", len(dropped), {'barcode': barcode},
+                                 help_text="Files deferred by degraded mode, per barcode")
+                    logger.warning(f"{barcode} is degraded: deferred {len(dropped)} queued file(s) to stay within "
+                                   f"{self.degrade_after_seconds / 60:.0f} minutes of work.")
+                    shed_files.extend(dropped)
+
+        self._requeue_deferred(scheduler, backlog, batcher)
+        return shed_files
+
+    def _requeue_deferred(self, scheduler, backlog: dict, batcher=None):
+        """Moves deferred files back into the queue of barcodes out of degraded mode, up to half the budget."""
+        for barcode, files in list(self.deferred.items()):
+            if barcode in self.degraded:
+                continue
+            backlog_bytes = backlog.get(barcode, (0, 0))[1]
+            requeued = 0
+            while files and (not backlog_bytes or self.work_seconds(backlog_bytes, batcher)
+                             < self.RECOVER_RATIO * self.degrade_after_seconds):
+                file_path = files.popleft()
+                if not os.path.exists(file_path) or not scheduler.put(file_path):
+                    continue
+                try:
+                    backlog_bytes += os.path.getsize(file_path)
+                except OSError:
+                    pass
+                requeued += 1
+            if requeued:
+                logger.info(f"{barcode}: requeued {requeued} deferred file(s), {len(files)} still deferred.")
+            if not files:
+                del self.deferred[barcode]
+            REGISTRY.set("nanort_files_deferred", len(files), {'barcode': barcode},
+                         help_text="Files deferred by degraded mode and not yet requeued, per barcode")
+
+    def _set_degraded(self, barcode: str, degraded: bool, work: float):
+        if degraded:
+            self.degraded.add(barcode)
+            logger.warning(f"{barcode} entered degraded mode: ~{work / 60:.1f} minutes of work queued.")
+        else:
+            self.degraded.discard(barcode)
+            logger.info(f"{barcode} left degraded mode.")
+        REGISTRY.set("nanort_barcode_degraded", 1 if degraded else 0, {'barcode': barcode},
+                     help_text="1 while a barcode is in degraded (load-shedding) mode")
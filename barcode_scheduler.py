@@ -0,0 +1,170 @@
+# barcode_scheduler.py
+import os
+import time
+import logging
+import configparser
+from collections import deque
+from threading import Lock
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+# Priority classes, best first
+URGENT = "urgent"
+STARVED = "starved"
+NORMAL = "normal"
+LOW = "low"
+_RANK = {URGENT: 0, STARVED: 1, NORMAL: 2, LOW: 3}
+
+def _parse_barcodes(value: str) -> set:
+    return {b.strip() for b in value.split(',') if b.strip()}
+
+def barcode_of(file_path: str) -> str:
+    """Returns the barcode a FASTQ belongs to (its parent folder, as main.nf groups them)."""
+    return os.path.basename(os.path.dirname(file_path))
+
+class BarcodeScheduler:
+    """
+    Replaces the plain FIFO file queue with one queue per barcode.
+
+    Files for barcodes that are not listed in [Settings] barcodes are dropped at the
+    door instead of being sent to Nextflow. Batches are filled barcode by barcode in
+    priority order: clinically urgent barcodes first, then barcodes whose oldest file
+    has waited longer than `starvation_seconds`, then everything else by age, then the
+    low-priority barcodes. With no priorities configured this is plain arrival order.
+
+    Keeps the put/get/empty/qsize surface of queue.Queue so the watchers can use it as is.
+    """
+    def __init__(self, barcodes: set = None, urgent: set = None, low: set = None, starvation_seconds: float = 600.0):
+        self.barcodes = barcodes or set()
+        self.urgent = urgent or set()
+        self.low = low or set()
+        self.starvation_seconds = starvation_seconds
+        self.queues = {}  # barcode -> deque of (path, size, arrival time)
+        self.total_bytes = 0
+        self.enqueued_bytes = 0  # running total, used to estimate the arrival rate
+        self.dropped = 0
+        self._lock = Lock()
+
+    @classmethod
+    def from_config(cls, config: configparser.ConfigParser) -> "BarcodeScheduler":
+        return cls(
+            barcodes=_parse_barcodes(config.get('Settings', 'barcodes', fallback='')),
+            urgent=_parse_barcodes(config.get('Scheduling', 'urgent_barcodes', fallback='')),
+            low=_parse_barcodes(config.get('Scheduling', 'low_priority_barcodes', fallback='')),
+            starvation_seconds=config.getfloat('Scheduling', 'starvation_seconds', fallback=600.0),
+        )
+
+    # --- Queue-compatible surface ---
+
+    def put(self, file_path: str) -> bool:
+        """Queues a file, unless its barcode is not configured. Returns whether it was queued."""
+        barcode = barcode_of(file_path)
+        if self.barcodes and barcode not in self.barcodes:
+            self.dropped += 1
+            REGISTRY.inc("nanort_files_ignored_total", help_text="Files dropped because their barcode is not configured")
+            logger.debug(f"Ignoring {os.path.basename(file_path)}: {barcode} is not a configured barcode.")
+            return False
+        try:
+            size = os.path.getsize(file_path)
+        except OSError:
+            size = 0
+        with self._lock:
+            self.queues.setdefault(barcode, deque()).append((file_path, size, time.monotonic()))
+            self.total_bytes += size
+            self.enqueued_bytes += size
+        return True
+
+    def get(self) -> str:
+        batch = self.get_batch(max_files=1)
+        if not batch:
+            raise IndexError("get from an empty scheduler")
+        return batch[0]
+
+    def empty(self) -> bool:
+        return self.qsize() == 0
+
+    def qsize(self) -> int:
+        with self._lock:
+            return sum(len(q) for q in self.queues.values())
+
+    # --- Scheduling ---
+
+    def priority_of(self, barcode: str, now: float = None) -> str:
+        if barcode in self.urgent:
+            return URGENT
+        queue = self.queues.get(barcode)
+        now = time.monotonic() if now is None else now
+        if queue and now - queue[0][2] >= self.starvation_seconds:
+            return STARVED
+        if barcode in self.low:
+            return LOW
+        return NORMAL
+
+    def rank(self, barcode: str) -> int:
+        """Sort key for a barcode's priority class (lower runs first)."""
+        with self._lock:
+            return _RANK[self.priority_of(barcode)]
+
+    def depth_by_barcode(self) -> dict:
+        """Number of queued files per barcode."""
+        with self._lock:
+            return {barcode: len(q) for barcode, q in self.queues.items() if q}
+
+    def backlog_by_barcode(self) -> dict:
+        """(queued files, queued bytes) per barcode."""
+        with self._lock:
+            return {barcode: (len(q), sum(size for _, size, _ in q)) for barcode, q in self.queues.items() if q}
+
+    def oldest_age(self) -> float:
+        """Seconds the oldest queued file has been waiting (0 when empty)."""
+        with self._lock:
+            arrivals = [q[0][2] for q in self.queues.values() if q]
+        return time.monotonic() - min(arrivals) if arrivals else 0.0
+
+    def get_batch(self, max_files: int = None, max_bytes: int = None, max_files_per_barcode: int = None) -> list:
+        """
+        Pops up to max_files / max_bytes worth of files, best priority class first, oldest first
+        within a class. max_files_per_barcode stops one flooding barcode from filling the batch.
+        """
+        batch, batch_bytes = [], 0
+        taken = {}
+        now = time.monotonic()
+        with self._lock:
+            while max_files is None or len(batch) < max_files:
+                candidates = [b for b, q in self.queues.items()
+                              if q and (max_files_per_barcode is None or taken.get(b, 0) < max_files_per_barcode)]
+                if not candidates:
+                    break
+                barcode = min(candidates, key=lambda b: (_RANK[self.priority_of(b, now)], self.queues[b][0][2]))
+                file_path, size, _ = self.queues[barcode][0]
+                if batch and max_bytes is not None and batch_bytes + size > max_bytes:
+                    break
+                self.queues[barcode].popleft()
+                batch.append(file_path)
+                batch_bytes += size
+                taken[barcode] = taken.get(barcode, 0) + 1
+            self.total_bytes -= batch_bytes
+        return batch
+
+    def shed(self, barcode: str, keep_fraction: float) -> list:
+        """
+        Thins a barcode's queue to keep_fraction of its files, dropping evenly spaced files so
+        the kept ones still cover the whole time span. Returns the dropped paths.
+        """
+        kept, dropped, dropped_bytes = deque(), [], 0
+        with self._lock:
+            queue = self.queues.get(barcode)
+            if not queue:
+                return []
+            for i, item in enumerate(queue):
+                # Keep a file whenever the running quota crosses an integer
+                if int((i + 1) * keep_fraction) > int(i * keep_fraction):
+                    kept.append(item)
+                else:
+                    dropped.append(item[0])
+                    dropped_bytes += item[1]
+            self.queues[barcode] = kept
+            self.total_bytes -= dropped_bytes
+        return dropped
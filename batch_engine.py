@@ -0,0 +1,269 @@
+# batch_engine.py
+import os
+import time
+import logging
+import itertools
+import configparser
+from queue import Queue, Full, Empty
+from threading import Thread, Lock
+from concurrent.futures import ThreadPoolExecutor
+
+import pipeline_runner
+import result_aggregator
+from barcode_scheduler import barcode_of
+
+logger = logging.getLogger(__name__)
+
+# Sentinel pushed through the stage queues to stop the worker threads
+_STOP = object()
+
+def run_pipeline_unit(files: list, config: configparser.ConfigParser, journal=None, run_name: str = None):
+    """
+    Runs the pipeline for a set of files, journaling the batch around it.
+    Returns (batch_id, batch_result_directory); the directory is None on failure.
+    """
+    batch_id = journal.begin(files) if journal else None
+    try:
+        batch_result_directory = pipeline_runner.run_batch(files, config, run_name=run_name)
+    except Exception as e:
+        logger.error(f"Pipeline crashed for a batch of {len(files)} files: {e}", exc_info=True)
+        batch_result_directory = None
+    if journal:
+        if batch_result_directory:
+            journal.pipeline_done(batch_id, batch_result_directory)
+        else:
+            journal.abandon(batch_id)
+    return batch_id, batch_result_directory
+
+def run_aggregation_unit(batch_id: str, batch_result_directory: str, config: configparser.ConfigParser,
+                         journal=None, barcodes: list = None):
+    """Aggregates a finished batch, journaling each barcode as it is folded in."""
+    on_barcode_done = (lambda barcode: journal.barcode_aggregated(batch_id, barcode)) if journal else None
+    result_aggregator.aggregate_and_plot(batch_result_directory, config, barcodes=barcodes, on_barcode_done=on_barcode_done)
+    if journal:
+        journal.aggregated(batch_id)
+        # aggregate_and_plot removes the batch folder itself when CLEANUP_BATCH_FOLDERS is set
+        journal.cleaned(batch_id)
+
+def _batch_bytes(files: list) -> int:
+    total = 0
+    for file_path in files:
+        try:
+            total += os.path.getsize(file_path)
+        except OSError:
+            pass
+    return total
+
+class BarcodeDispatcher:
+    """
+    Routes files into per-barcode work units and runs them on a pool of concurrent
+    pipeline slots. Each finished unit goes straight to `on_result`, so a flooding
+    barcode no longer holds back the results of the others.
+
+    A barcode never has more than one unit in flight: files arriving meanwhile are
+    held back and merged into its next unit, which keeps per-barcode results ordered.
+    Units are capped at max_unit_files so a held-back backlog is not sent in one go.
+    """
+    def __init__(self, config: configparser.ConfigParser, slots: int, on_result, batcher=None, journal=None, scheduler=None,
+                 max_unit_files: int = None):
+        self.config = config
+        self.slots = slots
+        self.on_result = on_result
+        self.batcher = batcher
+        self.journal = journal
+        self.scheduler = scheduler
+        self.max_unit_files = max_unit_files
+        self.pool = ThreadPoolExecutor(max_workers=slots, thread_name_prefix="pipeline-slot")
+        self.pending = {}     # barcode -> list of files waiting for the next unit
+        self.in_flight = set()
+        self._lock = Lock()
+        self._unit_ids = itertools.count(1)
+        self._closed = False
+
+    def submit(self, files: list):
+        with self._lock:
+            for file_path in files:
+                self.pending.setdefault(barcode_of(file_path), []).append(file_path)
+            self._dispatch_ready()
+
+    def queued_files(self) -> int:
+        with self._lock:
+            return sum(len(files) for files in self.pending.values())
+
+    def busy(self) -> bool:
+        with self._lock:
+            return bool(self.in_flight or self.pending)
+
+    def _dispatch_ready(self):
+        """Starts a unit for every barcode that has pending files and none in flight. Caller holds the lock."""
+        if self._closed:
+            return
+        # Units are only started when a slot is free, so priorities apply at the moment a slot opens
+        ranked = sorted(self.pending, key=lambda b: (self.scheduler.rank(b) if self.scheduler else 0, b))
+        for barcode in ranked:
+            if len(self.in_flight) >= self.slots:
+                break
+            if barcode in self.in_flight:
+                continue
+            files = self.pending.pop(barcode)
+            if self.max_unit_files and len(files) > self.max_unit_files:
+                files, self.pending[barcode] = files[:self.max_unit_files], files[self.max_unit_files:]
+            self.in_flight.add(barcode)
+            run_name = f"{barcode}_{next(self._unit_ids)}"
+            logger.info(f"Dispatching {len(files)} file(s) for {barcode} ({run_name}).")
+            self.pool.submit(self._run_unit, barcode, files, run_name)
+
+    def _run_unit(self, barcode: str, files: list, run_name: str):
+        start = time.monotonic()
+        batch_id, batch_result_directory = run_pipeline_unit(files, self.config, journal=self.journal, run_name=run_name)
+        if self.batcher and batch_result_directory:
+            self.batcher.record_pipeline(_batch_bytes(files), time.monotonic() - start)
+
+        try:
+            if batch_result_directory:
+                # Handed over before the barcode is released, so its next unit is always aggregated after this one
+                self.on_result((batch_id, batch_result_directory, None))
+            else:
+                logger.error(f"Skipping result aggregation for {barcode} due to a pipeline failure.")
+        finally:
+            with self._lock:
+                self.in_flight.discard(barcode)
+                self._dispatch_ready()
+
+    def shutdown(self, wait: bool = True):
+        """Stops dispatching new units. Files still pending are left for the next catch-up scan."""
+        with self._lock:
+            self._closed = True
+        self.pool.shutdown(wait=wait)
+
+class StagedEngine:
+    """
+    Runs the pipeline and aggregation stages in their own threads, joined by bounded
+    queues, so batch N+1 can be classified while batch N is still being aggregated.
+
+    Each stage consumes its queue strictly in FIFO order with a single worker, so
+    batches (and therefore every barcode's cumulative outputs) are aggregated in
+    exactly the order they were submitted. With more than one pipeline slot, batches
+    are split into per-barcode units by a BarcodeDispatcher instead.
+    """
+    def __init__(self, config: configparser.ConfigParser, queue_size: int = 2, pipeline_slots: int = 1,
+                 batcher=None, journal=None, scheduler=None, max_unit_files: int = None):
+        self.config = config
+        self.batcher = batcher
+        self.journal = journal
+        self.pipeline_queue = Queue(maxsize=queue_size)
+        self.aggregation_queue = Queue(maxsize=queue_size)
+        self._active = 0  # batches currently inside a stage worker
+        self._active_lock = Lock()
+        self.dispatcher = None
+        if pipeline_slots > 1:
+            self.dispatcher = BarcodeDispatcher(config, pipeline_slots, on_result=self.aggregation_queue.put,
+                                                batcher=batcher, journal=journal, scheduler=scheduler,
+                                                max_unit_files=max_unit_files)
+        self._threads = [
+            Thread(target=self._pipeline_stage, name="pipeline-stage", daemon=True),
+            Thread(target=self._aggregation_stage, name="aggregation-stage", daemon=True),
+        ]
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+        mode = f"{self.dispatcher.slots} per-barcode slots" if self.dispatcher else "single slot"
+        logger.info(f"Staged engine started (ingestion -> pipeline -> aggregation, {mode}).")
+
+    def submit(self, batch: list):
+        """Hands a batch to the pipeline stage. Blocks while the stage queue is full."""
+        self.pipeline_queue.put(batch)
+
+    def resume_aggregation(self, batch_id: str, batch_result_directory: str, barcodes: list = None):
+        """Queues a batch whose pipeline already finished before a restart straight into aggregation."""
+        self.aggregation_queue.put((batch_id, batch_result_directory, barcodes))
+
+    def pending(self) -> int:
+        """Number of batches waiting in front of the pipeline and aggregation stages."""
+        return self.pipeline_queue.qsize() + self.aggregation_queue.qsize()
+
+    def saturated(self) -> bool:
+        """
+        True while the pipeline stage has no room for another batch. The backend then keeps
+        files in the scheduler, where priorities and load shedding still apply.
+        """
+        return self.pipeline_queue.full() or bool(self.dispatcher and self.dispatcher.queued_files())
+
+    def busy(self) -> bool:
+        """True while any batch is queued for, or being processed by, the pipeline or aggregation stage."""
+        with self._active_lock:
+            active = self._active
+        return bool(active or self.pending() or (self.dispatcher and self.dispatcher.busy()))
+
+    def _set_active(self, delta: int):
+        with self._active_lock:
+            self._active += delta
+
+    def _pipeline_stage(self):
+        while True:
+            batch = self.pipeline_queue.get()
+            if batch is _STOP:
+                if self.dispatcher:
+                    self.dispatcher.shutdown(wait=True)
+                self.aggregation_queue.put(_STOP)
+                return
+
+            if self.dispatcher:
+                self.dispatcher.submit(batch)
+                continue
+
+            self._set_active(1)
+            start = time.monotonic()
+            try:
+                batch_id, batch_result_directory = run_pipeline_unit(batch, self.config, journal=self.journal)
+            finally:
+                self._set_active(-1)
+            if self.batcher and batch_result_directory:
+                self.batcher.record_pipeline(_batch_bytes(batch), time.monotonic() - start)
+
+            if batch_result_directory:
+                self.aggregation_queue.put((batch_id, batch_result_directory, None))
+            else:
+                logger.error("Skipping result aggregation due to a pipeline failure.")
+
+    def _aggregation_stage(self):
+        while True:
+            item = self.aggregation_queue.get()
+            if item is _STOP:
+                return
+            batch_id, batch_result_directory, barcodes = item
+            self._set_active(1)
+            start = time.monotonic()
+            try:
+                run_aggregation_unit(batch_id, batch_result_directory, self.config, journal=self.journal, barcodes=barcodes)
+            except Exception as e:
+                logger.error(f"Aggregation stage crashed for {batch_result_directory}: {e}", exc_info=True)
+            finally:
+                self._set_active(-1)
+            if self.batcher:
+                self.batcher.record_aggregation(time.monotonic() - start)
+
+    def shutdown(self, wait: bool = True):
+        """
+        Stops accepting batches and, if wait is set, drains the queued work first. Without
+        wait it never blocks: queued batches are dropped (their files are not in the
+        processed ledger, so the next catch-up scan finds them again).
+        """
+        if wait:
+            self.pipeline_queue.put(_STOP)
+            for thread in self._threads:
+                thread.join()
+        else:
+            while True:
+                try:
+                    self.pipeline_queue.put_nowait(_STOP)
+                    break
+                except Full:
+                    try:
+                        self.pipeline_queue.get_nowait()
+                    except Empty:
+                        pass
+            if self.dispatcher:
+                self.dispatcher.shutdown(wait=False)
+        logger.info("Staged engine stopped.")
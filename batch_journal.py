@@ -0,0 +1,133 @@
+# batch_journal.py
+import os
+import json
+import time
+import logging
+import itertools
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+# Batch lifecycle, in order. A batch is finished once it reaches CLEANED (or ABANDONED).
+QUEUED = "queued"
+PIPELINE_DONE = "pipeline_done"
+BARCODE_AGGREGATED = "barcode_aggregated"
+AGGREGATED = "aggregated"
+CLEANED = "cleaned"
+ABANDONED = "abandoned"
+
+class BatchJournal:
+    """
+    Write-ahead journal of in-flight batches, stored as JSON lines and fsync'd on every
+    transition, so a restarted backend can resume each batch from its last completed
+    stage instead of re-running Nextflow:
+
+      queued         -> files handed to the pipeline; on restart they are re-queued
+      pipeline_done  -> batch folder is complete; on restart only aggregation is re-run
+      barcode_aggregated (per barcode) -> that barcode is skipped on resume
+      aggregated / cleaned -> nothing left to do
+
+    Finished batches are dropped when the journal is compacted on startup.
+    """
+    def __init__(self, journal_path: str):
+        self.journal_path = journal_path
+        self.batches = {}  # batch id -> state dict
+        self._lock = Lock()
+        self._load()
+        self._compact()
+        self._ids = itertools.count(1)
+
+    def _load(self):
+        if not os.path.exists(self.journal_path):
+            return
+        try:
+            with open(self.journal_path, 'r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # A torn final line from a crash mid-write; everything before it is valid
+                        logger.warning("Ignoring a truncated record in the batch journal.")
+                        continue
+                    self._apply(record)
+        except IOError as e:
+            logger.error(f"Could not read batch journal '{self.journal_path}': {e}")
+
+    def _apply(self, record: dict):
+        batch_id, state = record['batch'], record['state']
+        entry = self.batches.setdefault(batch_id, {'id': batch_id, 'state': QUEUED, 'files': [],
+                                                   'batch_dir': None, 'aggregated_barcodes': []})
+        if state == QUEUED:
+            entry['files'] = record.get('files', [])
+        elif state == PIPELINE_DONE:
+            entry['batch_dir'] = record.get('batch_dir')
+        elif state == BARCODE_AGGREGATED:
+            entry['aggregated_barcodes'].append(record['barcode'])
+            return
+        entry['state'] = state
+
+    def _compact(self):
+        """Rewrites the journal keeping only batches that are still in flight."""
+        live = [e for e in self.batches.values() if e['state'] not in (CLEANED, ABANDONED)]
+        self.batches = {e['id']: e for e in live}
+        temp_path = self.journal_path + ".tmp"
+        try:
+            with open(temp_path, 'w') as f:
+                for entry in live:
+                    f.write(json.dumps({'batch': entry['id'], 'state': QUEUED, 'files': entry['files']}) + "\n")
+                    if entry['batch_dir']:
+                        f.write(json.dumps({'batch': entry['id'], 'state': PIPELINE_DONE, 'batch_dir': entry['batch_dir']}) + "\n")
+                    for barcode in entry['aggregated_barcodes']:
+                        f.write(json.dumps({'batch': entry['id'], 'state': BARCODE_AGGREGATED, 'barcode': barcode}) + "\n")
+                    if entry['state'] == AGGREGATED:
+                        f.write(json.dumps({'batch': entry['id'], 'state': AGGREGATED}) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self.journal_path)
+        except (IOError, OSError) as e:
+            logger.error(f"Could not compact batch journal: {e}")
+
+    def _write(self, record: dict):
+        record['ts'] = time.time()
+        with self._lock:
+            self._apply(record)
+            try:
+                with open(self.journal_path, 'a') as f:
+                    f.write(json.dumps(record) + "\n")
+                    f.flush()
+                    os.fsync(f.fileno())
+            except (IOError, OSError) as e:
+                logger.error(f"Could not write to batch journal: {e}")
+
+    # --- Transitions ---
+
+    def begin(self, files: list) -> str:
+        """Records a new batch of files about to enter the pipeline and returns its id."""
+        batch_id = f"{int(time.time() * 1000)}_{next(self._ids)}"
+        self._write({'batch': batch_id, 'state': QUEUED, 'files': list(files)})
+        return batch_id
+
+    def pipeline_done(self, batch_id: str, batch_dir: str):
+        self._write({'batch': batch_id, 'state': PIPELINE_DONE, 'batch_dir': batch_dir})
+
+    def barcode_aggregated(self, batch_id: str, barcode: str):
+        self._write({'batch': batch_id, 'state': BARCODE_AGGREGATED, 'barcode': barcode})
+
+    def aggregated(self, batch_id: str):
+        self._write({'batch': batch_id, 'state': AGGREGATED})
+
+    def cleaned(self, batch_id: str):
+        self._write({'batch': batch_id, 'state': CLEANED})
+        with self._lock:
+            self.batches.pop(batch_id, None)
+
+    def abandon(self, batch_id: str):
+        """Drops a batch whose files were handed back to the queue (or whose pipeline failed)."""
+        self._write({'batch': batch_id, 'state': ABANDONED})
+        with self._lock:
+            self.batches.pop(batch_id, None)
+
+    def incomplete(self) -> list:
+        """Batches left unfinished by a previous run, oldest first."""
+        with self._lock:
+            return [dict(e) for e in self.batches.values()]
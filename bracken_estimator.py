@@ -0,0 +1,203 @@
+# bracken_estimator.py
+import os
+import logging
+import configparser
+from threading import Lock
+
+import numpy as np
+
+from combine_kreports import process_kraken_report
+
+logger = logging.getLogger(__name__)
+
+# Bracken's level order; nodes at or below the estimation level are mapped up to it
+MAIN_LEVELS = ['R', 'K', 'D', 'P', 'C', 'O', 'F', 'G', 'S']
+OUTPUT_HEADER = "name\ttaxonomy_id\ttaxonomy_lvl\tkraken_assigned_reads\tadded_reads\tnew_est_reads\tfraction_total_reads\n"
+
+_ESTIMATORS = {}
+_ESTIMATORS_LOCK = Lock()
+
+def kmer_distrib_path(config: configparser.ConfigParser) -> str:
+    read_length = config.getint('KrakenParams', 'read_len', fallback=150)
+    return os.path.join(config.get('DatabasePaths', 'kraken_db'), f"database{read_length}mers.kmer_distrib")
+
+def get_bracken_estimator(config: configparser.ConfigParser) -> "BrackenEstimator":
+    """Returns the process-wide estimator for the configured database and read length."""
+    path = os.path.abspath(kmer_distrib_path(config))
+    with _ESTIMATORS_LOCK:
+        if path not in _ESTIMATORS:
+            _ESTIMATORS[path] = BrackenEstimator(path, cache_dir=os.path.join(config.get('Paths', 'output_directory'), "bracken_cache"))
+        return _ESTIMATORS[path]
+
+def _parse_report(report_path: str, level: str, threshold: int):
+    """
+    Reads a Kraken report the way est_abundance.py does. Returns (species, genomes, above):
+    species [taxid, name, clade reads] at the level with at least threshold reads, in report
+    order; genomes {taxid: (species taxid, reads at that node)} for nodes at or below a kept
+    species; above {taxid: reads at that node} for nodes whose reads get redistributed.
+    """
+    species, genomes, above = [], {}, {}
+    under_level = []  # per depth: is this node at or below the level
+    last_taxid = -1
+    with open(report_path, 'r') as f:
+        for line in f:
+            values = process_kraken_report(line)
+            if len(values) < 7:
+                continue
+            name, taxid, depth, level_id, all_reads, lvl_reads = values[:6]
+            if level_id == 'U' or taxid == 0:
+                continue
+            del under_level[depth:]
+            parent_under = bool(under_level) and under_level[-1]
+            under_level.append(parent_under or level_id == level)
+            if not under_level[-1]:
+                if lvl_reads:
+                    above[taxid] = above.get(taxid, 0) + lvl_reads
+            if level_id == level:
+                if all_reads < threshold:
+                    last_taxid = -1
+                else:
+                    species.append([taxid, name, all_reads])
+                    genomes[taxid] = (taxid, lvl_reads)
+                    last_taxid = taxid
+            elif level_id[0] in MAIN_LEVELS and MAIN_LEVELS.index(level_id[0]) >= MAIN_LEVELS.index(level):
+                if last_taxid != -1:
+                    genomes[taxid] = (last_taxid, lvl_reads)
+    return species, genomes, above
+
+class BrackenEstimator:
+    """
+    In-process Bracken (est_abundance.py). The database's kmer_distrib (for each taxon,
+    the fraction of each genome's reads Kraken2 assigns there) is loaded once per process
+    as a sparse matrix, with a .npz copy in cache_dir so other processes skip re-parsing
+    the text file. estimate() re-estimates any number of reports in one set of array
+    operations: each node above the level hands its reads to the kept species in
+    proportion to kmer fraction x reads assigned to the species' genomes.
+    """
+    def __init__(self, kmer_distrib: str, cache_dir: str = None):
+        self.kmer_distrib = kmer_distrib
+        self.cache_dir = cache_dir
+        self._lock = Lock()
+        self._taxids = None  # sorted taxids; rows/cols index into it
+        self._rows = self._cols = self._fractions = None
+
+    # --- kmer_distrib ---
+
+    def _cache_path(self) -> str:
+        st = os.stat(self.kmer_distrib)
+        return os.path.join(self.cache_dir, f"{os.path.basename(self.kmer_distrib)}.{st.st_size}_{st.st_mtime_ns}.npz")
+
+    def _parse(self):
+        distributions = {}
+        with open(self.kmer_distrib, 'r') as f:
+            next(f, None)  # header
+            for line in f:
+                mapped_taxid, _, genomes = line.strip().partition('\t')
+                if not genomes:
+                    continue
+                fractions = {}
+                for genome in genomes.split(' '):
+                    genome_taxid, mapped_kmers, total_kmers = genome.split(':')
+                    fractions[int(genome_taxid)] = float(mapped_kmers) / float(total_kmers)
+                distributions[int(mapped_taxid)] = fractions
+        rows = np.fromiter((m for m, d in distributions.items() for _ in d), dtype=np.int64)
+        cols = np.fromiter((g for d in distributions.values() for g in d), dtype=np.int64)
+        fractions = np.fromiter((x for d in distributions.values() for x in d.values()), dtype=np.float64)
+        taxids = np.union1d(rows, cols)
+        return taxids, np.searchsorted(taxids, rows).astype(np.int32), np.searchsorted(taxids, cols).astype(np.int32), fractions
+
+    def load(self):
+        """Loads the distribution matrix if it is not loaded yet."""
+        with self._lock:
+            if self._taxids is not None:
+                return
+            cache_path = self._cache_path() if self.cache_dir else None
+            if cache_path and os.path.exists(cache_path):
+                with np.load(cache_path) as cached:
+                    self._taxids, self._rows, self._cols, self._fractions = (
+                        cached['taxids'], cached['rows'], cached['cols'], cached['fractions'])
+                return
+            logger.info(f"Loading Bracken distribution {os.path.basename(self.kmer_distrib)}...")
+            self._taxids, self._rows, self._cols, self._fractions = self._parse()
+            if cache_path:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                tmp_path = cache_path + ".tmp.npz"
+                np.savez(tmp_path, taxids=self._taxids, rows=self._rows, cols=self._cols, fractions=self._fractions)
+                os.replace(tmp_path, cache_path)
+            logger.info(f"Bracken distribution loaded: {len(self._fractions)} entries over {len(self._taxids)} taxa.")
+
+    def _lookup(self, taxids: list) -> np.ndarray:
+        """Maps taxids to compact positions: an array over the matrix's taxa, -1 where not given."""
+        lookup = np.full(len(self._taxids), -1, dtype=np.int64)
+        wanted = np.asarray(taxids, dtype=np.int64)
+        index = np.searchsorted(self._taxids, wanted)
+        found = index < len(self._taxids)
+        found[found] = self._taxids[index[found]] == wanted[found]
+        lookup[index[found]] = np.nonzero(found)[0]
+        return lookup
+
+    # --- Estimation ---
+
+    def estimate(self, reports: dict, level: str = 'S', threshold: int = 10) -> dict:
+        """
+        Re-estimates {key: report path} in one pass. Returns {key: rows}, each row being
+        [name, taxid, clade reads, added reads, estimated reads] for a kept species, or
+        {key: None} when a report has no taxa at the level above the threshold.
+        """
+        self.load()
+        keys = list(reports)
+        parsed = [_parse_report(reports[key], level, threshold) for key in keys]
+
+        species_taxids = sorted({s[0] for species, _, _ in parsed for s in species})
+        genome_species = {}
+        for _, genomes, _ in parsed:
+            genome_species.update({g: s for g, (s, _) in genomes.items()})
+        genome_taxids = list(genome_species)
+        node_taxids = sorted({n for _, _, above in parsed for n in above})
+        species_pos = {t: i for i, t in enumerate(species_taxids)}
+        genome_pos = {t: i for i, t in enumerate(genome_taxids)}
+        node_pos = {t: i for i, t in enumerate(node_taxids)}
+
+        # Reads per genome (at kept species and below) and per redistributed node, one column per report
+        weights = np.zeros((len(genome_taxids), len(keys)))
+        node_reads = np.zeros((len(node_taxids), len(keys)))
+        for column, (_, genomes, above) in enumerate(parsed):
+            for taxid, (_, reads) in genomes.items():
+                weights[genome_pos[taxid], column] = reads
+            for taxid, reads in above.items():
+                node_reads[node_pos[taxid], column] = reads
+
+        # Matrix entries linking a node with reads to a genome with reads
+        rows = self._lookup(node_taxids)[self._rows]
+        cols = self._lookup(genome_taxids)[self._cols]
+        keep = (rows >= 0) & (cols >= 0)
+        rows, cols, fractions = rows[keep], cols[keep], self._fractions[keep]
+
+        probability = fractions[:, None] * weights[cols]
+        totals = np.zeros_like(node_reads)
+        np.add.at(totals, rows, probability)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            share = np.where(totals[rows] > 0, probability / totals[rows], 0) * node_reads[rows]
+        added = np.zeros((len(species_taxids), len(keys)))
+        species_of_genome = np.array([species_pos[genome_species[g]] for g in genome_taxids], dtype=np.int64)
+        np.add.at(added, species_of_genome[cols], share)
+
+        results = {}
+        for column, (key, (species, _, _)) in enumerate(zip(keys, parsed)):
+            if not species:
+                results[key] = None
+                continue
+            results[key] = [[name, taxid, all_reads, added[species_pos[taxid], column], float(all_reads) + added[species_pos[taxid], column]]
+                            for taxid, name, all_reads in species]
+        return results
+
+def write_bracken_output(rows: list, path: str, level: str = 'S'):
+    """Writes rows from estimate() in est_abundance.py's output format."""
+    total = sum(row[4] for row in rows)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(OUTPUT_HEADER)
+        for name, taxid, all_reads, _, new_reads in rows:
+            f.write(f"{name}\t{taxid}\t{level}\t{int(all_reads)}\t{int(new_reads) - int(all_reads)}\t"
+                    f"{int(new_reads)}\t{new_reads / total if total else 0:0.5f}\n")
+    os.replace(tmp_path, path)
@@ -0,0 +1,71 @@
+# child_processes.py
+import os
+import time
+import signal
+import logging
+import subprocess
+from threading import Lock, Event
+
+logger = logging.getLogger(__name__)
+
+# Every child started through run() is tracked here so a shutdown can stop them all at once
+_children = set()
+_children_lock = Lock()
+_shutting_down = Event()
+
+class ShutdownRequested(RuntimeError):
+    """Raised instead of starting a new child process once the backend is shutting down."""
+
+def _signal_group(proc: subprocess.Popen, sig: int):
+    try:
+        os.killpg(proc.pid, sig)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+def run(command: list, timeout: float = None, check: bool = False, capture_output: bool = False,
+        text: bool = False, cwd: str = None, env: dict = None) -> subprocess.CompletedProcess:
+    """
+    Drop-in for subprocess.run() with a timeout that takes the child's whole process group
+    down with it (Nextflow, Bracken and the plotting scripts all start children of their own).
+    A timeout of None or 0 waits forever.
+    """
+    if _shutting_down.is_set():
+        raise ShutdownRequested(f"Not starting {os.path.basename(command[0])}: shutdown in progress.")
+    pipe = subprocess.PIPE if capture_output else None
+    proc = subprocess.Popen(command, stdout=pipe, stderr=pipe, text=text, cwd=cwd, env=env, start_new_session=True)
+    with _children_lock:
+        _children.add(proc)
+    try:
+        stdout, stderr = proc.communicate(timeout=timeout or None)
+    except subprocess.TimeoutExpired:
+        logger.error(f"{os.path.basename(command[0])} exceeded its {timeout:g}s timeout; killing it.")
+        _signal_group(proc, signal.SIGKILL)
+        proc.communicate()
+        raise
+    except BaseException:
+        # KeyboardInterrupt or a crash in the caller: never leave an orphaned process group behind
+        _signal_group(proc, signal.SIGKILL)
+        proc.wait()
+        raise
+    finally:
+        with _children_lock:
+            _children.discard(proc)
+    if check and proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, command, output=stdout, stderr=stderr)
+    return subprocess.CompletedProcess(command, proc.returncode, stdout, stderr)
+
+def terminate_all(grace_seconds: float = 0.5):
+    """Refuses new children, sends SIGTERM to running ones and SIGKILLs whatever outlives the grace period."""
+    _shutting_down.set()
+    with _children_lock:
+        children = list(_children)
+    for proc in children:
+        _signal_group(proc, signal.SIGTERM)
+    deadline = time.monotonic() + grace_seconds
+    for proc in children:
+        try:
+            proc.wait(timeout=max(0.0, deadline - time.monotonic()))
+        except subprocess.TimeoutExpired:
+            _signal_group(proc, signal.SIGKILL)
+    if children:
+        logger.info(f"Stopped {len(children)} running child process(es).")
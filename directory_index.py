@@ -0,0 +1,130 @@
+# directory_index.py
+import os
+import json
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+class DirectoryIndex:
+    """
+    Caches the mtime and scandir listing of every directory under a root so that
+    repeated sweeps only re-list the directories that actually changed.
+
+    A directory's mtime only moves when an entry is added, removed or renamed
+    directly inside it, so unchanged barcode folders are skipped with a single stat().
+    """
+    # Directories modified this recently are re-listed on the next sweep as well,
+    # guarding against files created within the same mtime tick as our scandir.
+    SETTLE_SECONDS = 2.0
+
+    def __init__(self, root: str, state_path: str = None, pattern: str = ".fastq.gz"):
+        self.root = os.path.abspath(root)
+        self.state_path = state_path
+        self.pattern = pattern
+        # dir path -> {'mtime_ns': int, 'subdirs': [names], 'files': [names], 'settled': bool}
+        self.dirs = {}
+        self._dirty = False
+        self._load_state()
+
+    def _load_state(self):
+        """Loads the cached directory listings from the JSON state file."""
+        if not self.state_path or not os.path.exists(self.state_path):
+            return
+        try:
+            with open(self.state_path, 'r') as f:
+                state_data = json.load(f)
+            if state_data.get('root') == self.root:
+                self.dirs = state_data.get('dirs', {})
+                logger.info(f"Loaded directory index for {len(self.dirs)} directories from {self.state_path}")
+            else:
+                logger.info("Directory index was built for a different root, starting fresh.")
+        except (json.JSONDecodeError, IOError) as e:
+            logger.warning(f"Could not load directory index, starting fresh. Error: {e}")
+
+    def save_state(self):
+        """Atomically writes the cached listings if anything changed since the last save."""
+        if not self.state_path or not self._dirty:
+            return
+        temp_path = self.state_path + ".tmp"
+        try:
+            with open(temp_path, 'w') as f:
+                json.dump({'root': self.root, 'dirs': self.dirs}, f)
+            os.replace(temp_path, self.state_path)
+            self._dirty = False
+        except (IOError, OSError) as e:
+            logger.error(f"Could not save directory index: {e}")
+
+    def _list_dir(self, path: str):
+        """Returns the (subdirs, files) of a directory, keeping only matching files."""
+        subdirs, files = [], []
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.name)
+                    elif entry.name.endswith(self.pattern):
+                        files.append(entry.name)
+                except OSError:
+                    continue
+        return sorted(subdirs), sorted(files)
+
+    def scan(self, processed_files, full: bool = False) -> list:
+        """
+        Walks the tree, re-listing only directories whose mtime changed, and returns the
+        absolute paths of matching files that are not in `processed_files`.
+
+        With full=True every cached file is checked against `processed_files`, which is
+        what the startup catch-up needs; incremental sweeps only check newly listed files.
+        """
+        new_files = []
+        seen_dirs = set()
+        now = time.time()
+        stack = [self.root]
+
+        while stack:
+            path = stack.pop()
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            seen_dirs.add(path)
+
+            cached = self.dirs.get(path)
+            if cached and cached['mtime_ns'] == st.st_mtime_ns and cached.get('settled', True):
+                subdirs, files = cached['subdirs'], cached['files']
+                candidates = files if full else []
+            else:
+                try:
+                    subdirs, files = self._list_dir(path)
+                except OSError as e:
+                    logger.warning(f"Could not list directory {path}: {e}")
+                    continue
+                if cached and not full:
+                    known = set(cached['files'])
+                    candidates = [f for f in files if f not in known]
+                else:
+                    candidates = files
+                self.dirs[path] = {
+                    'mtime_ns': st.st_mtime_ns,
+                    'subdirs': subdirs,
+                    'files': files,
+                    'settled': (now - st.st_mtime) > self.SETTLE_SECONDS
+                }
+                self._dirty = True
+
+            for name in candidates:
+                file_path = os.path.join(path, name)
+                if file_path not in processed_files:
+                    new_files.append(file_path)
+
+            for name in subdirs:
+                stack.append(os.path.join(path, name))
+
+        # Forget directories that disappeared since the last sweep
+        for stale in set(self.dirs) - seen_dirs:
+            del self.dirs[stale]
+            self._dirty = True
+
+        self.save_state()
+        return sorted(new_files)
@@ -0,0 +1,168 @@
+# host_index.py
+import os
+import json
+import time
+import fcntl
+import hashlib
+import logging
+import subprocess
+import configparser
+from threading import Lock, Thread
+
+import child_processes
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+_MANAGERS = {}
+_MANAGERS_LOCK = Lock()
+
+def get_host_index(config: configparser.ConfigParser):
+    """Returns the process-wide index manager for the configured host reference, or None if there is nothing to manage."""
+    fasta = config.get('DatabasePaths', 'host_reference', fallback='')
+    if not fasta or fasta.endswith(".mmi") or not config.getboolean('HostIndex', 'enabled', fallback=True):
+        return None
+    fasta = os.path.abspath(fasta)
+    with _MANAGERS_LOCK:
+        if fasta not in _MANAGERS:
+            _MANAGERS[fasta] = HostIndex.from_config(fasta, config)
+        return _MANAGERS[fasta]
+
+def host_reference(config: configparser.ConfigParser) -> str:
+    """The reference minimap2 should align against: the prebuilt index once it is valid, the FASTA until then."""
+    manager = get_host_index(config)
+    return manager.resolve() if manager else config.get('DatabasePaths', 'host_reference', fallback='')
+
+def _sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(8 * 1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class HostIndex:
+    """
+    Prebuilt minimap2 index (.mmi) for the host reference, so REMOVE_HOST aligns instead
+    of re-indexing GRCh38 for every barcode of every batch.
+
+    The index is built once with the configured preset next to the FASTA (or in
+    index_directory) and described by a JSON manifest holding the FASTA's SHA-256,
+    size and mtime, the preset and the minimap2 version. A size/mtime match trusts the
+    manifest; otherwise the FASTA is re-hashed and the index rebuilt if it changed.
+    Until a valid index exists, resolve() returns the FASTA, so batches are never held
+    up by a build.
+    """
+    def __init__(self, fasta: str, index_dir: str, preset: str = "map-ont", threads: int = 8, env: dict = None):
+        self.fasta = fasta
+        self.preset = preset
+        self.threads = threads
+        self.env = env
+        base = os.path.join(index_dir, f"{os.path.basename(fasta)}.{preset}")
+        self.index_path = base + ".mmi"
+        self.manifest_path = base + ".mmi.json"
+        self.lock_path = base + ".mmi.lock"
+        self._valid = None  # (fasta size, mtime_ns) the index was last checked against
+        self._lock = Lock()
+
+    @classmethod
+    def from_config(cls, fasta: str, config: configparser.ConfigParser) -> "HostIndex":
+        index_dir = config.get('HostIndex', 'index_directory', fallback='')
+        if not index_dir:
+            index_dir = os.path.dirname(fasta)
+            if not os.access(index_dir, os.W_OK):
+                index_dir = os.path.join(config.get('Paths', 'output_directory'), "host_index")
+        os.makedirs(index_dir, exist_ok=True)
+        # minimap2 from the pipeline's tool environment, like the Nextflow processes
+        pipeline_dir = os.path.dirname(os.path.abspath(config.get('Paths', 'nextflow_script')))
+        env = os.environ.copy()
+        env["PATH"] = os.path.join(pipeline_dir, "bin", "conda-env", "bin") + os.pathsep + env.get("PATH", "")
+        return cls(fasta, index_dir,
+                   preset=config.get('HostIndex', 'preset', fallback='map-ont'),
+                   threads=config.getint('HostIndex', 'build_threads', fallback=8), env=env)
+
+    def _fasta_stat(self):
+        st = os.stat(self.fasta)
+        return st.st_size, st.st_mtime_ns
+
+    def _minimap2_version(self) -> str:
+        result = child_processes.run(["minimap2", "--version"], capture_output=True, text=True, env=self.env)
+        return result.stdout.strip()
+
+    def _read_manifest(self) -> dict:
+        try:
+            with open(self.manifest_path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _write_manifest(self, manifest: dict):
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp_path, self.manifest_path)
+
+    def resolve(self) -> str:
+        """Index path if it has been validated for the FASTA as it is now, else the FASTA."""
+        try:
+            if self._valid is not None and self._valid == self._fasta_stat() and os.path.exists(self.index_path):
+                return self.index_path
+        except OSError:
+            pass
+        return self.fasta
+
+    def _check(self, stat) -> bool:
+        """Whether the index on disk matches the FASTA. Refreshes the manifest if only the mtime moved."""
+        manifest = self._read_manifest()
+        if not manifest or not os.path.exists(self.index_path):
+            return False
+        if manifest.get('preset') != self.preset or manifest.get('index_size') != os.path.getsize(self.index_path):
+            return False
+        if [manifest.get('fasta_size'), manifest.get('fasta_mtime_ns')] == list(stat):
+            return True
+        logger.info("Host reference timestamp changed; verifying its checksum against the index manifest...")
+        if manifest.get('fasta_size') != stat[0] or manifest.get('fasta_sha256') != _sha256(self.fasta):
+            return False
+        manifest['fasta_mtime_ns'] = stat[1]
+        self._write_manifest(manifest)
+        return True
+
+    def ensure(self) -> str:
+        """Validates the index, building it if it is missing or stale. Returns the path to align against."""
+        with self._lock, open(self.lock_path, 'w') as lock_file:
+            # Another backend sharing the reference may be building it right now
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            stat = self._fasta_stat()
+            if not self._check(stat):
+                self._build(stat)
+            self._valid = stat
+        return self.index_path
+
+    def _build(self, stat):
+        logger.info(f"Building minimap2 {self.preset} index for {os.path.basename(self.fasta)}; "
+                    "host depletion uses the FASTA until it is ready.")
+        start = time.monotonic()
+        tmp_path = self.index_path + ".tmp"
+        child_processes.run(["minimap2", "-x", self.preset, "-t", str(self.threads), "-d", tmp_path, self.fasta],
+                            check=True, env=self.env)
+        fasta_sha256 = _sha256(self.fasta)
+        if self._fasta_stat() != stat:
+            os.remove(tmp_path)
+            raise RuntimeError("host reference changed while its index was being built")
+        os.replace(tmp_path, self.index_path)
+        self._write_manifest({
+            'fasta': self.fasta, 'fasta_size': stat[0], 'fasta_mtime_ns': stat[1], 'fasta_sha256': fasta_sha256,
+            'preset': self.preset, 'minimap2_version': self._minimap2_version(),
+            'index_size': os.path.getsize(self.index_path), 'built_at': time.time(),
+        })
+        REGISTRY.observe("nanort_host_index_build_seconds", time.monotonic() - start,
+                         help_text="Time to build the prebuilt minimap2 host index")
+        logger.info(f"Host index ready: {self.index_path} ({time.monotonic() - start:.0f}s).")
+
+    def start(self):
+        """Validates or builds the index in the background."""
+        def work():
+            try:
+                self.ensure()
+            except (OSError, RuntimeError, subprocess.CalledProcessError, child_processes.ShutdownRequested) as e:
+                logger.error(f"Could not prepare the minimap2 host index; aligning against the FASTA: {e}")
+        Thread(target=work, name="host-index", daemon=True).start()
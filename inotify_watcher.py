@@ -0,0 +1,238 @@
+# inotify_watcher.py
+import os
+import gzip
+import zlib
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import logging
+from queue import Queue
+from threading import Thread, Event, Lock
+
+logger = logging.getLogger(__name__)
+
+# --- inotify constants (linux/inotify.h) ---
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+_WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF | IN_MOVE_SELF
+_EVENT_HEADER = struct.Struct("iIII")
+
+def gzip_is_complete(file_path: str) -> bool:
+    """True if the file is a gzip stream that decompresses cleanly up to its end-of-stream marker."""
+    try:
+        with gzip.open(file_path, 'rb') as gz:
+            while gz.read(4 * 1024 * 1024):
+                pass
+        return True
+    except (EOFError, OSError, zlib.error):
+        return False
+
+def _file_identity(file_path: str):
+    try:
+        st = os.stat(file_path)
+    except OSError:
+        return None
+    return st.st_size, st.st_mtime_ns
+
+class InotifyWatcher:
+    """
+    Linux inotify watcher that only queues a FASTQ once MinKNOW has finished writing it.
+
+    Files are picked up on IN_CLOSE_WRITE / IN_MOVED_TO, never on creation. Bursts of
+    events for the same path are coalesced until the path has been quiet for
+    `settle_seconds`, then the gzip stream is verified end to end before queueing;
+    incomplete files stay pending and are retried. Directories created later (new
+    barcodes, new runs) are watched automatically.
+
+    Exposes start()/stop()/join() like a watchdog Observer. Under asyncio, attach() puts
+    the inotify descriptor on the event loop instead and the caller drives flush_settled().
+    """
+    # Set aside a file that is still not a complete gzip after this long (see retry_abandoned)
+    MAX_PENDING_SECONDS = 600
+
+    def __init__(self, path_to_watch: str, file_queue: Queue, processed_files, settle_seconds: float = 1.0,
+                 pattern: str = ".fastq.gz"):
+        self.root = os.path.abspath(path_to_watch)
+        self.file_queue = file_queue
+        self.processed_files = processed_files
+        self.settle_seconds = settle_seconds
+        self.pattern = pattern
+
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, f"inotify_init1 failed: {os.strerror(err)}")
+
+        self._watches = {}  # wd -> directory path
+        self._pending = {}  # file path -> (last event time, first seen time)
+        self._abandoned = {}  # file path -> (size, mtime_ns) when it was set aside
+        self._pending_lock = Lock()
+        self._stop = Event()
+        self._thread = Thread(target=self._run, name="inotify-watcher", daemon=True)
+
+    # --- Public API ---
+
+    def start(self):
+        # Files already on disk at startup are the catch-up scan's job
+        self._add_tree(self.root, announce_files=False)
+        self._thread.start()
+        logger.info(f"inotify watcher started on directory: {self.root} ({len(self._watches)} directories)")
+
+    def stop(self):
+        self._stop.set()
+
+    def join(self, timeout: float = None):
+        self._thread.join(timeout)
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+    def attach(self, loop):
+        """Reads events from an asyncio loop rather than the watcher thread."""
+        self._add_tree(self.root, announce_files=False)
+        loop.add_reader(self._fd, self._read_events)
+        logger.info(f"inotify watcher attached to the event loop on: {self.root} ({len(self._watches)} directories)")
+
+    def detach(self, loop):
+        if self._fd >= 0:
+            loop.remove_reader(self._fd)
+            os.close(self._fd)
+            self._fd = -1
+
+    def notify(self, file_path: str):
+        """Hands a path found by other means (e.g. the failsafe sweep) to the settle-and-verify logic."""
+        now = time.monotonic()
+        with self._pending_lock:
+            self._abandoned.pop(file_path, None)
+            first_seen = self._pending.get(file_path, (now, now))[1]
+            self._pending[file_path] = (now, first_seen)
+
+    def retry_abandoned(self):
+        """
+        Hands files set aside after MAX_PENDING_SECONDS back to the verify logic once they
+        change on disk (a writer resumed or the file was replaced). Unchanged ones are not
+        re-read, and a restart retries them all through the catch-up scan.
+        """
+        with self._pending_lock:
+            abandoned = list(self._abandoned.items())
+        for file_path, identity in abandoned:
+            current = _file_identity(file_path)
+            if current == identity:
+                continue
+            with self._pending_lock:
+                self._abandoned.pop(file_path, None)
+            if current is not None:
+                logger.info(f"Retrying {os.path.basename(file_path)}: it changed since it was set aside.")
+                self.notify(file_path)
+
+    # --- Watches ---
+
+    def _add_watch(self, path: str):
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), _WATCH_MASK | IN_ONLYDIR)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err == errno.ENOSPC:
+                logger.error("inotify watch limit reached; raise fs.inotify.max_user_watches. Relying on the failsafe sweep.")
+            elif err != errno.ENOENT:
+                logger.warning(f"Could not watch {path}: {os.strerror(err)}")
+            return
+        self._watches[wd] = path
+
+    def _add_tree(self, top: str, announce_files: bool = True):
+        """
+        Watches a directory tree. Files already inside a newly created directory are handed
+        to the verify logic, since they may have been written before the watch existed.
+        """
+        for root, _, files in os.walk(top):
+            self._add_watch(root)
+            if announce_files:
+                for name in files:
+                    if name.endswith(self.pattern):
+                        self.notify(os.path.join(root, name))
+
+    # --- Event loop ---
+
+    def _run(self):
+        poller = select.poll()
+        poller.register(self._fd, select.POLLIN)
+        while not self._stop.is_set():
+            if poller.poll(int(self.settle_seconds * 500)):
+                self._read_events()
+            self.flush_settled()
+
+    def _read_events(self):
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset + _EVENT_HEADER.size <= len(data):
+            wd, mask, _cookie, name_len = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = data[offset:offset + name_len].rstrip(b"\0").decode(errors="surrogateescape")
+            offset += name_len
+            self._handle_event(wd, mask, name)
+
+    def _handle_event(self, wd: int, mask: int, name: str):
+        if mask & IN_Q_OVERFLOW:
+            logger.warning("inotify event queue overflowed; the failsafe sweep will catch any missed files.")
+            return
+        if mask & IN_IGNORED or mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+            self._watches.pop(wd, None)
+            return
+
+        directory = self._watches.get(wd)
+        if directory is None or not name:
+            return
+        path = os.path.join(directory, name)
+
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                self._add_tree(path)
+        elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO) and name.endswith(self.pattern):
+            self.notify(path)
+
+    def flush_settled(self):
+        """Queues every pending file that has been quiet for settle_seconds and is a complete gzip."""
+        now = time.monotonic()
+        with self._pending_lock:
+            settled = [p for p, (last, _) in self._pending.items() if now - last >= self.settle_seconds]
+        for file_path in settled:
+            if file_path in self.processed_files:
+                self._drop(file_path)
+            elif gzip_is_complete(file_path):
+                logger.info(f"New file detected: {os.path.basename(file_path)}")
+                if self.file_queue.put(file_path):
+                    self.processed_files.add(file_path)
+                self._drop(file_path)
+            elif not os.path.exists(file_path):
+                self._drop(file_path)
+            else:
+                with self._pending_lock:
+                    _, first_seen = self._pending[file_path]
+                    if now - first_seen > self.MAX_PENDING_SECONDS:
+                        logger.error(f"Setting aside {os.path.basename(file_path)}: still not a complete gzip stream. "
+                                     f"It is retried if it changes, or on restart.")
+                        del self._pending[file_path]
+                        self._abandoned[file_path] = _file_identity(file_path)
+                    else:
+                        # Retry after another settle period
+                        self._pending[file_path] = (now, first_seen)
+
+    def _drop(self, file_path: str):
+        with self._pending_lock:
+            self._pending.pop(file_path, None)
@@ -0,0 +1,288 @@
+# kraken_daemon.py
+import os
+import re
+import time
+import select
+import signal
+import logging
+import subprocess
+import configparser
+from threading import Lock, Thread
+from contextlib import contextmanager
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+# Fixed paths used by classify.cc's daemon mode (-D)
+CONTROL_STDIN = "/tmp/classify_stdin"
+CONTROL_STDOUT = "/tmp/classify_stdout"
+PID_FILE = "/tmp/classify.pid"
+JOB_FIFO = "/tmp/classify_{pid}_{stream}"
+
+# In daemon mode a job's stderr shares its stdout FIFO with the minimizer lines, so
+# ReportStats' summary ends up in the stream (possibly mid-line, as stdout is block buffered)
+_STATS_RE = re.compile(
+    rb"\r?\d+ sequences \([^)]*\) processed in [^\n]*\n"
+    rb"|  \d+ sequences classified \([^)]*\)\n"
+    rb"|  \d+ sequences unclassified \([^)]*\)\n"
+)
+# The stats are written before the final stdout flush, so they are always near the end
+_TAIL_BYTES = 256 * 1024
+
+_DAEMONS = {}
+_DAEMONS_LOCK = Lock()
+
+def get_kraken_daemon(config: configparser.ConfigParser):
+    """Returns the process-wide classifier daemon, or None when [Kraken2Daemon] is disabled."""
+    if not config.getboolean('Kraken2Daemon', 'enabled', fallback=False):
+        return None
+    pipeline_dir = os.path.dirname(os.path.abspath(config.get('Paths', 'nextflow_script')))
+    classify_bin = config.get('Kraken2Daemon', 'classify_executable',
+                              fallback=os.path.join(pipeline_dir, "bin", "classify"))
+    with _DAEMONS_LOCK:
+        if classify_bin not in _DAEMONS:
+            _DAEMONS[classify_bin] = Kraken2Daemon(
+                classify_bin,
+                startup_timeout=config.getfloat('Kraken2Daemon', 'startup_timeout_seconds', fallback=900),
+            )
+        return _DAEMONS[classify_bin]
+
+def kraken_db_files(config: configparser.ConfigParser):
+    """(hash, taxonomy, options) .k2d paths, from /dev/shm when the database is memory mapped like RUN_KRAKEN2."""
+    memory_mapping = config.getboolean('KrakenParams', 'memory_mapping', fallback=False)
+    db = "/dev/shm" if memory_mapping else config.get('DatabasePaths', 'kraken_db')
+    return tuple(os.path.join(db, name) for name in ("hash.k2d", "taxo.k2d", "opts.k2d"))
+
+def classify_args(config: configparser.ConfigParser, threads: int, output: str = None, report: str = None) -> list:
+    """classify options equivalent to the kraken2 wrapper flags RUN_KRAKEN2 uses."""
+    hash_file, taxonomy, options = kraken_db_files(config)
+    args = ["-H", hash_file, "-t", taxonomy, "-o", options, "-p", str(threads), "-n",
+            "-T", config.get('KrakenParams', 'confidence', fallback='0.1'),
+            "-Q", config.get('KrakenParams', 'min_base_q', fallback='0'),
+            "-g", config.get('KrakenParams', 'min_hit_groups', fallback='2'), "-K"]
+    if config.getboolean('KrakenParams', 'memory_mapping', fallback=False):
+        args.append("-M")
+    if output:
+        args += ["-O", output]
+    if report:
+        args += ["-R", report]
+    return args
+
+class DaemonError(RuntimeError):
+    """The classifier daemon died or stopped answering."""
+
+class Kraken2Daemon:
+    """
+    Keeps one kraken2 `classify -D` process resident so the hash table is loaded (or
+    mapped) once instead of at the start of every batch.
+
+    The daemon's protocol: after loading the database it forks a worker per job, prints
+    "PID: <n>" on its control FIFO, the worker reads reads from /tmp/classify_<n>_stdin
+    and writes kraken output / minimizer lines to /tmp/classify_<n>_stdout, and "DONE"
+    follows when it exits. The next command line written to the control FIFO starts the
+    next job. Databases the daemon has seen stay loaded, so one daemon serves them all;
+    its control FIFOs have fixed names, so there is one per host and jobs are serialized.
+
+    A dead or unresponsive daemon is restarted and the job retried once.
+    """
+    JOB_TIMEOUT = 6 * 3600
+
+    def __init__(self, classify_bin: str, startup_timeout: float = 900):
+        self.classify_bin = classify_bin
+        self.startup_timeout = startup_timeout
+        self.pid = None
+        self._control_in = None
+        self._control_out = None
+        self._buffer = b""
+        self._lock = Lock()
+
+    # --- Lifecycle ---
+
+    def _alive(self) -> bool:
+        if not self.pid:
+            return False
+        try:
+            os.kill(self.pid, 0)
+            return True
+        except OSError:
+            return False
+
+    def start(self, config: configparser.ConfigParser):
+        """Launches the daemon and waits until it has loaded the database and finished a warm-up job."""
+        self.stop()
+        # A daemon left behind by an earlier backend would own the control FIFOs
+        try:
+            with open(PID_FILE) as f:
+                os.kill(int(f.read().strip()), signal.SIGTERM)
+        except (OSError, ValueError):
+            pass
+        for path in (CONTROL_STDIN, CONTROL_STDOUT, PID_FILE):
+            if os.path.exists(path):
+                os.remove(path)
+        logger.info("Starting resident Kraken2 classifier...")
+        start = time.monotonic()
+        # classify double-forks into the background and the launcher exits straight away
+        subprocess.run([self.classify_bin, "-D"] + classify_args(config, threads=1), check=True)
+
+        deadline = time.monotonic() + 30
+        while not (os.path.exists(CONTROL_STDOUT) and os.path.exists(PID_FILE)):
+            if time.monotonic() > deadline:
+                raise DaemonError("classifier daemon did not create its control FIFOs")
+            time.sleep(0.05)
+        with open(PID_FILE) as f:
+            self.pid = int(f.read().strip() or 0)
+        self._control_out = os.open(CONTROL_STDOUT, os.O_RDONLY | os.O_NONBLOCK)
+        self._control_in = os.open(CONTROL_STDIN, os.O_WRONLY)
+        self._buffer = b""
+
+        # The daemon starts its first job with the launch options; feed it no reads
+        job_pid = self._read_pid(self.startup_timeout)
+        output = _JobOutput(JOB_FIFO.format(pid=job_pid, stream="stdout"), os.devnull)
+        output.start()
+        stdin_fifo = JOB_FIFO.format(pid=job_pid, stream="stdin")
+        _wait_for(stdin_fifo)
+        hold = _InputHold(stdin_fifo)
+        hold.start()
+        hold.release(self.startup_timeout)
+        self._read_control(b"DONE", self.startup_timeout)
+        output.join()
+        REGISTRY.observe("nanort_kraken_daemon_start_seconds", time.monotonic() - start,
+                         help_text="Time to start the resident classifier and load its database")
+        logger.info(f"Kraken2 classifier resident (pid {self.pid}) after {time.monotonic() - start:.1f}s.")
+
+    def stop(self):
+        if self._alive():
+            try:
+                os.kill(self.pid, signal.SIGTERM)
+            except OSError:
+                pass
+        for fd in (self._control_in, self._control_out):
+            if fd is not None:
+                os.close(fd)
+        self._control_in = self._control_out = None
+        self.pid = None
+
+    # --- Control channel ---
+
+    def _read_control(self, marker: bytes, timeout: float) -> bytes:
+        """Reads control output until a line starting with marker arrives. Returns that line."""
+        deadline = time.monotonic() + timeout
+        while True:
+            while b"\n" in self._buffer:
+                line, self._buffer = self._buffer.split(b"\n", 1)
+                if line.startswith(marker):
+                    return line
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not self._alive():
+                raise DaemonError(f"classifier daemon stopped responding while waiting for {marker.decode()}")
+            ready, _, _ = select.select([self._control_out], [], [], min(remaining, 1.0))
+            if ready:
+                self._buffer += os.read(self._control_out, 65536)
+
+    def _read_pid(self, timeout: float) -> int:
+        return int(self._read_control(b"PID:", timeout).split(b":")[1])
+
+    # --- Jobs ---
+
+    @contextmanager
+    def job(self, config: configparser.ConfigParser, threads: int, kraken_output: str, report: str, minimizers: str):
+        """
+        Runs one classification job. Yields the FIFO path the caller must write uncompressed
+        FASTQ into (and close); on exit waits for the job and checks its outputs. Produces the
+        same .kraken2.tsv, .report.tsv and .minimizers.tsv files as RUN_KRAKEN2.
+        """
+        args = ["classify"] + classify_args(config, threads, output=kraken_output, report=report)
+        if any(" " in arg for arg in args):
+            raise ValueError("the classifier daemon cannot take paths containing spaces")
+
+        with self._lock:
+            if not self._alive():
+                self.start(config)
+            if os.path.exists(report):
+                os.remove(report)
+            start = time.monotonic()
+            try:
+                os.write(self._control_in, (" ".join(args) + "\n").encode())
+                job_pid = self._read_pid(self.startup_timeout)
+                output = _JobOutput(JOB_FIFO.format(pid=job_pid, stream="stdout"), minimizers)
+                output.start()
+                stdin_fifo = JOB_FIFO.format(pid=job_pid, stream="stdin")
+                _wait_for(stdin_fifo)
+                hold = _InputHold(stdin_fifo)
+                hold.start()
+                try:
+                    yield stdin_fifo
+                finally:
+                    hold.release()
+                    self._read_control(b"DONE", self.JOB_TIMEOUT)
+                    output.join()
+                if not os.path.exists(report) or not output.saw_stats:
+                    raise DaemonError(f"classification job {job_pid} did not complete; see {minimizers}")
+            except (DaemonError, BrokenPipeError) as e:
+                # Restarted on the next job
+                self.stop()
+                raise DaemonError(str(e)) from e
+            REGISTRY.observe("nanort_kraken_daemon_job_seconds", time.monotonic() - start,
+                             help_text="Wall time of classification jobs run by the resident classifier")
+
+def stop_all():
+    """Stops every resident classifier started by this process."""
+    with _DAEMONS_LOCK:
+        for daemon in _DAEMONS.values():
+            with daemon._lock:
+                daemon.stop()
+
+def _wait_for(path: str, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while not os.path.exists(path):
+        if time.monotonic() > deadline:
+            raise DaemonError(f"{path} was never created")
+        time.sleep(0.01)
+
+class _InputHold(Thread):
+    """
+    Holds a write end of a job's input FIFO from the moment the worker opens it, so the
+    worker sees end-of-file exactly when release() is called, whether or not the caller
+    ever opened the FIFO itself.
+    """
+    def __init__(self, fifo_path: str):
+        super().__init__(name="kraken-daemon-input", daemon=True)
+        self.fifo_path = fifo_path
+        self.fd = None
+
+    def run(self):
+        try:
+            self.fd = os.open(self.fifo_path, os.O_WRONLY)
+        except OSError:
+            pass
+
+    def release(self, timeout: float = 5):
+        self.join(timeout)
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+class _JobOutput(Thread):
+    """Copies a job's stdout FIFO to a file, removing the daemon's stats lines from the tail."""
+    def __init__(self, fifo_path: str, destination: str):
+        super().__init__(name="kraken-daemon-output", daemon=True)
+        self.fifo_path = fifo_path
+        self.destination = destination
+        self.saw_stats = False
+
+    def run(self):
+        _wait_for(self.fifo_path)
+        tail = b""
+        with open(self.fifo_path, 'rb') as src, open(self.destination, 'wb') as dst:
+            while True:
+                chunk = src.read(1024 * 1024)
+                if not chunk:
+                    break
+                tail += chunk
+                if len(tail) > 2 * _TAIL_BYTES:
+                    dst.write(tail[:-_TAIL_BYTES])
+                    tail = tail[-_TAIL_BYTES:]
+            cleaned, count = _STATS_RE.subn(b"", tail)
+            self.saw_stats = count > 0
+            dst.write(cleaned)
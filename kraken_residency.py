@@ -0,0 +1,189 @@
+# kraken_residency.py
+import os
+import json
+import mmap
+import time
+import shutil
+import hashlib
+import logging
+import configparser
+from threading import Lock, Thread, Event
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+SHM_DIR = "/dev/shm"
+# Written into shm once every file there has been verified against the manifest
+READY_FLAG = ".nanort_kraken_ready.json"
+
+_MANAGERS = {}
+_MANAGERS_LOCK = Lock()
+
+def get_kraken_residency(config: configparser.ConfigParser):
+    """Returns the process-wide residency manager for the Kraken2 database, or None if Kraken2 is not used."""
+    kraken_db = config.get('DatabasePaths', 'kraken_db', fallback='')
+    if not kraken_db or not (config.getboolean('WorkflowSteps', 'run_classification', fallback=False)
+                             and config.getboolean('WorkflowSteps', 'run_kraken', fallback=False)):
+        return None
+    if not config.getboolean('KrakenResidency', 'enabled', fallback=True):
+        return None
+    kraken_db = os.path.abspath(kraken_db)
+    with _MANAGERS_LOCK:
+        if kraken_db not in _MANAGERS:
+            _MANAGERS[kraken_db] = KrakenResidency(
+                kraken_db,
+                memory_mapping=config.getboolean('KrakenParams', 'memory_mapping', fallback=False),
+                manifest_dir=config.get('Paths', 'output_directory'),
+                verify=config.getboolean('KrakenResidency', 'verify_on_start', fallback=True),
+            )
+        return _MANAGERS[kraken_db]
+
+def _database_files(directory: str) -> list:
+    """The files PREPARE_KRAKEN_DB copies: the .k2d tables and Bracken's *_distrib files."""
+    return sorted(f for f in os.listdir(directory)
+                  if f.endswith(".k2d") or f.endswith("_distrib")) if os.path.isdir(directory) else []
+
+def _sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(16 * 1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _prefetch(path: str):
+    """Asks the kernel to bring a file's pages in ahead of the first batch (MADV_WILLNEED)."""
+    if not os.path.getsize(path):
+        return
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        if hasattr(mapped, 'madvise'):
+            mapped.madvise(mmap.MADV_WILLNEED)
+
+class KrakenResidency:
+    """
+    Loads the Kraken2 database once per service start instead of letting every batch's
+    PREPARE_KRAKEN_DB stat (and possibly rsync) it.
+
+    A manifest of the source database's files (size, mtime, SHA-256) is kept in the
+    output directory; checksums are only recomputed for files whose size or mtime
+    changed. With memory mapping, each /dev/shm copy is checked against the manifest
+    (sizes, and checksums when verify is on), damaged or missing files are re-copied
+    atomically, and a ready flag is written to /dev/shm. Without it the source files
+    themselves are prefetched into the page cache. Either way the pages are hinted
+    with MADV_WILLNEED, and `ready` tells the pipeline to skip its own checks.
+    """
+    def __init__(self, kraken_db: str, memory_mapping: bool, manifest_dir: str, verify: bool = True,
+                 shm_dir: str = SHM_DIR):
+        self.kraken_db = kraken_db
+        self.memory_mapping = memory_mapping
+        self.manifest_path = os.path.join(manifest_dir, "kraken_db_manifest.json")
+        self.verify = verify
+        self.shm_dir = shm_dir
+        self._ready = Event()
+
+    @property
+    def ready(self) -> bool:
+        """True once the database is verified and loaded. A vanished /dev/shm copy clears it."""
+        if self._ready.is_set() and self.memory_mapping and not os.path.exists(os.path.join(self.shm_dir, READY_FLAG)):
+            logger.warning("Kraken2 database flag disappeared from /dev/shm; batches will check the database again.")
+            self._ready.clear()
+        return self._ready.is_set()
+
+    # --- Manifest ---
+
+    def manifest(self) -> dict:
+        """{file name: {size, mtime_ns, sha256}} for the source database, reusing stored checksums where possible."""
+        try:
+            with open(self.manifest_path) as f:
+                stored = json.load(f)
+            if stored.get('kraken_db') != self.kraken_db:
+                stored = {}
+        except (IOError, ValueError):
+            stored = {}
+        known = stored.get('files', {})
+
+        files = {}
+        for name in _database_files(self.kraken_db):
+            st = os.stat(os.path.join(self.kraken_db, name))
+            entry = known.get(name, {})
+            if entry.get('size') != st.st_size or entry.get('mtime_ns') != st.st_mtime_ns:
+                logger.info(f"Checksumming Kraken2 database file {name} ({st.st_size / 1024**3:.1f} GB)...")
+                entry = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns,
+                         'sha256': _sha256(os.path.join(self.kraken_db, name))}
+            files[name] = entry
+
+        if files != known:
+            tmp_path = self.manifest_path + ".tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump({'kraken_db': self.kraken_db, 'files': files}, f, indent=2)
+            os.replace(tmp_path, self.manifest_path)
+        return files
+
+    # --- Loading ---
+
+    def _shm_copy_ok(self, name: str, entry: dict) -> bool:
+        shm_file = os.path.join(self.shm_dir, name)
+        if not os.path.exists(shm_file) or os.path.getsize(shm_file) != entry['size']:
+            return False
+        if self.verify and _sha256(shm_file) != entry['sha256']:
+            logger.error(f"{shm_file} does not match the database checksum; reloading it.")
+            REGISTRY.inc("nanort_kraken_shm_corrupt_total", help_text="Corrupted /dev/shm database files detected")
+            return False
+        return True
+
+    def _copy_to_shm(self, name: str):
+        source = os.path.join(self.kraken_db, name)
+        target = os.path.join(self.shm_dir, name)
+        # The old copy stays in place until the new one is complete
+        stats = os.statvfs(self.shm_dir)
+        if os.path.getsize(source) > stats.f_bavail * stats.f_frsize:
+            raise OSError(f"not enough space in {self.shm_dir} for {name}")
+        logger.info(f"Loading {name} into {self.shm_dir}...")
+        tmp_path = f"{target}.nanort_tmp"
+        shutil.copyfile(source, tmp_path)
+        # Readers (and running kraken2 processes) never see a half-written file
+        os.replace(tmp_path, target)
+
+    def load(self):
+        """Verifies and, if needed, (re)loads the database, prefetches it and raises the ready flag."""
+        start = time.monotonic()
+        manifest = self.manifest()
+        if not manifest:
+            raise OSError(f"no Kraken2 database files in {self.kraken_db}")
+
+        if self.memory_mapping:
+            flag_path = os.path.join(self.shm_dir, READY_FLAG)
+            os.makedirs(self.shm_dir, exist_ok=True)
+            for name, entry in manifest.items():
+                if not self._shm_copy_ok(name, entry):
+                    if os.path.exists(flag_path):
+                        os.remove(flag_path)
+                    self._copy_to_shm(name)
+            resident = [os.path.join(self.shm_dir, name) for name in manifest]
+        else:
+            resident = [os.path.join(self.kraken_db, name) for name in manifest]
+
+        for path in resident:
+            _prefetch(path)
+
+        if self.memory_mapping:
+            tmp_path = flag_path + ".tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump({name: entry['sha256'] for name, entry in manifest.items()}, f)
+            os.replace(tmp_path, flag_path)
+        self._ready.set()
+        REGISTRY.set("nanort_kraken_db_ready", 1, help_text="1 once the Kraken2 database is verified and resident")
+        REGISTRY.observe("nanort_kraken_db_load_seconds", time.monotonic() - start,
+                         help_text="Time to verify and load the Kraken2 database at service start")
+        logger.info(f"Kraken2 database resident ({sum(e['size'] for e in manifest.values()) / 1024**3:.1f} GB, "
+                    f"{'/dev/shm' if self.memory_mapping else 'page cache'}) after {time.monotonic() - start:.0f}s.")
+
+    def start(self):
+        """Loads the database in the background; batches fall back to PREPARE_KRAKEN_DB's checks until it is ready."""
+        REGISTRY.set("nanort_kraken_db_ready", 0, help_text="1 once the Kraken2 database is verified and resident")
+        def work():
+            try:
+                self.load()
+            except (OSError, ValueError) as e:
+                logger.error(f"Could not load the Kraken2 database: {e}")
+        Thread(target=work, name="kraken-residency", daemon=True).start()
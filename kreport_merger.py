@@ -0,0 +1,209 @@
+# kreport_merger.py
+import os
+import json
+import hashlib
+import logging
+from array import array
+from threading import Lock
+
+from combine_kreports import process_kraken_report
+
+logger = logging.getLogger(__name__)
+
+# Same level handling as combine_kreports.py
+MAIN_LEVELS = ['U', 'R', 'D', 'K', 'P', 'C', 'O', 'F', 'G', 'S']
+MAP_LEVELS = {'kingdom': 'K', 'superkingdom': 'D', 'phylum': 'P', 'class': 'C', 'order': 'O',
+              'family': 'F', 'genus': 'G', 'species': 'S'}
+
+_TREES = {}
+_TREES_LOCK = Lock()
+
+class KreportTree:
+    """
+    Cumulative Kraken2 report for one barcode, held as parallel arrays indexed by node
+    (with a taxid -> node map) instead of being re-parsed from the master report for
+    every batch. add_report() costs one pass over the batch report; write() renders the
+    same output as `combine_kreports.py --no-headers --only-combined`.
+    """
+    def __init__(self):
+        self._node = {}  # taxid -> node index
+        self.taxid = array('q')
+        self.parent = array('q')
+        self.depth = array('q')
+        self.all_reads = array('q')
+        self.lvl_reads = array('q')
+        self.all_min = array('q')
+        self.lvl_min = array('q')
+        self.level_id = []
+        self.name = []
+        self.children = []
+        self.unclassified_reads = 0
+        self.unclassified_min = 0
+        self.total_reads = 0
+        self._add_node('root', 1, 0, 'R', -1)
+
+    def _add_node(self, name: str, taxid: int, depth: int, level_id: str, parent: int) -> int:
+        index = len(self.taxid)
+        self._node[taxid] = index
+        for column, value in ((self.taxid, taxid), (self.parent, parent), (self.depth, depth),
+                              (self.all_reads, 0), (self.lvl_reads, 0), (self.all_min, 0), (self.lvl_min, 0)):
+            column.append(value)
+        self.level_id.append(level_id)
+        self.name.append(name)
+        self.children.append([])
+        if parent >= 0:
+            self.children[parent].append(index)
+        return index
+
+    def add_report(self, report_path: str):
+        """Adds a Kraken2 report's counts (a batch report, or a master report written by either merger)."""
+        prev = 0
+        with open(report_path, 'r') as f:
+            for line in f:
+                values = process_kraken_report(line)
+                if len(values) < 7:
+                    continue
+                name, taxid, depth, level_id, all_reads, lvl_reads, all_min, lvl_min = values
+                level_id = MAP_LEVELS.get(level_id, level_id)
+                self.total_reads += lvl_reads
+                if level_id == 'U' or taxid == 0:
+                    self.unclassified_reads += lvl_reads
+                    self.unclassified_min += lvl_min
+                    continue
+                if taxid == 1:
+                    node = prev = 0
+                else:
+                    while depth != self.depth[prev] + 1:
+                        prev = self.parent[prev]
+                    node = self._node.get(taxid)
+                    if node is None:
+                        if level_id == '-' or len(level_id) > 1:
+                            parent_level = self.level_id[prev]
+                            if parent_level in MAIN_LEVELS:
+                                level_id = parent_level + '1'
+                            else:
+                                level_id = parent_level[:-1] + str(int(parent_level[-1]) + 1)
+                        node = self._add_node(name, taxid, depth, level_id, prev)
+                    prev = node
+                self.all_reads[node] += all_reads
+                self.lvl_reads[node] += lvl_reads
+                self.all_min[node] += all_min
+                self.lvl_min[node] += lvl_min
+
+    def lines(self):
+        """Yields the report's lines, ordered like combine_kreports.py (largest clade first, depth first)."""
+        total = self.total_reads
+        percent = lambda reads: f"{reads / total * 100:0.4f}" if total > 0 else "0.0000"
+        yield (f"{percent(self.unclassified_reads)}\t{self.unclassified_reads}\t{self.unclassified_reads}\t"
+               f"{self.unclassified_min}\t{self.unclassified_min}\tU\t0\tunclassified\n")
+        stack = [0]
+        while stack:
+            node = stack.pop()
+            ordered = sorted(self.children[node], key=self.all_reads.__getitem__)
+            stack.extend(ordered)
+            # combine_kreports.py re-reads the master report, so ties keep the order they were last printed in
+            self.children[node] = ordered[::-1]
+            yield (f"{percent(self.all_reads[node])}\t{self.all_reads[node]}\t{self.lvl_reads[node]}\t"
+                   f"{self.all_min[node]}\t{self.lvl_min[node]}\t{self.level_id[node]}\t{self.taxid[node]}\t"
+                   f"{' ' * self.depth[node] * 2}{self.name[node]}\n")
+
+    def write(self, path: str):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            f.writelines(self.lines())
+        os.replace(tmp_path, path)
+
+def _stat(path: str):
+    try:
+        st = os.stat(path)
+        return st.st_size, st.st_mtime_ns
+    except OSError:
+        return None
+
+# --- Merged batches ---
+
+def _batches_path(master_report: str) -> str:
+    return master_report + ".batches.json"
+
+def _digest(path: str) -> str:
+    sha = hashlib.sha1()
+    try:
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                sha.update(block)
+    except OSError:
+        return None
+    return sha.hexdigest()
+
+def _write_batches(master_report: str, state: dict):
+    tmp_path = _batches_path(master_report) + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, _batches_path(master_report))
+
+def _load_batches(master_report: str) -> dict:
+    """
+    {'batches': [...], 'pending': None} for a master report. A merge interrupted between
+    writing the report and recording its batch is resolved here: the pending batch
+    counts as merged exactly when the report on disk is the one that merge wrote.
+    """
+    try:
+        with open(_batches_path(master_report)) as f:
+            state = json.load(f)
+    except (IOError, ValueError):
+        return {'batches': [], 'pending': None}
+    pending = state.get('pending')
+    if pending:
+        if _digest(master_report) == pending['digest']:
+            state['batches'].append(pending['batch'])
+        state['pending'] = None
+    return state
+
+def merged_batches(master_report: str) -> list:
+    """Batch ids already folded into a master report."""
+    return _load_batches(master_report)['batches']
+
+# --- Merging ---
+
+def merge_into_master(new_report: str, master_report: str, batch_id: str = None) -> bool:
+    """
+    Adds a batch report to a barcode's master report. The tree is kept in memory between
+    batches and reloaded from the master report only when it changed behind our back
+    (first use in this process, or another process wrote it).
+
+    With batch_id the merge is recorded next to the master report and a batch already
+    merged (by an aggregation that was interrupted and is being redone) is skipped.
+    Returns False if it was skipped.
+    """
+    state = _load_batches(master_report) if batch_id else None
+    if state and batch_id in state['batches']:
+        logger.info(f"{os.path.basename(new_report)} from {batch_id} is already in {os.path.basename(master_report)}; skipping.")
+        return False
+    key = os.path.abspath(master_report)
+    with _TREES_LOCK:
+        tree, written = _TREES.pop(key, (None, None))
+    if tree is None or written != _stat(master_report):
+        tree = KreportTree()
+        if _stat(master_report) and os.path.getsize(master_report) > 0:
+            tree.add_report(master_report)
+    # On failure the tree is dropped and rebuilt from the last master report written
+    tree.add_report(new_report)
+    content = "".join(tree.lines()).encode('utf-8')
+    if state is not None:
+        state['pending'] = {'batch': batch_id, 'digest': hashlib.sha1(content).hexdigest()}
+        _write_batches(master_report, state)
+    tmp_path = master_report + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, master_report)
+    if state is not None:
+        state['batches'].append(batch_id)
+        state['pending'] = None
+        _write_batches(master_report, state)
+    with _TREES_LOCK:
+        _TREES[key] = (tree, _stat(master_report))
+    return True
@@ -0,0 +1,130 @@
+# metrics.py
+import os
+import time
+import logging
+from threading import Lock, Thread
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+class MetricsRegistry:
+    """
+    A small in-process registry of gauges and counters, rendered in the Prometheus
+    text exposition format. The backend writes it to a textfile (for node_exporter's
+    textfile collector) and can optionally serve it over HTTP on /metrics.
+    """
+    def __init__(self):
+        self._values = {}   # (name, labels tuple) -> value
+        self._meta = {}     # name -> (type, help)
+        self._lock = Lock()
+
+    @staticmethod
+    def _key(name: str, labels: dict):
+        return name, tuple(sorted((labels or {}).items()))
+
+    def _declare(self, name: str, kind: str, help_text: str):
+        if name not in self._meta:
+            self._meta[name] = (kind, help_text or name)
+
+    def set(self, name: str, value: float, labels: dict = None, help_text: str = None):
+        """Sets a gauge."""
+        with self._lock:
+            self._declare(name, "gauge", help_text)
+            self._values[self._key(name, labels)] = float(value)
+
+    def inc(self, name: str, amount: float = 1.0, labels: dict = None, help_text: str = None):
+        """Increments a counter."""
+        with self._lock:
+            self._declare(name, "counter", help_text)
+            key = self._key(name, labels)
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def observe(self, name: str, seconds: float, labels: dict = None, help_text: str = None):
+        """Records a duration as a last-value gauge plus _sum/_count counters."""
+        self.set(f"{name}_last", seconds, labels, help_text)
+        self.inc(f"{name}_sum", seconds, labels, help_text)
+        self.inc(f"{name}_count", 1, labels, help_text)
+
+    def clear(self, name: str):
+        """Drops every label set of a metric (e.g. per-barcode queue depths that went to zero)."""
+        with self._lock:
+            for key in [k for k in self._values if k[0] == name]:
+                del self._values[key]
+
+    def render(self) -> str:
+        with self._lock:
+            values = dict(self._values)
+            meta = dict(self._meta)
+        # Derived at render time so the value is fresh on every scrape
+        last_result = values.get(("nanort_last_result_timestamp_seconds", ()))
+        if last_result:
+            meta["nanort_seconds_since_last_result"] = ("gauge", "Seconds since aggregated results were last updated")
+            values[("nanort_seconds_since_last_result", ())] = time.time() - last_result
+
+        lines = []
+        for name in sorted(meta):
+            kind, help_text = meta[name]
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for (metric, labels), value in sorted(values.items()):
+                if metric != name:
+                    continue
+                label_str = ",".join(f'{k}="{v}"' for k, v in labels)
+                lines.append(f"{name}{{{label_str}}} {value:.6g}" if label_str else f"{name} {value:.6g}")
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path: str):
+        """Atomically writes the current metrics so a collector never reads a partial file."""
+        temp_path = path + ".tmp"
+        try:
+            with open(temp_path, 'w') as f:
+                f.write(self.render())
+            os.replace(temp_path, path)
+        except (IOError, OSError) as e:
+            logger.error(f"Could not write metrics textfile {path}: {e}")
+
+    def serve(self, port: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+        """Serves /metrics from a background thread."""
+        registry = self
+
+        class _Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), _Handler)
+        Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+        logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+        return server
+
+# Process-wide registry shared by the backend, pipeline runner and aggregator
+REGISTRY = MetricsRegistry()
+
+def publish_queue_metrics(file_queue, engine=None):
+    """Refreshes the queue-related gauges from the barcode scheduler and, if given, the engine's backlog."""
+    REGISTRY.clear("nanort_queue_depth_files")
+    for barcode, depth in file_queue.depth_by_barcode().items():
+        REGISTRY.set("nanort_queue_depth_files", depth, {'barcode': barcode}, help_text="Files waiting to be batched, per barcode")
+    REGISTRY.set("nanort_queue_bytes", file_queue.total_bytes, help_text="Bytes waiting to be batched")
+    REGISTRY.set("nanort_queue_oldest_age_seconds", file_queue.oldest_age(), help_text="Age of the oldest file waiting to be batched")
+    if engine:
+        REGISTRY.set("nanort_stage_backlog_batches", engine.pending(), help_text="Batches waiting in front of the pipeline and aggregation stages")
+
+def record_batch(files: list) -> int:
+    """Records a freshly cut batch and returns its size in bytes."""
+    batch_bytes = sum(os.path.getsize(f) for f in files if os.path.exists(f))
+    REGISTRY.set("nanort_batch_files", len(files), help_text="Files in the most recent batch")
+    REGISTRY.set("nanort_batch_bytes", batch_bytes, help_text="Bytes in the most recent batch")
+    REGISTRY.inc("nanort_batches_total", help_text="Batches cut since startup")
+    REGISTRY.inc("nanort_files_batched_total", len(files), help_text="Files batched since startup")
+    return batch_bytes
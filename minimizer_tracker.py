@@ -18,6 +18,7 @@ class MinimizerTracker:
 
         self.total_minimizers = {}
         self.distinct_minimizers = {}
+        self.batches = []  # batch ids already counted
         self._load_state()
 
     def _load_taxonomy(self, taxonomy_path: str):
@@ -44,6 +45,7 @@ class MinimizerTracker:
                     state_data = json.load(f)
                     self.total_minimizers = {int(k): v for k, v in state_data.get('total_minimizers', {}).items()}
                     self.distinct_minimizers = {int(k): set(map(int, v)) for k, v in state_data.get('distinct_minimizers', {}).items()}
+                    self.batches = state_data.get('batches', [])
             except (json.JSONDecodeError, IOError) as e:
                 logger.warning(f"Could not load state file, starting fresh. Error: {e}")
         else:
@@ -56,15 +58,22 @@ class MinimizerTracker:
             serializable_distinct = {k: list(v) for k, v in self.distinct_minimizers.items()}
             state_data = {
                 'total_minimizers': self.total_minimizers,
-                'distinct_minimizers': serializable_distinct
+                'distinct_minimizers': serializable_distinct,
+                'batches': self.batches
             }
-            with open(self.state_path, 'w') as f:
+            with open(self.state_path + ".tmp", 'w') as f:
                 json.dump(state_data, f, indent=2)
+            os.replace(self.state_path + ".tmp", self.state_path)
         except IOError as e:
             logger.error(f"Could not save state file: {e}")
 
-    def update_with_batch(self, raw_minimizer_file: str):
-        """Processes a new batch of raw minimizers."""
+    def update_with_batch(self, raw_minimizer_file: str, batch_id: str = None):
+        """Processes a new batch of raw minimizers, unless batch_id was already counted."""
+        if batch_id and batch_id in self.batches:
+            logger.info(f"Minimizers from {batch_id} are already counted; skipping.")
+            return
+        if batch_id:
+            self.batches.append(batch_id)
         logger.info(f"Updating direct hit counts with new batch from {raw_minimizer_file}...")
         minimizers_added = 0
         try:
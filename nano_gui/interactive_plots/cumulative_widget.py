@@ -6,6 +6,7 @@ import pyqtgraph as pg
 from PyQt6.QtWidgets import (QTabWidget, QWidget, QVBoxLayout, QHBoxLayout, 
                              QLabel, QSlider, QScrollArea, QFrame)
 from PyQt6.QtCore import QThread, pyqtSignal, pyqtSlot, Qt
+from timeseries_store import read_frame, get_series
 
 # Professional muted palette (Tableau 10)
 TABLEAU_COLORS = [
@@ -23,12 +24,9 @@ class DataLoader(QThread):
 
     def run(self):
         try:
-            if not os.path.exists(self.file_path):
+            if not get_series(self.file_path).exists() and not os.path.exists(self.file_path):
                 return
-            if os.path.getsize(self.file_path) == 0:
-                self.data_loaded.emit(pd.DataFrame())
-                return
-            df = pd.read_csv(self.file_path)
+            df = read_frame(self.file_path)
             self.data_loaded.emit(df)
         except Exception as e:
             self.failed.emit(str(e))
@@ -234,7 +232,7 @@ class CumulativePlot(QTabWidget):
         layout.addWidget(self.no_data_label)
 
     def update_data(self, data_file):
-        if not os.path.exists(data_file): return
+        if not get_series(data_file).exists() and not os.path.exists(data_file): return
         if self.loader is not None and self.loader.isRunning(): return
 
         self.loader = DataLoader(data_file)
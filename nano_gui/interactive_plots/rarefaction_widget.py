@@ -3,6 +3,7 @@ import pandas as pd
 import pyqtgraph as pg
 from PyQt6.QtWidgets import (QWidget, QHBoxLayout, QVBoxLayout, QScrollArea, QLabel, QFrame)
 from PyQt6.QtCore import Qt
+from timeseries_store import read_frame
 
 TABLEAU_COLORS = [
     '#4E79A7', '#F28E2B', '#E15759', '#76B7B2', '#59A14F', 
@@ -49,9 +50,9 @@ class RarefactionPlot(QWidget):
         self.curves = {}
 
     def update_data(self, file_path):
-        """Loads CSV and updates curves."""
+        """Loads the rarefaction series and updates curves."""
         try:
-            df = pd.read_csv(file_path)
+            df = read_frame(file_path)
             if df.empty: return
             
             if 'timestamp' in df.columns:
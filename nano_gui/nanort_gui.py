@@ -1,6 +1,10 @@
 import sys
 import os
 import configparser
+
+# Backend modules the GUI reads results through (timeseries_store) live in the project root
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
 from PyQt6.QtWidgets import (QApplication, QMainWindow, QWidget, QHBoxLayout, 
                              QListWidget, QStackedWidget, QListWidgetItem,
                              QSplitter, QVBoxLayout, QLabel)
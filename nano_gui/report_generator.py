@@ -5,6 +5,7 @@ import plotly.graph_objects as go
 import plotly.express as px
 from plotly.subplots import make_subplots
 from PyQt6.QtCore import QThread, pyqtSignal
+from timeseries_store import read_frame
 
 class ReportGenerator(QThread):
     log_message = pyqtSignal(str)
@@ -46,10 +47,17 @@ class ReportGenerator(QThread):
                 return None
         return None
 
+    def _load_series(self, filename):
+        try:
+            df = read_frame(os.path.join(self.agg_dir, filename))
+            return df if not df.empty else None
+        except:
+            return None
+
     def generate_report(self):
         # 1. Load Data
-        df_acc = self._load_csv("cumulative_species_data.csv")
-        df_rare = self._load_csv("rarefaction_data.csv")
+        df_acc = self._load_series("cumulative_species_data.csv")
+        df_rare = self._load_series("rarefaction_data.csv")
         df_abund = self._load_csv("abundance_data.csv")
 
         # 2. Prepare Figures
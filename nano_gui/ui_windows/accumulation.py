@@ -4,6 +4,7 @@ import datetime
 from PyQt6.QtWidgets import QWidget, QVBoxLayout, QLabel
 from PyQt6.QtCore import Qt
 from interactive_plots.cumulative_widget import CumulativePlot
+from timeseries_store import get_series
 
 class AccumulationWindow(QWidget):
     """
@@ -40,12 +41,13 @@ class AccumulationWindow(QWidget):
             agg_dir = os.path.join(output_dir, "aggregated_results")
             self.data_file_path = os.path.join(agg_dir, "cumulative_species_data.csv")
 
-        if not os.path.exists(self.data_file_path):
-            self.status_label.setText(f"Status: Waiting for pipeline output... ({os.path.basename(self.data_file_path)} not found)")
+        series = get_series(self.data_file_path)
+        if not series.exists() and not os.path.exists(self.data_file_path):
+            self.status_label.setText("Status: Waiting for pipeline output... (no cumulative data yet)")
             return 
 
         try:
-            if os.path.getsize(self.data_file_path) == 0:
+            if series.exists() and not series.barcodes():
                 self.status_label.setText("Status: File found but empty. Waiting for data...")
                 return
 
@@ -2,6 +2,7 @@
 import os
 import sys
 import time
+import asyncio
 import argparse
 import configparser
 import logging
@@ -10,8 +11,21 @@ from threading import Thread
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 
-import pipeline_runner
 import result_aggregator
+from directory_index import DirectoryIndex
+from batch_engine import StagedEngine, run_pipeline_unit, run_aggregation_unit
+from batch_journal import BatchJournal, PIPELINE_DONE, AGGREGATED
+from adaptive_batcher import AdaptiveBatcher
+from processed_ledger import get_ledger
+from inotify_watcher import InotifyWatcher
+from barcode_scheduler import BarcodeScheduler
+from backpressure import BackpressurePolicy
+from host_index import get_host_index
+from kraken_residency import get_kraken_residency
+import child_processes
+import kraken_daemon
+from async_backend import AsyncBackend
+from metrics import REGISTRY, publish_queue_metrics, record_batch
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -31,8 +45,8 @@ class FastQHandler(FileSystemEventHandler):
             # Check if we've already processed this file to avoid duplicates on restart
             if file_path not in self.processed_files:
                 logger.info(f"New file detected: {os.path.basename(file_path)}")
-                self.file_queue.put(file_path)
-                self.processed_files.add(file_path) # Add to the set to prevent re-queueing
+                if self.file_queue.put(file_path):
+                    self.processed_files.add(file_path) # Add to the set to prevent re-queueing
 
     def on_moved(self, event):
         """Called when a file is renamed or moved into the monitored directory."""
@@ -40,11 +54,19 @@ class FastQHandler(FileSystemEventHandler):
             file_path = os.path.abspath(event.dest_path)
             if file_path not in self.processed_files:
                 logger.info(f"New file detected (moved/renamed): {os.path.basename(file_path)}")
-                self.file_queue.put(file_path)
-                self.processed_files.add(file_path)
+                if self.file_queue.put(file_path):
+                    self.processed_files.add(file_path)
+
+def start_monitoring(path_to_watch: str, file_queue: Queue, processed_files: set, mode: str = "watchdog"):
+    """
+    Creates and starts the file system watcher in a background thread.
+    mode 'inotify' uses the native Linux watcher, which waits for MinKNOW to close each file.
+    """
+    if mode == "inotify":
+        observer = InotifyWatcher(path_to_watch, file_queue, processed_files)
+        observer.start()
+        return observer
 
-def start_monitoring(path_to_watch: str, file_queue: Queue, processed_files: set) -> Observer:
-    """Creates and starts the file system watcher in a background thread."""
     event_handler = FastQHandler(file_queue, processed_files)
     observer = Observer()
     observer.schedule(event_handler, path_to_watch, recursive=True)
@@ -52,23 +74,25 @@ def start_monitoring(path_to_watch: str, file_queue: Queue, processed_files: set
     logger.info(f"File watcher started on directory: {path_to_watch}")
     return observer
 
-def read_processed_files_log(log_file_path: str) -> set:
-    """Reads the log of previously processed files to prevent re-running on startup."""
-    processed = set()
-    if os.path.exists(log_file_path):
-        try:
-            with open(log_file_path, 'r') as f:
-                for line in f:
-                    processed.add(line.strip())
-            logger.info(f"Loaded {len(processed)} previously processed file paths from log.")
-        except IOError as e:
-            logger.error(f"Could not read processed files log at '{log_file_path}': {e}")
-    return processed
+def queue_catch_up(files: list, watcher, file_queue: Queue, processed_files: set):
+    """
+    Queues the files the startup scan found. The inotify watcher first confirms each one
+    is a complete gzip, since MinKNOW may still have been writing it when we restarted.
+    """
+    for file_path in files:
+        if isinstance(watcher, InotifyWatcher):
+            watcher.notify(file_path)
+            continue
+        logger.info(f"Catch-up: Queuing unprocessed file: {os.path.basename(file_path)}")
+        if file_queue.put(file_path):
+            processed_files.add(file_path)
 
 def main():
     """Main function to run the backend service."""
     parser = argparse.ArgumentParser(description="NanoRT Backend: Monitors for new Nanopore data and triggers the Nextflow pipeline.")
     parser.add_argument("-c", "--config", default="config.ini", help="Path to the configuration file (default: config.ini).")
+    parser.add_argument("--event-loop", choices=["threads", "asyncio"], default=None,
+                        help="Run the service on worker threads or a single asyncio event loop (overrides [Settings] event_loop).")
     args = parser.parse_args()
 
     if not os.path.exists(args.config):
@@ -82,9 +106,12 @@ def main():
     output_dir = config.get('Paths', 'output_directory')
     log_filename = config.get('Settings', 'processed_files_log')
     processed_log_path = os.path.join(output_dir, log_filename)
+    ledger_filename = config.get('Settings', 'processed_files_ledger', fallback='processed_files.db')
+    processed_ledger_path = os.path.join(output_dir, ledger_filename)
     
-    # We will pass the full config object now, but also update the log path in the object itself
+    # We will pass the full config object now, but also update the log paths in the object itself
     config['Settings']['processed_files_log'] = processed_log_path
+    config['Settings']['processed_files_ledger'] = processed_ledger_path
 
     os.makedirs(output_dir, exist_ok=True)
 
@@ -99,55 +126,180 @@ def main():
             sys.exit(0)
     logger.info("Watch directory found!")
 
-    file_queue = Queue()
-    processed_files_set = read_processed_files_log(processed_log_path)
+    # Per-barcode, priority-aware queue; files of unconfigured barcodes are dropped on arrival
+    file_queue = BarcodeScheduler.from_config(config)
+    # The ledger replaces the old in-memory set: lookups hit SQLite, and a legacy
+    # processed_files.log from an earlier run is imported once.
+    processed_files_set = get_ledger(processed_ledger_path, legacy_log_path=processed_log_path)
+    logger.info(f"Opened processed files ledger: {processed_ledger_path}")
+
+    # --- START JOURNAL RECOVERY ---
+    # Batches interrupted by a crash or kill are resumed from their last completed stage:
+    # queued files go back into the queue, finished pipelines only need aggregating.
+    journal_path = os.path.join(output_dir, config.get('Settings', 'batch_journal', fallback='batch_journal.jsonl'))
+    journal = BatchJournal(journal_path)
+    resume_aggregation = []
+    for entry in journal.incomplete():
+        if entry['state'] in (PIPELINE_DONE, AGGREGATED) and entry['batch_dir'] and os.path.isdir(entry['batch_dir']):
+            found = result_aggregator._get_barcodes_in_batch(entry['batch_dir'])
+            remaining = [b for b in found if b not in entry['aggregated_barcodes']]
+            logger.info(f"Journal: resuming aggregation of {os.path.basename(entry['batch_dir'])} for {len(remaining)} barcode(s).")
+            resume_aggregation.append((entry['id'], entry['batch_dir'], remaining))
+        elif entry['state'] in (PIPELINE_DONE, AGGREGATED):
+            # The batch folder is gone, so aggregation and cleanup already happened
+            journal.cleaned(entry['id'])
+        else:
+            logger.info(f"Journal: re-queuing {len(entry['files'])} file(s) from an interrupted batch.")
+            # Re-queued even if the ledger already has them: their results never reached aggregation
+            for file_path in entry['files']:
+                if file_queue.put(file_path):
+                    processed_files_set.add(file_path)
+            journal.abandon(entry['id'])
+    # --- END JOURNAL RECOVERY ---
 
     # --- START CATCH-UP MECHANISM ---
     logger.info("Scanning for existing files to catch up...")
-    for root, _, files in os.walk(fastq_dir_to_watch):
-        for file in files:
-            if file.endswith(".fastq.gz"):
-                file_path = os.path.abspath(os.path.join(root, file))
-                if file_path not in processed_files_set:
-                    logger.info(f"Catch-up: Queuing unprocessed file: {file}")
-                    file_queue.put(file_path)
-                    processed_files_set.add(file_path)
+    index_path = os.path.join(output_dir, config.get('Settings', 'directory_index', fallback='directory_index.json'))
+    dir_index = DirectoryIndex(fastq_dir_to_watch, state_path=index_path)
+    # Queued once the watcher exists (see queue_catch_up)
+    catch_up_files = dir_index.scan(processed_files_set, full=True)
+    logger.info(f"Catch-up: {len(catch_up_files)} unprocessed file(s) found.")
     # --- END CATCH-UP MECHANISM ---
 
-    observer = start_monitoring(config.get('Paths', 'fastq_directory'), file_queue, processed_files_set)
+    # Metrics are written as a Prometheus textfile and, if a port is set, served over HTTP
+    metrics_path = os.path.join(output_dir, config.get('Metrics', 'textfile', fallback='metrics.prom'))
+    metrics_port = config.getint('Metrics', 'http_port', fallback=0)
+    if metrics_port:
+        REGISTRY.serve(metrics_port)
+
+    # Optionally size batches against a latency target instead of a fixed interval
+    batcher = None
+    if config.getboolean('Settings', 'adaptive_batching', fallback=False):
+        batcher = AdaptiveBatcher.from_config(config)
+        logger.info(f"Adaptive batching enabled (target latency {batcher.target_latency:.0f}s).")
+
+    # Validate (or build) the prebuilt minimap2 host index without holding up the first batches
+    if config.getboolean('WorkflowSteps', 'run_host_depletion', fallback=False):
+        host_index = get_host_index(config)
+        if host_index:
+            host_index.start()
+
+    # Verify and load the Kraken2 database once, instead of in every batch's PREPARE_KRAKEN_DB
+    kraken_residency = get_kraken_residency(config)
+    if kraken_residency:
+        kraken_residency.start()
+
+    # Caps batch sizes and, optionally, sheds load from barcodes whose backlog is too deep
+    backpressure = BackpressurePolicy.from_config(config)
+
+    watcher_mode = config.get('Settings', 'watcher', fallback='watchdog').strip().lower()
+    event_loop = (args.event_loop or config.get('Settings', 'event_loop', fallback='threads')).strip().lower()
+    if event_loop == "asyncio":
+        # The inotify watcher is attached to the event loop rather than started in a thread
+        if watcher_mode == "inotify":
+            watcher = InotifyWatcher(fastq_dir_to_watch, file_queue, processed_files_set)
+        else:
+            watcher = start_monitoring(fastq_dir_to_watch, file_queue, processed_files_set)
+        queue_catch_up(catch_up_files, watcher, file_queue, processed_files_set)
+        backend = AsyncBackend(config, file_queue, processed_files_set, journal, dir_index, watcher,
+                               batcher=batcher, metrics_path=metrics_path, backpressure=backpressure)
+        try:
+            asyncio.run(backend.run(resume_aggregation))
+        finally:
+            kraken_daemon.stop_all()
+        logger.info("Backend service has been shut down gracefully.")
+        return
+
+    observer = start_monitoring(config.get('Paths', 'fastq_directory'), file_queue, processed_files_set, mode=watcher_mode)
+    queue_catch_up(catch_up_files, observer, file_queue, processed_files_set)
+
+    # Optionally overlap pipeline execution and aggregation in separate stages
+    engine = None
+    if config.getboolean('Settings', 'staged_engine', fallback=False):
+        engine = StagedEngine(
+            config,
+            queue_size=config.getint('Settings', 'stage_queue_size', fallback=2),
+            pipeline_slots=config.getint('Settings', 'pipeline_slots', fallback=1),
+            batcher=batcher,
+            journal=journal,
+            scheduler=file_queue,
+            max_unit_files=backpressure.max_files_per_barcode
+        )
+        engine.start()
+
+    for batch_id, batch_dir, remaining in resume_aggregation:
+        if engine:
+            engine.resume_aggregation(batch_id, batch_dir, remaining)
+        else:
+            run_aggregation_unit(batch_id, batch_dir, config, journal=journal, barcodes=remaining)
 
     try:
         logger.info("Backend service is now running. Press Ctrl+C to stop.")
+        last_sweep = time.monotonic()
         while True:
             batch_interval = config.getint('Settings', 'batch_interval_seconds')
-            logger.info(f"Waiting for {batch_interval} seconds to gather next batch...")
-            time.sleep(batch_interval)
+            if batcher:
+                # Poll frequently; the batcher decides when a batch is worth cutting
+                time.sleep(config.getfloat('Batching', 'poll_seconds', fallback=1.0))
+            else:
+                logger.info(f"Waiting for {batch_interval} seconds to gather next batch...")
+                time.sleep(batch_interval)
             
             # --- START FAILSAFE SWEEP ---
-            # Ensure no files are missed if watchdog drops events (e.g. on network drives)
-            for root, _, files in os.walk(fastq_dir_to_watch):
-                for file in files:
-                    if file.endswith(".fastq.gz"):
-                        file_path = os.path.abspath(os.path.join(root, file))
-                        if file_path not in processed_files_set:
-                            logger.info(f"Failsafe scanner queued file: {file}")
-                            file_queue.put(file_path)
-                            processed_files_set.add(file_path)
+            # Ensure no files are missed if watchdog drops events (e.g. on network drives).
+            # Only directories whose mtime changed since the last sweep are re-listed.
+            if time.monotonic() - last_sweep >= batch_interval:
+                last_sweep = time.monotonic()
+                if isinstance(observer, InotifyWatcher):
+                    observer.retry_abandoned()
+                for file_path in dir_index.scan(processed_files_set):
+                    if isinstance(observer, InotifyWatcher):
+                        # Let the watcher confirm the file is fully written before it is queued
+                        observer.notify(file_path)
+                        continue
+                    logger.info(f"Failsafe scanner queued file: {os.path.basename(file_path)}")
+                    if file_queue.put(file_path):
+                        processed_files_set.add(file_path)
             # --- END FAILSAFE SWEEP ---
 
-            current_batch = []
-            while not file_queue.empty():
-                current_batch.append(file_queue.get())
+            publish_queue_metrics(file_queue, engine)
+            REGISTRY.write_textfile(metrics_path)
+
+            backpressure.apply(file_queue, batcher)
+            if engine and engine.saturated():
+                # Leave the backlog in the scheduler rather than piling it up behind the pipeline
+                continue
+
+            if batcher:
+                current_batch = batcher.next_batch(file_queue, busy=bool(engine and engine.busy()),
+                                                   max_files_per_barcode=backpressure.max_files_per_barcode)
+                if not current_batch:
+                    continue
+            else:
+                # Capped, so a backlog is worked off over several batches instead of one huge run
+                current_batch = file_queue.get_batch(**backpressure.batch_limits())
 
             if current_batch:
                 logger.info(f"Collected a batch of {len(current_batch)} new files. Starting analysis.")
+                batch_bytes = record_batch(current_batch)
+
+                if engine:
+                    # Blocks while the pipeline stage is saturated, applying backpressure to ingestion
+                    engine.submit(current_batch)
+                    continue
                 
                 # Pass the entire config object to the runner
-                batch_result_directory = pipeline_runner.run_pipeline_for_batch(current_batch, config)
+                batch_start = time.monotonic()
+                batch_id, batch_result_directory = run_pipeline_unit(current_batch, config, journal=journal)
 
                 if batch_result_directory:
+                    if batcher:
+                        batcher.record_pipeline(batch_bytes, time.monotonic() - batch_start)
                     # Pass the entire config object to the aggregator
-                    result_aggregator.aggregate_and_plot(batch_result_directory, config)
+                    aggregation_start = time.monotonic()
+                    run_aggregation_unit(batch_id, batch_result_directory, config, journal=journal)
+                    if batcher:
+                        batcher.record_aggregation(time.monotonic() - aggregation_start)
                 else:
                     logger.error("Skipping result aggregation due to a pipeline failure.")
             else:
@@ -156,9 +308,17 @@ def main():
     except KeyboardInterrupt:
         logger.info("Shutdown signal received.")
     finally:
+        # Child processes run in their own sessions, so Ctrl+C no longer reaches them directly.
+        # Stopping them first frees busy stages and leaves nothing orphaned if a second Ctrl+C
+        # cuts the rest of this block short
+        child_processes.terminate_all()
+        result_aggregator.shutdown_pools()
         logger.info("Stopping file watcher...")
         observer.stop()
         observer.join()
+        if engine:
+            engine.shutdown(wait=False)
+        kraken_daemon.stop_all()
         logger.info("Backend service has been shut down gracefully.")
 
 
@@ -81,7 +81,9 @@ process PREPARE_KRAKEN_DB {
     }
 
     # --- Main logic of the script block ---
-    if ${kraken_opts.memory_mapping}; then
+    if ${params.kraken_db_ready}; then
+        echo "Database verified and loaded by the backend at service start. Skipping checks."
+    elif ${kraken_opts.memory_mapping}; then
         echo "Memory mapping is enabled. Checking /dev/shm..."
         check_and_load_db "${db_path}"
     else
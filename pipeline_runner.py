@@ -6,32 +6,65 @@ from datetime import datetime
 import configparser
 import json
 import shutil
+import shlex
+import time
+import signal
+import asyncio
+import child_processes
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from work_cache import get_work_cache
+from kraken_daemon import get_kraken_daemon, DaemonError
+from processed_ledger import get_ledger
+from unit_cache import get_unit_cache, stage_key, file_identity
+from kreport_merger import KreportTree
+from kraken_residency import get_kraken_residency
+from host_index import host_reference as resolve_host_reference
+from resource_planner import get_resource_planner, write_resource_config
+from trace_ledger import get_trace_ledger, trace_ledger_path, write_trace_config
+from metrics import REGISTRY
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-def run_pipeline_for_batch(fastq_files: list, config: configparser.ConfigParser):
+# Settings read by the Python side only (Bracken's), never passed to Nextflow as --<group>.<key>
+# and not part of any cached stage's key
+_PYTHON_SIDE_PARAMS = {'KrakenParams': ('read_len', 'bracken_threshold')}
+
+def _new_batch_dir(config: configparser.ConfigParser, run_name: str = None):
+    """Creates a timestamped batch folder in the output directory. Returns (path, name)."""
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    batch_name = f"batch_{timestamp}"
+    if run_name:
+        batch_name = f"{batch_name}_{run_name}"
+    batch_output_dir = os.path.abspath(os.path.join(config.get('Paths', 'output_directory'), batch_name))
+    os.makedirs(batch_output_dir, exist_ok=True)
+    return batch_output_dir, batch_name
+
+def _prepare_run(fastq_files: list, config: configparser.ConfigParser, run_name: str = None, work_cache=None):
     """
-    Executes the Nextflow pipeline for a batch of FASTQ files, using all parameters
+    Creates the batch folder and builds the Nextflow command line, using all parameters
     from the provided config object and formatting them correctly for the command line.
-    """
-    if not fastq_files:
-        logging.info("No new files in the batch to process.")
-        return None
-
-    logging.info(f"Starting pipeline for a batch of {len(fastq_files)} file(s).")
+    Returns (command, batch_output_dir, batch_name, launch_dir, work_dir_path).
 
+    With a work cache, every run shares its work directory and keeps a persistent launch directory.
+    """
     # --- Setup paths ---
     output_dir = config.get('Paths', 'output_directory')
-    nextflow_script = config.get('Paths', 'nextflow_script')
-    processed_log_path = config.get('Settings', 'processed_files_log')
+    nextflow_script = os.path.abspath(config.get('Paths', 'nextflow_script'))
 
     # NEW: Get custom work directory, safely defaulting to a 'work' folder INSIDE the output_directory
     work_dir = config.get('Paths', 'work_directory', fallback=os.path.join(output_dir, "work"))
     work_dir_path = os.path.abspath(work_dir)
+    # Nextflow keeps its session cache (.nextflow/) and log in the launch directory
+    launch_dir = os.getcwd()
 
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    batch_output_dir = os.path.join(output_dir, f"batch_{timestamp}")
-    os.makedirs(batch_output_dir, exist_ok=True)
+    batch_output_dir, batch_name = _new_batch_dir(config, run_name)
+    if work_cache:
+        launch_dir = work_cache.launch_dir(run_name)
+    elif run_name:
+        work_dir_path = os.path.join(work_dir_path, run_name)
+        launch_dir = os.path.join(work_dir_path, "launch")
+        os.makedirs(launch_dir, exist_ok=True)
     input_files_str = ",".join(fastq_files)
 
     # --- DYNAMIC COMMAND BUILDING ---
@@ -52,6 +85,19 @@ def run_pipeline_for_batch(fastq_files: list, config: configparser.ConfigParser)
         "-work-dir", work_dir_path
     ]
 
+    # Per-process cpus, memory and maxForks sized for this batch and the host
+    planner = get_resource_planner(config)
+    if planner:
+        resource_config_path = os.path.join(batch_output_dir, "nextflow_resources.config")
+        write_resource_config(resource_config_path, planner.allocate(batch_output_dir, fastq_files, config))
+        command.extend(["-c", resource_config_path])
+
+    # Per-task realtime, CPU, memory and I/O for the trace ledger
+    if config.getboolean('Settings', 'nextflow_trace', fallback=True):
+        trace_config_path = os.path.join(batch_output_dir, "nextflow_trace.config")
+        write_trace_config(trace_config_path, _trace_path(batch_output_dir))
+        command.extend(["-c", trace_config_path])
+
     # 0. Add optional barcodes parameter
     if config.has_option('Settings', 'barcodes'):
         barcodes_value = config.get('Settings', 'barcodes')
@@ -62,6 +108,9 @@ def run_pipeline_for_batch(fastq_files: list, config: configparser.ConfigParser)
     # 1. Add simple key-value parameters
     if config.has_section('DatabasePaths'):
         for param, value in config.items('DatabasePaths'):
+            if param == 'host_reference' and value:
+                # Prebuilt minimap2 index once it is ready
+                value = resolve_host_reference(config)
             if value:
                 command.extend([f"--{param}", value])
 
@@ -72,6 +121,11 @@ def run_pipeline_for_batch(fastq_files: list, config: configparser.ConfigParser)
             if config.getboolean('WorkflowSteps', step):
                 command.append(f"--{step}")
     
+    # The backend already verified and loaded the Kraken2 database; PREPARE_KRAKEN_DB can skip its checks
+    residency = get_kraken_residency(config)
+    if residency and residency.ready:
+        command.append("--kraken_db_ready")
+
     # 3. Add nested parameters using dot notation (e.g., --qc_opts.min_length 1000)
     # This dictionary maps config sections to their corresponding Nextflow 'params' group name.
     map_param_sections = {
@@ -84,61 +138,770 @@ def run_pipeline_for_batch(fastq_files: list, config: configparser.ConfigParser)
     for section, param_group_name in map_param_sections.items():
         if config.has_section(section):
             for key, value in config.items(section):
+                if key in _PYTHON_SIDE_PARAMS.get(section, ()):
+                    continue
                 # Construct the dot-notation parameter: --<group>.<key> <value>
                 # Example: --qc_opts.min_length 1000
                 command.extend([f"--{param_group_name}.{key}", value])
             
     # --- END DYNAMIC COMMAND BUILDING ---
+    return command, batch_output_dir, batch_name, launch_dir, work_dir_path
 
+def _trace_path(batch_output_dir: str) -> str:
+    return os.path.join(batch_output_dir, "nextflow_trace.tsv")
+
+def _ingest_trace(fastq_files: list, config: configparser.ConfigParser, batch_output_dir: str, batch_name: str):
+    """Copies the run's task metrics into the trace ledger (after every attempt, failed ones included)."""
+    trace_path = _trace_path(batch_output_dir)
+    if not os.path.exists(trace_path):
+        return
     try:
-        # The command is correctly formatted for Nextflow
-        logging.info(f"Executing command: {' '.join(command)}")
-        # Output will stream directly to the console in real-time.
-        subprocess.run(
-            command,
-            check=True,
-            text=True
-        )
-
-        logging.info("Nextflow pipeline completed successfully for the batch.")
-        log_processed_files(fastq_files, processed_log_path)
+        barcodes = {os.path.basename(os.path.dirname(f)) for f in fastq_files}
+        count = get_trace_ledger(trace_ledger_path(config)).ingest(trace_path, batch_name, barcodes)
+        logging.info(f"Recorded {count} Nextflow task trace(s) for {batch_name}.")
+    except Exception as e:
+        logging.warning(f"Could not record the Nextflow trace: {e}")
+
+def _release_resources(config: configparser.ConfigParser, batch_output_dir: str):
+    planner = get_resource_planner(config)
+    if planner:
+        planner.release(batch_output_dir)
+
+def _nextflow_timeout(config: configparser.ConfigParser) -> float:
+    """Upper bound on one Nextflow run in seconds (0 disables it)."""
+    return config.getfloat('Settings', 'nextflow_timeout_seconds', fallback=0)
+
+def _ledger_path(config: configparser.ConfigParser) -> str:
+    return config.get('Settings', 'processed_files_ledger',
+                      fallback=os.path.join(config.get('Paths', 'output_directory'), 'processed_files.db'))
+
+def _record_success(fastq_files: list, config: configparser.ConfigParser, batch_name: str, started: float):
+    logging.info("Nextflow pipeline completed successfully for the batch.")
+    REGISTRY.observe("nanort_nextflow_seconds", time.monotonic() - started,
+                     help_text="Wall time of successful Nextflow runs")
+    log_processed_files(fastq_files, _ledger_path(config), batch_name)
+
+def _cleanup_run(launch_dir: str, work_dir_path: str):
+    """Removes the run's Nextflow work folder and the session cache files from its launch directory."""
+    try:
+        # 1. Finds the hidden Nextflow cache files in the current execution directory
+        nf_dir = os.path.join(launch_dir, ".nextflow")
+        nf_log = os.path.join(launch_dir, ".nextflow.log")
         
+        # 2. Delete only the specific work subfolder
+        if os.path.exists(work_dir_path):
+            shutil.rmtree(work_dir_path, ignore_errors=True)
+
+        # 3. Deletes the hidden Nextflow cache files from the execution directory
+        if os.path.exists(nf_dir):
+            shutil.rmtree(nf_dir, ignore_errors=True)
+        if os.path.exists(nf_log):
+            os.remove(nf_log)
+        logging.info(f"Cleaned up Nextflow temporary artifacts ({work_dir_path}, .nextflow/, .nextflow.log).")
+    except Exception as e:
+        logging.warning(f"Failed to clean up Nextflow artifacts: {e}")
+
+def _attempts(config: configparser.ConfigParser, work_cache) -> int:
+    """Failed runs are retried with -resume only when the work cache keeps their task directories."""
+    return 1 + (config.getint('WorkCache', 'resume_retries', fallback=1) if work_cache else 0)
+
+def _with_resume(command: list, attempt: int) -> list:
+    # Resumes the last session in the launch directory, i.e. the attempt that just failed
+    return command + ["-resume"] if attempt > 1 else command
+
+def run_pipeline_for_batch(fastq_files: list, config: configparser.ConfigParser, run_name: str = None):
+    """
+    Executes the Nextflow pipeline for a batch of FASTQ files, using all parameters
+    from the provided config object and formatting them correctly for the command line.
+
+    When run_name is given, the run gets its own work and launch directories (and a
+    suffixed batch folder) so several Nextflow runs can execute concurrently.
+    """
+    if not fastq_files:
+        logging.info("No new files in the batch to process.")
+        return None
+
+    logging.info(f"Starting pipeline for a batch of {len(fastq_files)} file(s).")
+    work_cache = get_work_cache(config)
+    command, batch_output_dir, batch_name, launch_dir, work_dir_path = _prepare_run(fastq_files, config, run_name, work_cache)
+    attempts = _attempts(config, work_cache)
+
+    nextflow_start = time.monotonic()
+    try:
+        with work_cache.session(launch_dir) if work_cache else nullcontext():
+            for attempt in range(1, attempts + 1):
+                run_command = _with_resume(command, attempt)
+                # The command is correctly formatted for Nextflow
+                logging.info(f"Executing command: {' '.join(run_command)}")
+                try:
+                    # Output will stream directly to the console in real-time.
+                    child_processes.run(
+                        run_command,
+                        timeout=_nextflow_timeout(config),
+                        check=True,
+                        text=True,
+                        cwd=launch_dir
+                    )
+                    break
+                except subprocess.CalledProcessError as e:
+                    logging.error(f"Nextflow pipeline failed with exit code {e.returncode}.")
+                    REGISTRY.inc("nanort_nextflow_failures_total", help_text="Nextflow runs that exited with an error")
+                    if attempt == attempts:
+                        return None
+                    logging.info("Retrying with -resume; only the failed processes will run again.")
+                finally:
+                    _ingest_trace(fastq_files, config, batch_output_dir, batch_name)
+
+        _record_success(fastq_files, config, batch_name, nextflow_start)
         return batch_output_dir
 
     except FileNotFoundError:
         logging.error("'nextflow' command not found. Is Nextflow installed and in your PATH?")
         return None
-    except subprocess.CalledProcessError as e:
-        logging.error(f"Nextflow pipeline failed with exit code {e.returncode}.")
+    except subprocess.TimeoutExpired:
+        REGISTRY.inc("nanort_nextflow_failures_total", help_text="Nextflow runs that exited with an error")
+        return None
+    except child_processes.ShutdownRequested:
         return None
     finally:
+        _release_resources(config, batch_output_dir)
         # --- Nextflow Cleanup ---
-        # This block now runs whether the pipeline succeeds or crashes
+        # This block now runs whether the pipeline succeeds or crashes.
+        # A work cache keeps everything and evicts it in the background instead.
+        if not work_cache:
+            _cleanup_run(launch_dir, work_dir_path)
+        # ----------------------------------------
+
+async def _run_nextflow_async(command: list, config: configparser.ConfigParser, launch_dir: str):
+    """Runs one Nextflow attempt. Returns its exit code, or None if it timed out."""
+    logging.info(f"Executing command: {' '.join(command)}")
+    proc = await asyncio.create_subprocess_exec(*command, cwd=launch_dir, start_new_session=True)
+    try:
+        return await asyncio.wait_for(proc.wait(), timeout=_nextflow_timeout(config) or None)
+    except asyncio.TimeoutError:
+        logging.error(f"Nextflow exceeded its {_nextflow_timeout(config):g}s timeout; stopping it.")
+        await _stop_process_group(proc)
+        return None
+    except asyncio.CancelledError:
+        await _stop_process_group(proc)
+        raise
+
+async def run_pipeline_for_batch_async(fastq_files: list, config: configparser.ConfigParser, run_name: str = None):
+    """
+    asyncio counterpart of run_pipeline_for_batch for the event-loop backend. Nextflow
+    runs as an awaitable subprocess; on timeout or task cancellation its whole process
+    group is terminated (SIGTERM, then SIGKILL after half a second).
+    """
+    if not fastq_files:
+        logging.info("No new files in the batch to process.")
+        return None
+
+    logging.info(f"Starting pipeline for a batch of {len(fastq_files)} file(s).")
+    work_cache = get_work_cache(config)
+    command, batch_output_dir, batch_name, launch_dir, work_dir_path = _prepare_run(fastq_files, config, run_name, work_cache)
+    attempts = _attempts(config, work_cache)
+
+    nextflow_start = time.monotonic()
+    cancelled = False
+    try:
+        with work_cache.session(launch_dir) if work_cache else nullcontext():
+            for attempt in range(1, attempts + 1):
+                returncode = await _run_nextflow_async(_with_resume(command, attempt), config, launch_dir)
+                _ingest_trace(fastq_files, config, batch_output_dir, batch_name)
+                if returncode == 0:
+                    break
+                REGISTRY.inc("nanort_nextflow_failures_total", help_text="Nextflow runs that exited with an error")
+                if returncode is None:
+                    return None
+                logging.error(f"Nextflow pipeline failed with exit code {returncode}.")
+                if attempt == attempts:
+                    return None
+                logging.info("Retrying with -resume; only the failed processes will run again.")
+
+        _record_success(fastq_files, config, batch_name, nextflow_start)
+        return batch_output_dir
+
+    except asyncio.CancelledError:
+        cancelled = True
+        raise
+    except FileNotFoundError:
+        logging.error("'nextflow' command not found. Is Nextflow installed and in your PATH?")
+        return None
+    finally:
+        _release_resources(config, batch_output_dir)
+        # A work cache keeps everything and evicts it in the background instead
+        if not work_cache and cancelled:
+            # Removing a large work folder can take seconds; leave it so shutdown stays fast
+            logging.info(f"Nextflow run cancelled; leaving {work_dir_path} in place.")
+        elif not work_cache:
+            _cleanup_run(launch_dir, work_dir_path)
+
+async def _stop_process_group(proc, grace_seconds: float = 0.5):
+    for sig, wait in ((signal.SIGTERM, grace_seconds), (signal.SIGKILL, None)):
         try:
-            # 1. Finds the hidden Nextflow cache files in the current execution directory
-            nf_dir = os.path.abspath(".nextflow")
-            nf_log = os.path.abspath(".nextflow.log")
-            
-            # 2. Delete only the specific work subfolder
-            if os.path.exists(work_dir_path):
-                shutil.rmtree(work_dir_path, ignore_errors=True)
-
-            # 3. Deletes the hidden Nextflow cache files from the execution directory
-            if os.path.exists(nf_dir):
-                shutil.rmtree(nf_dir, ignore_errors=True)
-            if os.path.exists(nf_log):
-                os.remove(nf_log)
-            logging.info(f"Cleaned up Nextflow temporary artifacts ({work_dir_path}, .nextflow/, .nextflow.log).")
+            os.killpg(proc.pid, sig)
+        except ProcessLookupError:
+            return
+        try:
+            await asyncio.wait_for(asyncio.shield(proc.wait()), timeout=wait)
+            return
+        except asyncio.TimeoutError:
+            continue
+
+# --- START STREAMING EXECUTOR ---
+# Runs the main.nf stages for small batches without Nextflow: per barcode, one bash
+# pipeline streams cat -> minimap2 -> samtools -> fastplong -> kraken2 through OS pipes,
+# and tee publishes each stage's reads into the same batch layout main.nf produces.
+
+# main.nf drops samples whose combined reads are this small
+_MIN_READS_BYTES = 100
+
+def _kraken_db_in_shm(kraken_db: str, shm_dir: str = "/dev/shm") -> bool:
+    """True if every *.k2d file of the database is already in shared memory with the right size."""
+    k2d_files = [f for f in os.listdir(kraken_db) if f.endswith(".k2d")] if os.path.isdir(kraken_db) else []
+    if not k2d_files:
+        return False
+    for name in k2d_files:
+        shm_file = os.path.join(shm_dir, name)
+        if not os.path.exists(shm_file) or os.path.getsize(shm_file) != os.path.getsize(os.path.join(kraken_db, name)):
+            return False
+    return True
+
+def _kraken_db_resident(config: configparser.ConfigParser) -> bool:
+    residency = get_kraken_residency(config)
+    if residency:
+        return residency.ready
+    return _kraken_db_in_shm(config.get('DatabasePaths', 'kraken_db'))
+
+def _step(config: configparser.ConfigParser, step: str) -> bool:
+    return config.getboolean('WorkflowSteps', step, fallback=False)
+
+def streaming_supported(config: configparser.ConfigParser):
+    """Whether the configured workflow can run without Nextflow. Returns (supported, reason)."""
+    if _step(config, 'run_classification') and (_step(config, 'run_mapping') or _step(config, 'run_smart')):
+        return False, "mapping and SMART classification only run under Nextflow"
+    if _step(config, 'run_host_depletion') and not config.get('DatabasePaths', 'host_reference', fallback=''):
+        return False, "no host reference configured"
+    if (_step(config, 'run_classification') and _step(config, 'run_kraken')
+            and config.getboolean('KrakenParams', 'memory_mapping', fallback=False)
+            and not _kraken_db_resident(config)):
+        # PREPARE_KRAKEN_DB loads it; let Nextflow do that once
+        return False, "the Kraken2 database is not loaded in /dev/shm yet"
+    return True, ""
+
+def choose_executor(fastq_files: list, config: configparser.ConfigParser) -> str:
+    """
+    Picks 'units' when per-file processing is on, 'streaming' for batches small enough that
+    Nextflow's startup would dominate, else 'nextflow'.
+    """
+    if config.getboolean('UnitCache', 'enabled', fallback=False):
+        supported, reason = streaming_supported(config)
+        if supported:
+            return "units"
+        logging.info(f"Per-file units are unavailable for this workflow: {reason}.")
+    if not config.getboolean('Streaming', 'enabled', fallback=False):
+        return "nextflow"
+    max_files = config.getint('Streaming', 'max_files', fallback=8)
+    max_bytes = config.getint('Streaming', 'max_bytes', fallback=200 * 1024**2)
+    batch_bytes = sum(os.path.getsize(f) for f in fastq_files if os.path.exists(f))
+    if len(fastq_files) > max_files or batch_bytes > max_bytes:
+        return "nextflow"
+    supported, reason = streaming_supported(config)
+    if not supported:
+        logging.info(f"Using Nextflow for this batch: {reason}.")
+        return "nextflow"
+    return "streaming"
+
+def _streaming_env(config: configparser.ConfigParser) -> dict:
+    # Same tool environment the Nextflow processes get from their beforeScript
+    pipeline_dir = os.path.dirname(os.path.abspath(config.get('Paths', 'nextflow_script')))
+    env = os.environ.copy()
+    env["PATH"] = os.path.join(pipeline_dir, "bin", "conda-env", "bin") + os.pathsep + env.get("PATH", "")
+    return env
+
+def _fastplong_command(config: configparser.ConfigParser, json_path: str, html_path: str) -> str:
+    """fastplong reading stdin, with the same options RUN_QC_FASTPLONG builds from qc_opts."""
+    qc = lambda key, fallback='': config.get('QcParams', key, fallback=fallback)
+    qc_flag = lambda key: config.getboolean('QcParams', key, fallback=False)
+    command = (f"fastplong --stdin --stdout -m {qc('min_mean_q', '10')} -q {qc('min_base_q', '10')} "
+               f"-u {qc('perc_low_qual', '40')} -l {qc('min_length', '1000')} "
+               f"-j {shlex.quote(json_path)} -h {shlex.quote(html_path)}")
+    if qc('min_length', '1000') == '0':
+        command += " -L"
+    if qc_flag('disable_adapters'):
+        command += " -A"
+    if qc_flag('trim5'):
+        command += " -5"
+    if qc_flag('trim3'):
+        command += " -3"
+    if qc_flag('trim5') or qc_flag('trim3'):
+        command += f" -W {qc('window_size', '10')} -M {qc('cut_quality', '10')}"
+    if qc_flag('low_complexity'):
+        command += " --low_complexity_filter"
+    return command
+
+def _kraken_outputs(barcode: str, batch_output_dir: str) -> dict:
+    """The files RUN_KRAKEN2 publishes for a barcode, keyed like Kraken2Daemon.job's arguments."""
+    kraken_dir = os.path.join(batch_output_dir, "3_classification", "kraken2", barcode)
+    os.makedirs(kraken_dir, exist_ok=True)
+    return {'kraken_output': os.path.join(kraken_dir, f"{barcode}.kraken2.tsv"),
+            'report': os.path.join(kraken_dir, f"{barcode}.report.tsv"),
+            'minimizers': os.path.join(kraken_dir, f"{barcode}.minimizers.tsv")}
+
+def _kraken2_command(config: configparser.ConfigParser, threads: int, outputs: dict, reads: str = "/dev/stdin") -> str:
+    """kraken2 as RUN_KRAKEN2 runs it on reads (standard input by default), writing the files in outputs (see _kraken_outputs)."""
+    q = shlex.quote
+    memory_mapping = config.getboolean('KrakenParams', 'memory_mapping', fallback=False)
+    kraken_db = "/dev/shm" if memory_mapping else config.get('DatabasePaths', 'kraken_db')
+    kraken_bin = os.path.join(os.path.dirname(os.path.abspath(config.get('Paths', 'nextflow_script'))), "bin", "kraken2")
+    return (f"{q(kraken_bin)} --use-names --report-minimizer-data --threads {threads} --db {q(kraken_db)} "
+            f"--confidence {config.get('KrakenParams', 'confidence', fallback='0.1')} "
+            f"--minimum-base-quality {config.get('KrakenParams', 'min_base_q', fallback='0')} "
+            f"--minimum-hit-groups {config.get('KrakenParams', 'min_hit_groups', fallback='2')} "
+            f"{'--memory-mapping ' if memory_mapping else ''}"
+            f"--output {q(outputs['kraken_output'])} --report {q(outputs['report'])} "
+            f"{q(reads)} > {q(outputs['minimizers'])}")
+
+def _barcode_stream_script(barcode: str, files: list, config: configparser.ConfigParser, batch_output_dir: str,
+                           kraken_daemon: bool = False):
+    """
+    Builds the bash pipeline for one barcode. Returns (script, classification reads path),
+    the latter being the reads file RUN_AMR would receive. With kraken_daemon the pipeline
+    ends by writing reads to $KRAKEN2_STDIN instead of starting kraken2.
+    """
+    threads = config.getint('Streaming', 'threads', fallback=4)
+    q = shlex.quote
+
+    def out(stage, name):
+        stage_dir = os.path.join(batch_output_dir, stage, barcode)
+        os.makedirs(stage_dir, exist_ok=True)
+        return os.path.join(stage_dir, name)
+
+    combined = out("0_combined_fastq", f"{barcode}.fastq.gz")
+    fifos, publishers = [], []
+    stages = [f"cat {' '.join(q(f) for f in files)} | tee {q(combined)} | gzip -dc"]
+    reads_for_classification = combined
+
+    def publish(name, path):
+        # tee into a FIFO drained by a background gzip, so the script can wait for it
+        fifos.append(name)
+        publishers.append(f'gzip -c < "$tmp/{name}" > {q(path)} & pids+=($!)')
+        return f'tee "$tmp/{name}"'
+
+    if _step(config, 'run_host_depletion'):
+        host_reference = resolve_host_reference(config)
+        host = (f"minimap2 -K 50M -t {threads} -a -x map-ont {q(host_reference)} -")
+        if config.getboolean('HostDepletionParams', 'keep_bam', fallback=False):
+            bam = out("1_host_depletion", f"{barcode}.hostReads.bam")
+            fifos.append("sam")
+            publishers.append(f'samtools view -@ {threads} -bS - < "$tmp/sam" > {q(bam)} & pids+=($!)')
+            host += ' | tee "$tmp/sam"'
+        no_host = out("1_host_depletion", f"{barcode}.noHost.fastq.gz")
+        stages.append(f"{host} | samtools view -@ {threads} -f4 -F256 - | samtools fastq - | {publish('nohost', no_host)}")
+        reads_for_classification = no_host
+
+    if _step(config, 'run_read_qc'):
+        filtered = out("2_quality_control", f"{barcode}.filtered.fastq.gz")
+        qc = _fastplong_command(config, out("2_quality_control", f"{barcode}.filtered.json"),
+                                out("2_quality_control", f"{barcode}.filtered.html"))
+        stages.append(f"{qc} | {publish('filtered', filtered)}")
+        reads_for_classification = filtered
+
+    if _step(config, 'run_classification') and _step(config, 'run_kraken') and kraken_daemon:
+        # The resident classifier reads the job's input FIFO handed over in $KRAKEN2_STDIN
+        stages.append('cat > "$KRAKEN2_STDIN"')
+    elif _step(config, 'run_classification') and _step(config, 'run_kraken'):
+        # The kraken2 wrapper refuses to run without a file argument, so it is given /dev/stdin
+        stages.append(_kraken2_command(config, threads, _kraken_outputs(barcode, batch_output_dir)))
+    else:
+        stages.append("cat > /dev/null")
+
+    script = "\n".join([
+        "set -euo pipefail",
+        'tmp=$(mktemp -d)',
+        'pids=()',
+        # Never leave a publisher blocked on a FIFO nobody opened
+        """trap 'kill $(jobs -p) 2>/dev/null || true; rm -rf "$tmp"' EXIT""",
+        *(f'mkfifo "$tmp/{name}"' for name in fifos),
+        *publishers,
+        " | \\\n    ".join(stages),
+        'for pid in "${pids[@]}"; do wait "$pid"; done',
+    ])
+    return script, reads_for_classification
+
+def _run_amr_streaming(barcode: str, reads: str, config: configparser.ConfigParser, batch_output_dir: str, env: dict):
+    """RUN_AMR for one barcode: rgi bwt on the classification reads, keeping the files main.nf publishes."""
+    amr_dir = os.path.join(batch_output_dir, "3_classification", "amr", barcode)
+    scratch = os.path.join(batch_output_dir, f".amr_{barcode}")
+    os.makedirs(amr_dir, exist_ok=True)
+    os.makedirs(scratch, exist_ok=True)
+    basename = os.path.basename(reads)[:-len(".gz")].replace('.fastq', '').replace('.fq', '')
+    prefix = os.path.join(scratch, f"{barcode}_{basename}")
+    threads = config.getint('Streaming', 'threads', fallback=4)
+    try:
+        child_processes.run(["rgi", "bwt", "-1", os.path.abspath(reads), "-a", "bwa", "-o", prefix,
+                             "-n", str(threads), "--local", "--clean"],
+                            timeout=_nextflow_timeout(config), check=True, cwd=config.get('DatabasePaths', 'card_db'), env=env)
+        for name in os.listdir(scratch):
+            if name.endswith((".allele_mapping_data.txt", ".gene_mapping_data.txt", ".bam")):
+                shutil.move(os.path.join(scratch, name), os.path.join(amr_dir, name))
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+def _streaming_barcodes(fastq_files: list, config: configparser.ConfigParser) -> dict:
+    """Groups files by barcode folder, applying the [Settings] barcodes filter like main.nf."""
+    wanted = {b.strip() for b in config.get('Settings', 'barcodes', fallback='').split(',') if b.strip()}
+    groups = {}
+    for file_path in fastq_files:
+        barcode = os.path.basename(os.path.dirname(file_path))
+        if not wanted or barcode in wanted:
+            groups.setdefault(barcode, []).append(file_path)
+    return dict(sorted(groups.items()))
+
+def _streaming_daemon(config: configparser.ConfigParser):
+    """The resident Kraken2 classifier, if enabled and this workflow classifies with Kraken2."""
+    if _step(config, 'run_classification') and _step(config, 'run_kraken'):
+        return get_kraken_daemon(config)
+    return None
+
+def _run_with_daemon(daemon, script: str, config: configparser.ConfigParser, outputs: dict, env: dict):
+    """
+    Runs a script that writes reads to $KRAKEN2_STDIN, classified by the resident classifier into
+    outputs (see _kraken_outputs). A daemon failure restarts it and retries once.
+    """
+    threads = config.getint('Streaming', 'threads', fallback=4)
+    for attempt in (1, 2):
+        try:
+            with daemon.job(config, threads, **outputs) as stdin_fifo:
+                child_processes.run(["bash", "-c", script], timeout=_nextflow_timeout(config), check=True,
+                                    env=dict(env, KRAKEN2_STDIN=stdin_fifo))
+            return
+        except DaemonError as e:
+            if attempt == 2:
+                raise
+            logging.warning(f"Resident Kraken2 classifier failed ({e}); restarting it and retrying.")
+
+def _run_barcode_with_daemon(daemon, barcode: str, script: str, config: configparser.ConfigParser,
+                             batch_output_dir: str, env: dict):
+    """Runs a barcode's streaming pipeline feeding the resident classifier."""
+    _run_with_daemon(daemon, script, config, _kraken_outputs(barcode, batch_output_dir), env)
+
+def _concatenate(sources: list, destination: str):
+    # Gzip members and TSV rows both concatenate into a valid file
+    with open(destination, 'wb') as out_f:
+        for source in sources:
+            with open(source, 'rb') as in_f:
+                shutil.copyfileobj(in_f, out_f)
+
+def _publish_if_too_small(barcode: str, files: list, batch_output_dir: str) -> bool:
+    """main.nf only combines barcodes with too few reads to process. Returns True if this was one."""
+    if sum(os.path.getsize(f) for f in files) > _MIN_READS_BYTES:
+        return False
+    combined_dir = os.path.join(batch_output_dir, "0_combined_fastq", barcode)
+    os.makedirs(combined_dir, exist_ok=True)
+    _concatenate(files, os.path.join(combined_dir, f"{barcode}.fastq.gz"))
+    return True
+
+# Stage folders in pipeline order, after the combined reads
+_GATED_STAGES = ["1_host_depletion", "2_quality_control", os.path.join("3_classification", "kraken2")]
+
+def _passes_read_gates(barcode: str, config: configparser.ConfigParser, batch_output_dir: str) -> bool:
+    """
+    main.nf stops a sample whose host-depleted or QC-filtered reads are _MIN_READS_BYTES or
+    less. The streaming and unit pipelines run every stage regardless, so the outputs past
+    such a gate are removed afterwards to leave main.nf's layout. Returns False if the
+    barcode was stopped (it then gets no classification or AMR).
+    """
+    gates = []
+    if _step(config, 'run_host_depletion'):
+        gates.append((0, f"{barcode}.noHost.fastq.gz"))
+    if _step(config, 'run_read_qc'):
+        gates.append((1, f"{barcode}.filtered.fastq.gz"))
+    for index, name in gates:
+        reads = os.path.join(batch_output_dir, _GATED_STAGES[index], barcode, name)
+        if os.path.exists(reads) and os.path.getsize(reads) > _MIN_READS_BYTES:
+            continue
+        logging.info(f"{barcode}: too few reads left after {_GATED_STAGES[index]}; stopping it like main.nf.")
+        for stage in _GATED_STAGES[index + 1:]:
+            shutil.rmtree(os.path.join(batch_output_dir, stage, barcode), ignore_errors=True)
+        return False
+    return True
+
+def _streaming_jobs(fastq_files: list, config: configparser.ConfigParser, batch_output_dir: str, kraken_daemon=None):
+    """Yields (barcode, script, classification reads) for every barcode with enough reads to process."""
+    for barcode, files in _streaming_barcodes(fastq_files, config).items():
+        if _publish_if_too_small(barcode, files, batch_output_dir):
+            continue
+        script, reads = _barcode_stream_script(barcode, files, config, batch_output_dir,
+                                               kraken_daemon=kraken_daemon is not None)
+        yield barcode, script, reads
+
+def run_streaming_for_batch(fastq_files: list, config: configparser.ConfigParser, run_name: str = None):
+    """Runs the batch with the streaming executor. Returns the batch folder, or None on failure."""
+    logging.info(f"Starting streaming executor for a batch of {len(fastq_files)} file(s).")
+    batch_output_dir, batch_name = _new_batch_dir(config, run_name)
+    env = _streaming_env(config)
+    daemon = _streaming_daemon(config)
+    start = time.monotonic()
+    try:
+        for barcode, script, reads in _streaming_jobs(fastq_files, config, batch_output_dir, daemon):
+            if daemon:
+                _run_barcode_with_daemon(daemon, barcode, script, config, batch_output_dir, env)
+            else:
+                child_processes.run(["bash", "-c", script], timeout=_nextflow_timeout(config), check=True, env=env)
+            if not _passes_read_gates(barcode, config, batch_output_dir):
+                continue
+            if _step(config, 'run_classification') and _step(config, 'run_amr'):
+                _run_amr_streaming(barcode, reads, config, batch_output_dir, env)
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired, DaemonError, OSError) as e:
+        logging.error(f"Streaming executor failed: {e}")
+        shutil.rmtree(batch_output_dir, ignore_errors=True)
+        return None
+    REGISTRY.observe("nanort_streaming_seconds", time.monotonic() - start,
+                     help_text="Wall time of batches run by the streaming executor")
+    log_processed_files(fastq_files, _ledger_path(config), batch_name)
+    return batch_output_dir
+
+async def run_streaming_for_batch_async(fastq_files: list, config: configparser.ConfigParser, run_name: str = None):
+    """asyncio counterpart of run_streaming_for_batch; cancellation stops the barcode's whole pipeline."""
+    logging.info(f"Starting streaming executor for a batch of {len(fastq_files)} file(s).")
+    batch_output_dir, batch_name = _new_batch_dir(config, run_name)
+    env = _streaming_env(config)
+    daemon = _streaming_daemon(config)
+    start = time.monotonic()
+    try:
+        for barcode, script, reads in _streaming_jobs(fastq_files, config, batch_output_dir, daemon):
+            if daemon:
+                # Jobs on the resident classifier are serialized and block on its FIFOs, so they run in a thread
+                await asyncio.to_thread(_run_barcode_with_daemon, daemon, barcode, script, config, batch_output_dir, env)
+                if _passes_read_gates(barcode, config, batch_output_dir) and _step(config, 'run_classification') and _step(config, 'run_amr'):
+                    await asyncio.to_thread(_run_amr_streaming, barcode, reads, config, batch_output_dir, env)
+                continue
+            proc = await asyncio.create_subprocess_exec("bash", "-c", script, env=env, start_new_session=True)
+            try:
+                returncode = await asyncio.wait_for(proc.wait(), timeout=_nextflow_timeout(config) or None)
+            except (asyncio.TimeoutError, asyncio.CancelledError):
+                await _stop_process_group(proc)
+                raise
+            if returncode != 0:
+                raise subprocess.CalledProcessError(returncode, f"streaming pipeline for {barcode}")
+            if not _passes_read_gates(barcode, config, batch_output_dir):
+                continue
+            if _step(config, 'run_classification') and _step(config, 'run_amr'):
+                await asyncio.to_thread(_run_amr_streaming, barcode, reads, config, batch_output_dir, env)
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired, asyncio.TimeoutError, DaemonError, OSError) as e:
+        logging.error(f"Streaming executor failed: {e or 'timed out'}")
+        shutil.rmtree(batch_output_dir, ignore_errors=True)
+        return None
+    REGISTRY.observe("nanort_streaming_seconds", time.monotonic() - start,
+                     help_text="Wall time of batches run by the streaming executor")
+    log_processed_files(fastq_files, _ledger_path(config), batch_name)
+    return batch_output_dir
+# --- END STREAMING EXECUTOR ---
+
+# --- START UNIT EXECUTOR ---
+# Per-file processing units: host depletion, QC and Kraken2 run once per input file,
+# keyed in the unit cache by the file's content hash and each stage's parameters, and
+# each barcode's batch outputs are assembled from the units in main.nf's layout.
+
+def _stage_params(config: configparser.ConfigParser) -> dict:
+    """Everything each cached stage's output depends on besides its input."""
+    section = lambda name: dict(config.items(name)) if config.has_section(name) else {}
+    memory_mapping = config.getboolean('KrakenParams', 'memory_mapping', fallback=False)
+    kraken_db = config.get('DatabasePaths', 'kraken_db', fallback='')
+    # memory_mapping is keyed as 'shm' below
+    kraken_ignored = ('memory_mapping',) + _PYTHON_SIDE_PARAMS['KrakenParams']
+    return {
+        'host': {'reference': file_identity(config.get('DatabasePaths', 'host_reference', fallback='')),
+                 'options': section('HostDepletionParams')},
+        'qc': section('QcParams'),
+        'kraken': {'database': file_identity(os.path.join(kraken_db, "hash.k2d")),
+                   'options': {k: v for k, v in section('KrakenParams').items() if k not in kraken_ignored},
+                   'shm': memory_mapping},
+    }
+
+def _run_unit_script(script: str, config: configparser.ConfigParser, env: dict):
+    child_processes.run(["bash", "-c", "set -euo pipefail\n" + script], timeout=_nextflow_timeout(config),
+                        check=True, env=env)
+
+def _file_units(file_path: str, config: configparser.ConfigParser, cache, env: dict, daemon=None) -> dict:
+    """
+    Runs (or reuses) every enabled stage for one input file. Returns {stage: cache entry}
+    plus 'reads', the file classification and RUN_AMR would read.
+    """
+    q = shlex.quote
+    threads = config.getint('Streaming', 'threads', fallback=4)
+    params = _stage_params(config)
+    key = cache.content_hash(file_path)
+    units = {'reads': file_path}
+
+    def stage(name, build):
+        nonlocal key
+        key = stage_key(name, key, params[name])
+        entry = cache.lookup(name, key)
+        if entry is None:
+            with cache.produce(name, key) as scratch:
+                build(scratch)
+            entry = cache.entry_path(name, key)
+        units[name] = entry
+        return entry
+
+    if _step(config, 'run_host_depletion'):
+        def host(out):
+            command = f"minimap2 -K 50M -t {threads} -a -x map-ont {q(resolve_host_reference(config))} {q(units['reads'])}"
+            depleted = (f"samtools view -@ {threads} -f4 -F256 - | samtools fastq - | "
+                        f"gzip -c > {q(os.path.join(out, 'reads.fastq.gz'))}")
+            if not config.getboolean('HostDepletionParams', 'keep_bam', fallback=False):
+                _run_unit_script(f"{command} | {depleted}", config, env)
+                return
+            # The BAM writer reads a FIFO in the background and is waited for, as in _barcode_stream_script,
+            # so the stage fails if it does
+            _run_unit_script("\n".join([
+                'tmp=$(mktemp -d)',
+                """trap 'kill $(jobs -p) 2>/dev/null || true; rm -rf "$tmp"' EXIT""",
+                'mkfifo "$tmp/sam"',
+                f'samtools view -@ {threads} -bS - < "$tmp/sam" > {q(os.path.join(out, "hostReads.bam"))} & pid=$!',
+                f'{command} | tee "$tmp/sam" | {depleted}',
+                'wait "$pid"',
+            ]), config, env)
+        units['reads'] = os.path.join(stage('host', host), 'reads.fastq.gz')
+
+    if _step(config, 'run_read_qc'):
+        def qc(out):
+            fastplong = _fastplong_command(config, os.path.join(out, 'filtered.json'), os.path.join(out, 'filtered.html'))
+            _run_unit_script(f"gzip -dcf {q(units['reads'])} | {fastplong} | "
+                             f"gzip -c > {q(os.path.join(out, 'reads.fastq.gz'))}", config, env)
+        units['reads'] = os.path.join(stage('qc', qc), 'reads.fastq.gz')
+
+    if _step(config, 'run_classification') and _step(config, 'run_kraken'):
+        def kraken(out):
+            outputs = {'kraken_output': os.path.join(out, 'kraken2.tsv'), 'report': os.path.join(out, 'report.tsv'),
+                       'minimizers': os.path.join(out, 'minimizers.tsv')}
+            if daemon:
+                _run_with_daemon(daemon, f'gzip -dcf {q(units["reads"])} > "$KRAKEN2_STDIN"', config, outputs, env)
+            else:
+                _run_unit_script(_kraken2_command(config, threads, outputs, reads=units['reads']), config, env)
+        stage('kraken', kraken)
+    return units
+
+def _file_stem(file_path: str) -> str:
+    return os.path.basename(file_path).split('.fastq')[0].split('.fq')[0]
+
+def _assemble_barcode(barcode: str, files: list, units: dict, config: configparser.ConfigParser,
+                      batch_output_dir: str, env: dict) -> str:
+    """Writes a barcode's batch outputs from its files' units. Returns the classification reads path."""
+    def out(stage, name):
+        stage_dir = os.path.join(batch_output_dir, stage, barcode)
+        os.makedirs(stage_dir, exist_ok=True)
+        return os.path.join(stage_dir, name)
+
+    reads = out("0_combined_fastq", f"{barcode}.fastq.gz")
+    _concatenate(files, reads)
+    if _step(config, 'run_host_depletion'):
+        reads = out("1_host_depletion", f"{barcode}.noHost.fastq.gz")
+        _concatenate([os.path.join(units[f]['host'], 'reads.fastq.gz') for f in files], reads)
+        if config.getboolean('HostDepletionParams', 'keep_bam', fallback=False):
+            child_processes.run(["samtools", "cat", "-o", out("1_host_depletion", f"{barcode}.hostReads.bam")] +
+                                [os.path.join(units[f]['host'], 'hostReads.bam') for f in files],
+                                timeout=_nextflow_timeout(config), check=True, env=env)
+    if _step(config, 'run_read_qc'):
+        reads = out("2_quality_control", f"{barcode}.filtered.fastq.gz")
+        _concatenate([os.path.join(units[f]['qc'], 'reads.fastq.gz') for f in files], reads)
+        # fastplong's reports stay per input file
+        for f in files:
+            for ext in ("json", "html"):
+                shutil.copyfile(os.path.join(units[f]['qc'], f"filtered.{ext}"),
+                                out("2_quality_control", f"{barcode}.{_file_stem(f)}.filtered.{ext}"))
+    if _step(config, 'run_classification') and _step(config, 'run_kraken'):
+        outputs = _kraken_outputs(barcode, batch_output_dir)
+        _concatenate([os.path.join(units[f]['kraken'], 'kraken2.tsv') for f in files], outputs['kraken_output'])
+        _concatenate([os.path.join(units[f]['kraken'], 'minimizers.tsv') for f in files], outputs['minimizers'])
+        reports = [os.path.join(units[f]['kraken'], 'report.tsv') for f in files]
+        if len(reports) == 1:
+            shutil.copyfile(reports[0], outputs['report'])
+        else:
+            tree = KreportTree()
+            for report in reports:
+                tree.add_report(report)
+            tree.write(outputs['report'])
+    return reads
+
+def run_units_for_batch(fastq_files: list, config: configparser.ConfigParser, run_name: str = None):
+    """Runs the batch as per-file units through the unit cache. Returns the batch folder, or None on failure."""
+    logging.info(f"Starting per-file unit executor for a batch of {len(fastq_files)} file(s).")
+    cache = get_unit_cache(config)
+    batch_output_dir, batch_name = _new_batch_dir(config, run_name)
+    env = _streaming_env(config)
+    daemon = _streaming_daemon(config)
+    start = time.monotonic()
+    try:
+        groups = {}
+        for barcode, files in _streaming_barcodes(fastq_files, config).items():
+            if not _publish_if_too_small(barcode, files, batch_output_dir):
+                groups[barcode] = files
+        all_files = [f for files in groups.values() for f in files]
+        with ThreadPoolExecutor(max_workers=config.getint('UnitCache', 'workers', fallback=2)) as pool:
+            units = dict(zip(all_files, pool.map(lambda f: _file_units(f, config, cache, env, daemon), all_files)))
+        for barcode, files in groups.items():
+            reads = _assemble_barcode(barcode, files, units, config, batch_output_dir, env)
+            if not _passes_read_gates(barcode, config, batch_output_dir):
+                continue
+            if _step(config, 'run_classification') and _step(config, 'run_amr'):
+                _run_amr_streaming(barcode, reads, config, batch_output_dir, env)
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired, DaemonError, OSError) as e:
+        logging.error(f"Unit executor failed: {e}")
+        shutil.rmtree(batch_output_dir, ignore_errors=True)
+        return None
+    finally:
+        # Eviction is housekeeping: its failures never change the batch's result
+        try:
+            cache.evict()
         except Exception as e:
-            logging.warning(f"Failed to clean up Nextflow artifacts: {e}")
-        # ----------------------------------------
+            logging.warning(f"Unit cache eviction failed: {e}")
+    REGISTRY.observe("nanort_unit_executor_seconds", time.monotonic() - start,
+                     help_text="Wall time of batches run as per-file units")
+    log_processed_files(fastq_files, _ledger_path(config), batch_name)
+    return batch_output_dir
+# --- END UNIT EXECUTOR ---
+
+def run_batch(fastq_files: list, config: configparser.ConfigParser, run_name: str = None, executor: str = None):
+    """
+    Runs a batch with the given executor ('units', 'streaming' or 'nextflow'), or picks one
+    by batch size. A failed units or streaming run is retried under Nextflow.
+    """
+    executor = executor or choose_executor(fastq_files, config)
+    if executor == "units":
+        batch_output_dir = run_units_for_batch(fastq_files, config, run_name=run_name)
+        if batch_output_dir:
+            return batch_output_dir
+        logging.warning("Falling back to Nextflow for this batch.")
+    elif executor == "streaming":
+        batch_output_dir = run_streaming_for_batch(fastq_files, config, run_name=run_name)
+        if batch_output_dir:
+            return batch_output_dir
+        logging.warning("Falling back to Nextflow for this batch.")
+    return run_pipeline_for_batch(fastq_files, config, run_name=run_name)
+
+async def run_batch_async(fastq_files: list, config: configparser.ConfigParser, run_name: str = None, executor: str = None):
+    """asyncio counterpart of run_batch."""
+    executor = executor or choose_executor(fastq_files, config)
+    if executor == "units":
+        # Units fan out over their own thread pool
+        batch_output_dir = await asyncio.to_thread(run_units_for_batch, fastq_files, config, run_name)
+        if batch_output_dir:
+            return batch_output_dir
+        logging.warning("Falling back to Nextflow for this batch.")
+    elif executor == "streaming":
+        batch_output_dir = await run_streaming_for_batch_async(fastq_files, config, run_name=run_name)
+        if batch_output_dir:
+            return batch_output_dir
+        logging.warning("Falling back to Nextflow for this batch.")
+    return await run_pipeline_for_batch_async(fastq_files, config, run_name=run_name)
 
-def log_processed_files(file_list: list, log_file_path: str):
-    """Appends a list of successfully processed files to the log."""
+def log_processed_files(file_list: list, ledger_path: str, batch_id: str):
+    """Records a list of successfully processed files, with size and mtime, in the ledger."""
     try:
-        with open(log_file_path, 'a') as f:
-            for file_path in file_list:
-                f.write(f"{file_path}\n")
-        logging.info(f"Updated processed files log: {log_file_path}")
-    except IOError as e:
-        logging.error(f"Could not write to processed files log: {e}")
\ No newline at end of file
+        get_ledger(ledger_path).record(file_list, batch_id)
+        logging.info(f"Updated processed files ledger: {ledger_path}")
+    except Exception as e:
+        logging.error(f"Could not write to processed files ledger: {e}")
@@ -6,17 +6,14 @@ import matplotlib.pyplot as plt
 import matplotlib.ticker as mticker
 import seaborn as sns
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from timeseries_store import read_frame
+
 def generate_cumulative_plot(data_file: str, barcode: str, output_dir: str):
     """
     Generates a cumulative plot of species read counts over time for a specific barcode.
     """
-    try:
-        df = pd.read_csv(data_file)
-    except FileNotFoundError:
-        print(f"Error: Data file not found at {data_file}", file=sys.stderr)
-        return
-
-    barcode_df = df[df['barcode'] == barcode].copy()
+    barcode_df = read_frame(data_file, barcode=barcode)
     if barcode_df.empty:
         print(f"No data for barcode {barcode} found in {data_file}")
         return
@@ -5,16 +5,14 @@ import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from timeseries_store import read_frame
+
 def generate_rarefaction_plot(data_file: str, output_dir: str):
     """
     Generates a rarefaction plot (unique species vs. time) for all barcodes.
     """
-    try:
-        df = pd.read_csv(data_file)
-    except FileNotFoundError:
-        print(f"Error: Data file not found at {data_file}", file=sys.stderr)
-        return
-
+    df = read_frame(data_file)
     if df.empty:
         print(f"No data to plot in {data_file}")
         return
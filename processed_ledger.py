@@ -0,0 +1,147 @@
+# processed_ledger.py
+import os
+import time
+import sqlite3
+import logging
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS processed (
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime_ns INTEGER,
+    batch_id TEXT,
+    processed_at REAL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+) WITHOUT ROWID;
+"""
+
+# One ledger object per database file, shared by the watcher and the pipeline runner
+_LEDGERS = {}
+_LEDGERS_LOCK = Lock()
+
+def get_ledger(db_path: str, legacy_log_path: str = None) -> "ProcessedLedger":
+    """Returns the process-wide ledger for db_path, opening it on first use."""
+    db_path = os.path.abspath(db_path)
+    with _LEDGERS_LOCK:
+        if db_path not in _LEDGERS:
+            _LEDGERS[db_path] = ProcessedLedger(db_path, legacy_log_path=legacy_log_path)
+        return _LEDGERS[db_path]
+
+class ProcessedLedger:
+    """
+    SQLite (WAL mode) ledger of processed FASTQ files, keyed by path and storing size,
+    mtime and batch id. Opening it is O(1) and membership checks are index lookups,
+    so nothing proportional to the run length is held in memory.
+
+    It can stand in for the old processed-files set: `in` is True for files that are
+    queued in this session or were processed with the same size and mtime, so a file
+    rewritten in place is picked up again. `add` marks a file as queued.
+    """
+    # Checkpoint and truncate the WAL after this many recorded batches
+    CHECKPOINT_EVERY = 50
+
+    def __init__(self, db_path: str, legacy_log_path: str = None):
+        self.db_path = db_path
+        self._lock = Lock()
+        self._queued = set()
+        self._batches_since_checkpoint = 0
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(_SCHEMA)
+        if legacy_log_path:
+            self._import_legacy_log(legacy_log_path)
+
+    def _import_legacy_log(self, log_file_path: str):
+        """One-off import of a plain-text processed_files.log into the ledger."""
+        if not os.path.exists(log_file_path):
+            return
+        with self._lock:
+            done = self.conn.execute("SELECT value FROM meta WHERE key = 'legacy_log_imported'").fetchone()
+            if done:
+                return
+            try:
+                rows = []
+                with open(log_file_path, 'r') as f:
+                    for line in f:
+                        file_path = line.strip()
+                        if file_path:
+                            size, mtime_ns = self._stat(file_path)
+                            rows.append((file_path, size, mtime_ns, "legacy", time.time()))
+                with self.conn:
+                    self.conn.executemany("INSERT OR IGNORE INTO processed VALUES (?, ?, ?, ?, ?)", rows)
+                    self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('legacy_log_imported', ?)", (log_file_path,))
+                logger.info(f"Imported {len(rows)} file paths from legacy log '{log_file_path}' into the ledger.")
+            except (IOError, sqlite3.Error) as e:
+                logger.error(f"Could not import legacy processed files log '{log_file_path}': {e}")
+
+    @staticmethod
+    def _stat(file_path: str):
+        try:
+            st = os.stat(file_path)
+            return st.st_size, st.st_mtime_ns
+        except OSError:
+            return None, None
+
+    def __contains__(self, file_path: str) -> bool:
+        with self._lock:
+            if file_path in self._queued:
+                return True
+            row = self.conn.execute("SELECT size, mtime_ns FROM processed WHERE path = ?", (file_path,)).fetchone()
+        if row is None:
+            return False
+        size, mtime_ns = self._stat(file_path)
+        if size is None or row[0] is None:
+            return True
+        if (size, mtime_ns) != (row[0], row[1]):
+            logger.info(f"File changed since it was processed, treating as new: {os.path.basename(file_path)}")
+            return False
+        return True
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self.conn.execute("SELECT COUNT(*) FROM processed").fetchone()[0]
+
+    def add(self, file_path: str):
+        """Marks a file as queued for this session."""
+        with self._lock:
+            self._queued.add(file_path)
+
+    def discard(self, file_path: str):
+        """Forgets a queued file so the next scan can pick it up again."""
+        with self._lock:
+            self._queued.discard(file_path)
+
+    def record(self, file_paths: list, batch_id: str):
+        """Persists a batch of successfully processed files with their current size and mtime."""
+        now = time.time()
+        rows = []
+        for file_path in file_paths:
+            size, mtime_ns = self._stat(file_path)
+            rows.append((file_path, size, mtime_ns, batch_id, now))
+        with self._lock:
+            with self.conn:
+                self.conn.executemany("INSERT OR REPLACE INTO processed VALUES (?, ?, ?, ?, ?)", rows)
+            self._queued.difference_update(file_paths)
+            self._batches_since_checkpoint += 1
+            if self._batches_since_checkpoint >= self.CHECKPOINT_EVERY:
+                self.compact()
+
+    def compact(self):
+        """Folds the WAL back into the main database file and truncates it."""
+        try:
+            self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            self._batches_since_checkpoint = 0
+        except sqlite3.Error as e:
+            logger.warning(f"Ledger checkpoint failed: {e}")
+
+    def close(self):
+        with self._lock:
+            self.compact()
+            self.conn.close()
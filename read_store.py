@@ -0,0 +1,216 @@
+# read_store.py
+import os
+import re
+import csv
+import gzip
+import json
+import logging
+import configparser
+from threading import Lock
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+logger = logging.getLogger(__name__)
+
+COLUMNS = ["read_id", "taxid", "length", "batch"]
+MANIFEST = "partitions.json"
+
+# Kraken2 with --use-names writes 'Escherichia coli (taxid 562)' in the taxid column
+_TAXID_RE = re.compile(r"\(taxid (\d+)\)\s*$")
+
+_STORES = {}
+_STORES_LOCK = Lock()
+
+def read_store_path(barcode_agg_dir: str, barcode: str) -> str:
+    return os.path.join(barcode_agg_dir, f"master_{barcode}.reads")
+
+def get_read_store(directory: str, config: configparser.ConfigParser = None) -> "ReadAssignmentStore":
+    """Returns the process-wide store for directory, opening it on first use."""
+    directory = os.path.abspath(directory)
+    with _STORES_LOCK:
+        if directory not in _STORES:
+            fmt = config.get('ReadStore', 'format', fallback='auto') if config is not None else 'auto'
+            _STORES[directory] = ReadAssignmentStore(directory, fmt=fmt)
+        return _STORES[directory]
+
+def _taxid(value: str) -> int:
+    match = _TAXID_RE.search(value)
+    try:
+        return int(match.group(1) if match else value)
+    except ValueError:
+        return 0
+
+def _length(value: str) -> int:
+    # Paired reads are reported as '150|148'
+    try:
+        return sum(int(part) for part in value.split('|'))
+    except ValueError:
+        return 0
+
+def parse_kraken_output(path: str):
+    """Yields (read_id, taxid, length) from a Kraken2 per-read output file, dropping the k-mer LCA column."""
+    with open(path, 'r', newline='') as f:
+        for row in csv.reader(f, delimiter='\t'):
+            if len(row) >= 4:
+                yield row[1], _taxid(row[2]), _length(row[3])
+
+class ReadAssignmentStore:
+    """
+    Per-barcode store of Kraken2 read assignments: read id, taxid, read length and batch,
+    one partition file per batch, replacing the ever-growing master_<barcode>.kraken2.tsv
+    (whose k-mer LCA column is most of its size).
+
+    Partitions are Parquet (zstd, sorted by taxid so row-group statistics let a taxid
+    filter skip most of the file) when pyarrow is installed, and gzip TSV otherwise.
+    A JSON manifest records each partition's row count and per-taxid counts, so taxid
+    scans open only the partitions that contain those taxa. Partitions and the manifest
+    are written atomically; writing a batch again replaces its partition.
+    """
+    def __init__(self, directory: str, fmt: str = 'auto'):
+        if fmt == 'parquet' and pq is None:
+            logger.warning("pyarrow is not installed; storing read assignments as gzip TSV.")
+        self.directory = directory
+        self.format = 'parquet' if fmt in ('auto', 'parquet') and pq is not None else 'tsv'
+        self._lock = Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    # --- Manifest ---
+
+    def _manifest_path(self) -> str:
+        return os.path.join(self.directory, MANIFEST)
+
+    def partitions(self) -> dict:
+        """{batch id: {file, format, rows, taxa: {taxid: reads}}} in the order batches were written."""
+        try:
+            with open(self._manifest_path()) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _write_manifest(self, partitions: dict):
+        tmp_path = self._manifest_path() + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(partitions, f)
+        os.replace(tmp_path, self._manifest_path())
+
+    # --- Writing ---
+
+    def write_batch(self, kraken_output: str, batch_id: str) -> int:
+        """Stores one batch's Kraken2 output as its partition. Returns the reads stored."""
+        rows = sorted(parse_kraken_output(kraken_output), key=lambda r: r[1])
+        name = re.sub(r"[^\w.-]", "_", batch_id) + (".parquet" if self.format == 'parquet' else ".tsv.gz")
+        path = os.path.join(self.directory, name)
+        tmp_path = path + ".tmp"
+        if self.format == 'parquet':
+            table = pa.table({
+                'read_id': pa.array([r[0] for r in rows], pa.string()),
+                'taxid': pa.array([r[1] for r in rows], pa.int32()),
+                'length': pa.array([r[2] for r in rows], pa.int32()),
+                'batch': pa.DictionaryArray.from_arrays(pa.array([0] * len(rows), pa.int32()), pa.array([batch_id])),
+            })
+            pq.write_table(table, tmp_path, compression='zstd', row_group_size=128 * 1024)
+        else:
+            with gzip.open(tmp_path, 'wt', newline='', compresslevel=6) as f:
+                writer = csv.writer(f, delimiter='\t', lineterminator='\n')
+                writer.writerows((read_id, taxid, length, batch_id) for read_id, taxid, length in rows)
+        os.replace(tmp_path, path)
+
+        taxa = {}
+        for _, taxid, _ in rows:
+            taxa[taxid] = taxa.get(taxid, 0) + 1
+        with self._lock:
+            partitions = self.partitions()
+            old = partitions.pop(batch_id, None)
+            partitions[batch_id] = {'file': name, 'format': self.format, 'rows': len(rows),
+                                    'taxa': {str(t): n for t, n in taxa.items()}}
+            self._write_manifest(partitions)
+            if old and old['file'] != name:
+                os.remove(os.path.join(self.directory, old['file']))
+        return len(rows)
+
+    # --- Reading ---
+
+    def taxid_counts(self) -> dict:
+        """{taxid: reads} over every batch, from the manifest alone."""
+        counts = {}
+        for partition in self.partitions().values():
+            for taxid, n in partition['taxa'].items():
+                counts[int(taxid)] = counts.get(int(taxid), 0) + n
+        return counts
+
+    def disk_bytes(self) -> int:
+        return sum(os.path.getsize(os.path.join(self.directory, p['file'])) for p in self.partitions().values())
+
+    def _selected(self, taxids, batches) -> list:
+        selected = []
+        for batch_id, partition in self.partitions().items():
+            if batches is not None and batch_id not in batches:
+                continue
+            if taxids is not None and not any(str(t) in partition['taxa'] for t in taxids):
+                continue
+            selected.append(partition)
+        return selected
+
+    def iter_chunks(self, taxids=None, batches=None, chunk_rows: int = 65536):
+        """
+        Streams {column: list} chunks of at most chunk_rows reads, optionally limited to
+        some taxids and batch ids. Partitions without those taxa are never opened.
+        """
+        taxids = None if taxids is None else {int(t) for t in taxids}
+        for partition in self._selected(taxids, batches):
+            path = os.path.join(self.directory, partition['file'])
+            if partition['format'] == 'parquet':
+                if pq is None:
+                    raise RuntimeError(f"pyarrow is needed to read {path}")
+                parquet = pq.ParquetFile(path)
+                row_groups = list(range(parquet.num_row_groups))
+                if taxids is not None:
+                    # Rows are sorted by taxid, so each row group covers a narrow taxid range
+                    taxid_column = parquet.schema_arrow.get_field_index('taxid')
+                    def may_contain(i):
+                        stats = parquet.metadata.row_group(i).column(taxid_column).statistics
+                        return stats is None or not stats.has_min_max or any(stats.min <= t <= stats.max for t in taxids)
+                    row_groups = [i for i in row_groups if may_contain(i)]
+                if not row_groups:
+                    continue
+                for record_batch in parquet.iter_batches(batch_size=chunk_rows, row_groups=row_groups, columns=COLUMNS):
+                    chunk = record_batch.to_pydict()
+                    if taxids is not None:
+                        keep = [i for i, t in enumerate(chunk['taxid']) if t in taxids]
+                        if not keep:
+                            continue
+                        chunk = {c: [chunk[c][i] for i in keep] for c in COLUMNS}
+                    yield chunk
+            else:
+                chunk = {c: [] for c in COLUMNS}
+                with gzip.open(path, 'rt', newline='') as f:
+                    for read_id, taxid, length, batch_id in csv.reader(f, delimiter='\t'):
+                        taxid = int(taxid)
+                        if taxids is not None and taxid not in taxids:
+                            continue
+                        for column, value in zip(COLUMNS, (read_id, taxid, int(length), batch_id)):
+                            chunk[column].append(value)
+                        if len(chunk['read_id']) >= chunk_rows:
+                            yield chunk
+                            chunk = {c: [] for c in COLUMNS}
+                if chunk['read_id']:
+                    yield chunk
+
+    def iter_frames(self, taxids=None, batches=None, chunk_rows: int = 65536):
+        """iter_chunks as pandas DataFrames."""
+        import pandas as pd
+        for chunk in self.iter_chunks(taxids=taxids, batches=batches, chunk_rows=chunk_rows):
+            yield pd.DataFrame(chunk, columns=COLUMNS)
+
+    # --- Migration ---
+
+    def import_legacy(self, master_kraken_tsv: str) -> int:
+        """Moves an existing master_<barcode>.kraken2.tsv into the store as batch 'legacy' and deletes it."""
+        rows = self.write_batch(master_kraken_tsv, "legacy")
+        os.remove(master_kraken_tsv)
+        logger.info(f"Imported {rows} reads from {os.path.basename(master_kraken_tsv)} into {self.directory}.")
+        return rows
@@ -0,0 +1,170 @@
+# resource_planner.py
+import os
+import math
+import logging
+import configparser
+from threading import Lock
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+GB = 1024**3
+
+# Fixed-size processes keep these settings; the others are sized by the plan
+_STATIC = {
+    'COMBINE_FASTQ': {'cpus': 1, 'memory_gb': 1},
+    'RUN_QC_FASTPLONG': {'cpus': 1, 'memory_gb': 4},
+}
+# Thread counts past these stop paying off for a single sample
+_MAX_THREADS = {'REMOVE_HOST': 16, 'RUN_KRAKEN2': 16, 'RUN_AMR': 8}
+
+_PLANNERS = {}
+_PLANNERS_LOCK = Lock()
+
+def get_resource_planner(config: configparser.ConfigParser):
+    """Returns the process-wide planner, or None when [Resources] planning is disabled."""
+    if not config.getboolean('Resources', 'enabled', fallback=False):
+        return None
+    with _PLANNERS_LOCK:
+        if 'default' not in _PLANNERS:
+            _PLANNERS['default'] = ResourcePlanner.from_config(config)
+        return _PLANNERS['default']
+
+def detected_cpus() -> int:
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+def detected_memory_bytes() -> int:
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemTotal:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+def _step(config: configparser.ConfigParser, step: str) -> bool:
+    return config.getboolean('WorkflowSteps', step, fallback=False)
+
+def _kraken_task_memory(config: configparser.ConfigParser) -> float:
+    """GB per RUN_KRAKEN2 task: small with a shared /dev/shm database, the whole hash table otherwise."""
+    if config.getboolean('KrakenParams', 'memory_mapping', fallback=False):
+        return 2
+    hash_file = os.path.join(config.get('DatabasePaths', 'kraken_db', fallback=''), "hash.k2d")
+    try:
+        return math.ceil(os.path.getsize(hash_file) / GB) + 1
+    except OSError:
+        return 4
+
+class ResourcePlanner:
+    """
+    Sizes each Nextflow run for the host instead of relying on nextflow.config's static
+    task cpus. A run gets a share of the cores and memory (what its batch can use, but
+    no less than an even split between pipeline_slots concurrent runs). Within that
+    share each heavy process gets:
+
+      - maxForks: at most one task per barcode, and no more parallel tasks than fit in
+        memory (parallel minimap2 host alignments each hold the whole index)
+      - cpus: the run's cores divided between those forks, capped by what the barcode's
+        input can use (bytes_per_thread) and by where the tool stops scaling
+
+    The run's executor cpus/memory are set to its share so the local executor packs
+    stages of different barcodes without oversubscribing the host.
+    """
+    def __init__(self, cpus: int, memory_bytes: int, slots: int = 1, host_memory_gb: float = 12,
+                 amr_memory_gb: float = 8, bytes_per_thread: int = 25 * 1024**2):
+        self.cpus = max(1, cpus)
+        self.memory_bytes = memory_bytes
+        self.slots = max(1, slots)
+        self.host_memory_gb = host_memory_gb
+        self.amr_memory_gb = amr_memory_gb
+        self.bytes_per_thread = bytes_per_thread
+        self._active = {}  # run key -> (cpus, memory bytes)
+        self._lock = Lock()
+
+    @classmethod
+    def from_config(cls, config: configparser.ConfigParser) -> "ResourcePlanner":
+        section = 'Resources'
+        cpus = config.getint(section, 'cpus', fallback=0) or detected_cpus()
+        memory_gb = config.getfloat(section, 'memory_gb', fallback=0) or detected_memory_bytes() / GB
+        planner = cls(
+            cpus=cpus - config.getint(section, 'reserve_cpus', fallback=1),
+            memory_bytes=int((memory_gb - config.getfloat(section, 'reserve_memory_gb', fallback=4)) * GB),
+            slots=config.getint('Settings', 'pipeline_slots', fallback=1),
+            host_memory_gb=config.getfloat(section, 'host_alignment_memory_gb', fallback=12),
+            amr_memory_gb=config.getfloat(section, 'amr_memory_gb', fallback=8),
+            bytes_per_thread=int(config.getfloat(section, 'mb_per_thread', fallback=25) * 1024**2),
+        )
+        logger.info(f"Resource planner: {planner.cpus} cores and {planner.memory_bytes / GB:.0f} GB "
+                    f"for up to {planner.slots} concurrent run(s).")
+        return planner
+
+    def _processes(self, config: configparser.ConfigParser) -> dict:
+        """Heavy processes this workflow runs, with their memory per task in GB."""
+        processes = {}
+        if _step(config, 'run_host_depletion'):
+            processes['REMOVE_HOST'] = self.host_memory_gb
+        if _step(config, 'run_classification') and _step(config, 'run_kraken'):
+            processes['RUN_KRAKEN2'] = _kraken_task_memory(config)
+        if _step(config, 'run_classification') and _step(config, 'run_amr'):
+            processes['RUN_AMR'] = self.amr_memory_gb
+        return processes
+
+    def allocate(self, key: str, fastq_files: list, config: configparser.ConfigParser) -> dict:
+        """Reserves a share of the host for one run and returns its plan; release(key) when the run ends."""
+        barcodes = {os.path.basename(os.path.dirname(f)) for f in fastq_files}
+        wanted = {b.strip() for b in config.get('Settings', 'barcodes', fallback='').split(',') if b.strip()}
+        n_barcodes = max(1, len(barcodes & wanted) if wanted else len(barcodes))
+        batch_bytes = sum(os.path.getsize(f) for f in fastq_files if os.path.exists(f))
+        processes = self._processes(config)
+
+        # Threads one barcode's input can keep busy, and what the whole batch could use
+        useful_threads = max(1, math.ceil(batch_bytes / n_barcodes / self.bytes_per_thread))
+        demand = n_barcodes * min(useful_threads, max([_MAX_THREADS[p] for p in processes] or [1]))
+        largest_task = max(list(processes.values()) + [s['memory_gb'] for s in _STATIC.values()]) * GB
+
+        with self._lock:
+            free_cpus = self.cpus - sum(c for c, _ in self._active.values())
+            fair_cpus = max(1, self.cpus // self.slots)
+            run_cpus = max(1, min(self.cpus, max(fair_cpus, min(free_cpus, demand))))
+            # Memory follows the core share, but every task must still fit in the run
+            run_memory = min(self.memory_bytes, max(largest_task, self.memory_bytes * run_cpus // self.cpus))
+            self._active[key] = (run_cpus, run_memory)
+
+        plan = {'executor': {'cpus': run_cpus, 'memory_gb': int(run_memory // GB)}, 'process': dict(_STATIC)}
+        for process, memory_gb in processes.items():
+            forks = max(1, min(n_barcodes, int(run_memory // (memory_gb * GB)) or 1))
+            cpus = max(1, min(run_cpus // forks, useful_threads, _MAX_THREADS[process]))
+            plan['process'][process] = {'cpus': cpus, 'memory_gb': memory_gb, 'maxForks': forks}
+
+        REGISTRY.set("nanort_planned_cpus", sum(c for c, _ in self._active.values()),
+                     help_text="Cores reserved by running Nextflow runs")
+        logger.info(f"Resource plan for {n_barcodes} barcode(s), {batch_bytes / 1024**2:.0f} MB: "
+                    f"{run_cpus} cores, {run_memory / GB:.0f} GB; " +
+                    ", ".join(f"{p} {s['cpus']}x{s['maxForks']}" for p, s in plan['process'].items() if 'maxForks' in s))
+        return plan
+
+    def release(self, key: str):
+        with self._lock:
+            self._active.pop(key, None)
+            REGISTRY.set("nanort_planned_cpus", sum(c for c, _ in self._active.values()),
+                         help_text="Cores reserved by running Nextflow runs")
+
+def write_resource_config(config_path: str, plan: dict):
+    """Writes a plan as a Nextflow config for -c; its withName settings override nextflow.config's."""
+    lines = ["executor {",
+             f"    cpus = {plan['executor']['cpus']}",
+             f"    memory = '{plan['executor']['memory_gb']} GB'",
+             "}", "process {"]
+    for process, settings in plan['process'].items():
+        directives = [f"cpus = {settings['cpus']}", f"memory = '{settings['memory_gb']:g} GB'"]
+        if 'maxForks' in settings:
+            directives.append(f"maxForks = {settings['maxForks']}")
+        lines.append(f"    withName: '{process}' {{ {'; '.join(directives)} }}")
+    lines.append("}")
+    with open(config_path, 'w') as f:
+        f.write("\n".join(lines) + "\n")
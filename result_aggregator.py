@@ -7,10 +7,22 @@ import glob
 import configparser
 import shutil
 import gzip
+import json
+import time
+import multiprocessing
 import pandas as pd
 from datetime import datetime
+from threading import Lock
 from typing import Optional, Tuple
+from concurrent.futures import ProcessPoolExecutor, CancelledError, as_completed
+from concurrent.futures.process import BrokenProcessPool
 from minimizer_tracker import MinimizerTracker
+from read_store import get_read_store, read_store_path
+from kreport_merger import merge_into_master
+from bracken_estimator import get_bracken_estimator, write_bracken_output
+from timeseries_store import get_series
+from metrics import REGISTRY
+import child_processes
 from scipy import stats
 
 # --- CONFIGURATION FLAGS ---
@@ -20,69 +32,98 @@ CLEANUP_BATCH_FOLDERS = True
 # Define the absolute path to the project's root directory based on this script's location
 PROJECT_ROOT = os.path.dirname(os.path.abspath(__file__))
 
-# Check for the combiner script's existence on startup
-COMBINE_KREPORTS_PATH = os.path.join(PROJECT_ROOT, 'combine_kreports.py')
-if not os.path.exists(COMBINE_KREPORTS_PATH):
-    print(f"ERROR: Could not find 'combine_kreports.py' at the expected path: {COMBINE_KREPORTS_PATH}")
-    exit(1)
-
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 # --- Helper functions for file finding and manipulation ---
 
+def _subprocess_timeout(config: configparser.ConfigParser) -> float:
+    """Timeout for Bracken and the plotting scripts (0 disables it)."""
+    return config.getfloat('Settings', 'subprocess_timeout_seconds', fallback=0)
+
 def _get_barcodes_in_batch(batch_result_dir: str) -> list:
     kraken_dir = os.path.join(batch_result_dir, "3_classification", "kraken2")
     if not os.path.isdir(kraken_dir): return []
     return sorted([d for d in os.listdir(kraken_dir) if os.path.isdir(os.path.join(kraken_dir, d))])
 
-def _concatenate_files(source_path: str, destination_path: str):
+def _store_read_assignments(source_path: str, barcode_agg_dir: str, barcode: str, batch_id: str,
+                            config: configparser.ConfigParser):
+    """Adds a batch's per-read Kraken2 assignments to the barcode's read store."""
     if not os.path.exists(source_path):
-        logger.warning(f"Source file for concatenation not found: {source_path}")
+        logger.warning(f"Kraken2 output not found: {source_path}")
         return
     try:
-        with open(source_path, 'rb') as f_src, open(destination_path, 'ab') as f_dst:
-            shutil.copyfileobj(f_src, f_dst)
-        logger.info(f"Appended reads to {os.path.basename(destination_path)}")
-    except IOError as e:
-        logger.error(f"Error concatenating {os.path.basename(source_path)}: {e}")
-
-def _combine_kraken_reports_executable(new_report: str, master_report: str) -> bool:
+        store = get_read_store(read_store_path(barcode_agg_dir, barcode), config)
+        # Runs started before the read store still have the concatenated TSV
+        legacy_tsv = os.path.join(barcode_agg_dir, f"master_{barcode}.kraken2.tsv")
+        if os.path.exists(legacy_tsv):
+            store.import_legacy(legacy_tsv)
+        rows = store.write_batch(source_path, batch_id)
+        logger.info(f"Stored {rows} read assignments for {barcode} ({store.disk_bytes() / 1024**2:.1f} MB on disk)")
+    except (IOError, OSError, ValueError) as e:
+        logger.error(f"Error storing read assignments from {os.path.basename(source_path)}: {e}")
+
+def _combine_kraken_reports(new_report: str, master_report: str, batch_id: str) -> bool:
+    """Merges a batch report into the master report, once per batch. Returns True if the master includes it."""
     if not os.path.exists(new_report):
         logger.warning(f"New report file not found: {new_report}")
         return False
-    combiner_script = COMBINE_KREPORTS_PATH # Use the absolute path constant
-    temp_output = master_report + ".tmp"
-    cmd = []
-    if os.path.exists(master_report) and os.path.getsize(master_report) > 0:
-        # Use sys.executable to ensure the correct python interpreter is used
-        cmd = [sys.executable, combiner_script, "--report-file", master_report, new_report, "--output", temp_output, "--no-headers", "--only-combined"]
-    else:
-        shutil.copy(new_report, temp_output)
     try:
-        if cmd:
-            subprocess.run(cmd, check=True, capture_output=True, text=True)
-        shutil.move(temp_output, master_report)
+        merge_into_master(new_report, master_report, batch_id=batch_id)
         return True
-    except subprocess.CalledProcessError as e:
-        logger.error(f"combine_kreports.py failed. Stderr:\n{e.stderr}")
-        if os.path.exists(temp_output): os.remove(temp_output)
+    except (IOError, OSError, ValueError, IndexError) as e:
+        logger.error(f"Merging {os.path.basename(new_report)} into {os.path.basename(master_report)} failed: {e}")
         return False
 
-def _rerun_bracken(master_report_path: str, kraken_db_path: str, output_dir: str, barcode: str, config: configparser.ConfigParser) -> Optional[str]:
-    logger.info(f"Re-running Bracken for {barcode}...")
-    bracken_output = os.path.join(output_dir, f"master_{barcode}.bracken_sp.tsv")
+def _bracken_output_path(master_report_path: str, barcode: str) -> str:
+    return os.path.join(os.path.dirname(master_report_path), f"master_{barcode}.bracken_sp.tsv")
+
+def _run_bracken_cli(master_report_path: str, kraken_db_path: str, barcode: str, config: configparser.ConfigParser) -> Optional[str]:
+    bracken_output = _bracken_output_path(master_report_path, barcode)
     read_length = config.getint('KrakenParams', 'read_len', fallback=150)
-    command = ["bracken", "-d", kraken_db_path, "-i", master_report_path, "-o", bracken_output, "-r", str(read_length), "-l", "S", "-t", "10"]
+    threshold = config.getint('KrakenParams', 'bracken_threshold', fallback=10)
+    command = ["bracken", "-d", kraken_db_path, "-i", master_report_path, "-o", bracken_output, "-r", str(read_length), "-l", "S", "-t", str(threshold)]
     try:
-        subprocess.run(command, check=True, capture_output=True, text=True)
+        child_processes.run(command, timeout=_subprocess_timeout(config), check=True, capture_output=True, text=True)
         logger.info(f"Bracken completed successfully for {barcode}.")
         return bracken_output
     except Exception as e:
         logger.error(f"Bracken failed for {barcode}: {e}")
         return None
 
+def _rerun_bracken(master_reports: dict, config: configparser.ConfigParser) -> dict:
+    """
+    Re-estimates species abundances for {barcode: master report} in one in-process pass.
+    Returns {barcode: Bracken output path, or None if it failed}. Falls back to the bracken
+    CLI, one barcode at a time, if the in-process estimator cannot run.
+    """
+    if not master_reports:
+        return {}
+    logger.info(f"Re-running Bracken for {', '.join(master_reports)}...")
+    threshold = config.getint('KrakenParams', 'bracken_threshold', fallback=10)
+    bracken_start = time.monotonic()
+    outputs = {}
+    try:
+        estimates = get_bracken_estimator(config).estimate(master_reports, level='S', threshold=threshold)
+        for barcode, rows in estimates.items():
+            if rows is None:
+                logger.error(f"Bracken failed for {barcode}: no species with at least {threshold} reads.")
+                outputs[barcode] = None
+                continue
+            outputs[barcode] = _bracken_output_path(master_reports[barcode], barcode)
+            write_bracken_output(rows, outputs[barcode], level='S')
+    except (IOError, OSError, ValueError) as e:
+        logger.warning(f"In-process Bracken failed ({e}); running the bracken CLI instead.")
+        kraken_db_path = config.get('DatabasePaths', 'kraken_db')
+        outputs = {barcode: _run_bracken_cli(report, kraken_db_path, barcode, config)
+                   for barcode, report in master_reports.items()}
+    elapsed = (time.monotonic() - bracken_start) / len(master_reports)
+    for barcode in master_reports:
+        REGISTRY.observe("nanort_bracken_seconds", elapsed, {'barcode': barcode},
+                         help_text="Wall time of the Bracken re-estimation per barcode")
+    return outputs
+
 # --- NEW function for safe, atomic file writing ---
 def _safe_write_csv(df: pd.DataFrame, path: str):
     """Atomically writes a dataframe to a CSV file to prevent race conditions."""
@@ -98,49 +139,55 @@ def _safe_write_csv(df: pd.DataFrame, path: str):
 
 # --- MODIFIED functions for updating historical data ---
 
-def _update_cumulative_data(bracken_file: str, barcode: str, data_log_path: str):
-    """Reads a bracken file and updates the cumulative species data log safely."""
+def _update_cumulative_data(bracken_file: str, barcode: str, data_log_path: str, batch_id: str = None):
+    """Appends a bracken file's species estimates to the cumulative species time series."""
     now = datetime.now().isoformat()
     try:
-        # Prepare new data
         new_df = pd.read_csv(bracken_file, sep='\t')
-        new_df = new_df[['name', 'new_est_reads']]
-        new_df['timestamp'] = now
-        new_df['barcode'] = barcode
-        new_df = new_df.rename(columns={'new_est_reads': 'cumulative_reads'})
-        
-        # Read existing data, append new, and safe-write
-        existing_df = pd.DataFrame()
-        if os.path.exists(data_log_path):
-            existing_df = pd.read_csv(data_log_path)
-        
-        combined_df = pd.concat([existing_df, new_df], ignore_index=True)
-        _safe_write_csv(combined_df, data_log_path)
-
+        get_series(data_log_path).append(barcode, now, dict(zip(new_df['name'], new_df['new_est_reads'])), batch_id=batch_id)
     except Exception as e:
         logger.error(f"Failed to update cumulative data: {e}")
 
-def _update_rarefaction_data(bracken_file: str, barcode: str, data_log_path: str):
-    """Calculates unique species and updates the rarefaction data log safely."""
+def _update_rarefaction_data(bracken_file: str, barcode: str, data_log_path: str, batch_id: str = None):
+    """Calculates unique species and appends them to the rarefaction time series."""
     now = datetime.now().isoformat()
     try:
-        # Prepare new data point
         df = pd.read_csv(bracken_file, sep='\t')
         unique_species_count = df[df['new_est_reads'] > 0]['name'].nunique()
-        new_data = pd.DataFrame([{'timestamp': now, 'barcode': barcode, 'unique_species_count': unique_species_count}])
-        
-        # Read existing data, append new, and safe-write
-        existing_df = pd.DataFrame()
-        if os.path.exists(data_log_path):
-            existing_df = pd.read_csv(data_log_path)
-            
-        combined_df = pd.concat([existing_df, new_data], ignore_index=True)
-        _safe_write_csv(combined_df, data_log_path)
-        
-        logger.info(f"Updated rarefaction data log for {barcode}: {unique_species_count} species.")
+        if get_series(data_log_path).append(barcode, now, unique_species_count, batch_id=batch_id):
+            logger.info(f"Updated rarefaction data log for {barcode}: {unique_species_count} species.")
     except Exception as e:
         logger.error(f"Failed to update rarefaction data: {e}")
 
+def _write_json(path: str, data):
+    with open(path + ".tmp", 'w') as f:
+        json.dump(data, f)
+    os.replace(path + ".tmp", path)
+
+def _append_csv_once(df: pd.DataFrame, path: str, batch_id: str, **to_csv_args):
+    """
+    Appends df to a CSV at most once per batch. Appends are recorded in <path>.batches.json;
+    a batch already appended is skipped, and an append that was interrupted before being
+    recorded is cut off the file (and written again when its batch is redone).
+    """
+    batches_path = path + ".batches.json"
+    try:
+        with open(batches_path) as f:
+            state = json.load(f)
+    except (IOError, ValueError):
+        state = {'batches': [], 'pending': None}
+    if batch_id in state['batches']:
+        logger.info(f"Rows from {batch_id} are already in {os.path.basename(path)}; skipping.")
+        return
+    pending = state.get('pending')
+    if pending and os.path.exists(path):
+        with open(path, 'r+b') as f:
+            f.truncate(pending['size'])
+    size = os.path.getsize(path) if os.path.exists(path) else 0
+    _write_json(batches_path, {'batches': state['batches'], 'pending': {'batch': batch_id, 'size': size}})
+    df.to_csv(path, mode='a', header=size == 0, **to_csv_args)
+    _write_json(batches_path, {'batches': state['batches'] + [batch_id], 'pending': None})
+
 def _calculate_trend(species_history: pd.DataFrame) -> Tuple[float, float]:
     """
     Performs linear regression on the historical data of a single species
@@ -171,7 +218,7 @@ def _calculate_trend(species_history: pd.DataFrame) -> Tuple[float, float]:
     except Exception:
         return 0.0, 1.0
 
-def _update_read_stats(batch_dir: str, barcode: str, agg_dir: str, config: configparser.ConfigParser):
+def _count_read_stats(batch_dir: str, barcode: str, config: configparser.ConfigParser) -> dict:
     """Counts reads directly from the pipeline outputs before they are deleted."""
     raw_pattern = os.path.join(batch_dir, "0_combined_fastq", barcode, "*.fastq.gz")
     host_pattern = os.path.join(batch_dir, "1_host_depletion", barcode, "*.fastq.gz")
@@ -211,23 +258,493 @@ def _update_read_stats(batch_dir: str, barcode: str, agg_dir: str, config: confi
     if not config.getboolean('WorkflowSteps', 'run_read_qc', fallback=False):
         batch_qc = batch_host
 
+    return {'raw': batch_raw, 'host_depleted': batch_host, 'qc': batch_qc}
+
+def _update_read_stats(agg_dir: str, batch_id: str, batch_counts: dict):
+    """
+    Records a batch's {barcode: counts from _count_read_stats} and rewrites read_stats.csv
+    as the totals. Counts are kept per batch in read_stats.batches.json, so recording a
+    batch again (an interrupted aggregation being redone) replaces its counts instead of
+    adding them twice.
+    """
+    if not batch_counts:
+        return
     stats_path = os.path.join(agg_dir, "read_stats.csv")
-    df = pd.read_csv(stats_path) if os.path.exists(stats_path) else pd.DataFrame(columns=['barcode', 'raw', 'host_depleted', 'qc'])
+    batches_path = os.path.join(agg_dir, "read_stats.batches.json")
+    try:
+        with open(batches_path) as f:
+            batches = json.load(f)
+    except (IOError, ValueError):
+        batches = {}
+        # Totals counted before batches were recorded
+        if os.path.exists(stats_path):
+            batches['legacy'] = {str(row['barcode']): {c: int(row[c]) for c in ('raw', 'host_depleted', 'qc')}
+                                 for _, row in pd.read_csv(stats_path).iterrows()}
+    batches.setdefault(batch_id, {}).update(batch_counts)
+    with open(batches_path + ".tmp", 'w') as f:
+        json.dump(batches, f)
+    os.replace(batches_path + ".tmp", batches_path)
+
+    totals = {}
+    for counts_by_barcode in batches.values():
+        for barcode, counts in counts_by_barcode.items():
+            total = totals.setdefault(barcode, {'raw': 0, 'host_depleted': 0, 'qc': 0})
+            for column, count in counts.items():
+                total[column] += count
+    df = pd.DataFrame([{'barcode': barcode, **total} for barcode, total in totals.items()],
+                      columns=['barcode', 'raw', 'host_depleted', 'qc'])
+    _safe_write_csv(df, stats_path)
 
-    if barcode in df['barcode'].values:
-        df.loc[df['barcode'] == barcode, 'raw'] += batch_raw
-        df.loc[df['barcode'] == barcode, 'host_depleted'] += batch_host
-        df.loc[df['barcode'] == barcode, 'qc'] += batch_qc
-    else:
-        new_row = pd.DataFrame([{'barcode': barcode, 'raw': batch_raw, 'host_depleted': batch_host, 'qc': batch_qc}])
-        df = pd.concat([df, new_row], ignore_index=True)
+# --- Per-barcode aggregation ---
 
-    _safe_write_csv(df, stats_path)
+def _merge_barcode(batch_result_dir: str, barcode: str, aggregated_output_dir: str, config: configparser.ConfigParser) -> Tuple[Optional[str], Optional[dict]]:
+    """
+    Folds a barcode's batch reads and report into its master files. Returns the master
+    report (None if the merge failed) and the batch's read counts for read_stats.csv.
+    """
+    logger.info(f"--- Merging barcode: {barcode} ---")
+
+    barcode_batch_dir = os.path.join(batch_result_dir, "3_classification", "kraken2", barcode)
+    barcode_agg_dir = os.path.join(aggregated_output_dir, barcode)
+    os.makedirs(barcode_agg_dir, exist_ok=True)
+
+    new_kraken_tsv = os.path.join(barcode_batch_dir, f"{barcode}.kraken2.tsv")
+    batch_id = os.path.basename(os.path.normpath(batch_result_dir))
+    _store_read_assignments(new_kraken_tsv, barcode_agg_dir, barcode, batch_id, config)
+
+    new_report_tsv = os.path.join(barcode_batch_dir, f"{barcode}.report.tsv")
+    master_report_tsv = os.path.join(barcode_agg_dir, f"master_{barcode}.report.tsv")
+    
+    # --- Tally Read Stats Before Cleanup ---
+    try:
+        read_counts = _count_read_stats(batch_result_dir, barcode, config)
+    except Exception as e:
+        logger.error(f"Failed to count reads for {barcode}: {e}")
+        read_counts = None
+
+    return (master_report_tsv if _combine_kraken_reports(new_report_tsv, master_report_tsv, batch_id) else None), read_counts
+
+def _aggregate_barcode(batch_result_dir: str, barcode: str, aggregated_output_dir: str, config: configparser.ConfigParser,
+                       cumulative_data_log: str, rarefaction_data_log: str, now_timestamp: str,
+                       master_report_tsv: Optional[str], final_bracken_output: Optional[str]):
+    """Updates a merged barcode's analysis, plots and AMR outputs from its master report and Bracken estimate."""
+    logger.info(f"--- Processing barcode: {barcode} ---")
+
+    barcode_batch_dir = os.path.join(batch_result_dir, "3_classification", "kraken2", barcode)
+    barcode_agg_dir = os.path.join(aggregated_output_dir, barcode)
+    # Keys the appends below, so redoing an interrupted aggregation does not repeat them
+    batch_id = os.path.basename(os.path.normpath(batch_result_dir))
+
+    if master_report_tsv:
+        kraken_db_path = config.get('DatabasePaths', 'kraken_db')
+
+        if final_bracken_output:
+            try:
+                logger.info(f"--- Generating combined analysis for {barcode} ---")
+                
+                # --- NEW DYNAMIC TAXONOMY RESOLUTION ---
+                taxonomy_dir = config.get('DatabasePaths', 'taxonomy_dir', fallback=None)
+                
+                # 1. Did the user specify a valid dir in config?
+                if taxonomy_dir and os.path.exists(os.path.join(taxonomy_dir, "nodes.dmp")):
+                    taxonomy_path = os.path.join(taxonomy_dir, "nodes.dmp")
+                else:
+                    # 2. Look in standard kraken_db/taxonomy/nodes.dmp
+                    # 3. Look in root kraken_db/nodes.dmp
+                    # 4. Fallback to the project's internal scripts/kraken2/data/nodes.dmp backup
+                    p1 = os.path.join(kraken_db_path, "taxonomy", "nodes.dmp")
+                    p2 = os.path.join(kraken_db_path, "nodes.dmp")
+                    p3 = os.path.join(PROJECT_ROOT, "scripts", "kraken2", "data", "nodes.dmp")
+                    
+                    if os.path.exists(p1): taxonomy_path = p1
+                    elif os.path.exists(p2): taxonomy_path = p2
+                    else: taxonomy_path = p3
+                # ----------------------------------------
+                    
+                state_file_path = os.path.join(barcode_agg_dir, "minimizer_state.json")
+                raw_minimizer_file = os.path.join(barcode_batch_dir, f"{barcode}.minimizers.tsv")
+                
+                tracker = MinimizerTracker(taxonomy_path=taxonomy_path, state_path=state_file_path)
+                tracker.update_with_batch(raw_minimizer_file=raw_minimizer_file, batch_id=batch_id)
+                
+                current_report_df = tracker.generate_confidence_report(
+                    bracken_report_file=final_bracken_output,
+                    timestamp=now_timestamp 
+                )
+                
+                if current_report_df.empty:
+                    logger.warning(f"No species-level data for {barcode} in this batch. Analysis not updated.")
+                    return
+
+                combined_report_path = os.path.join(barcode_agg_dir, f"master_{barcode}.combined_analysis.tsv")
+                historical_df = pd.DataFrame()
+                if os.path.exists(combined_report_path):
+                    historical_df = pd.read_csv(combined_report_path, sep='\t')
+
+                slopes = []
+                p_values = []
+                for _, current_row in current_report_df.iterrows():
+                    taxid = current_row['taxonomy_id']
+                    
+                    species_history = pd.DataFrame()
+                    if not historical_df.empty:
+                        species_history = historical_df[historical_df['taxonomy_id'] == taxid]
+                    
+                    full_history = pd.concat([species_history, pd.DataFrame([current_row])], ignore_index=True)
+                    slope, p_value = _calculate_trend(full_history)
+                    slopes.append(slope)
+                    p_values.append(p_value)
+
+                current_report_df['regression_slope'] = slopes
+                current_report_df['p_value'] = p_values
+
+                cols_order = [
+                    'timestamp', 'name', 'taxonomy_id', 
+                    'cumulative_bracken_reads', 'cumulative_total_minimizers', 'cumulative_distinct_minimizers',
+                    'diversity_ratio', 'abundance_pct', 'complexity_pct', 'confidence_score',
+                    'regression_slope', 'p_value'
+                ]
+                final_df = current_report_df[cols_order]
+
+                _append_csv_once(final_df, combined_report_path, batch_id, sep='\t', index=False)
+                logger.info(f"Appended combined analysis report to {combined_report_path}")
+
+                tracker.save_state()
+                
+            except Exception as e:
+                logger.error(f"Analysis failed for {barcode}: {e}", exc_info=True)
+            
+            # Update interactive plot data files
+            _update_cumulative_data(final_bracken_output, barcode, cumulative_data_log, batch_id)
+            _update_rarefaction_data(final_bracken_output, barcode, rarefaction_data_log, batch_id)
+
+            # Regenerate static cumulative plot for this barcode
+            cumulative_script = os.path.join(PROJECT_ROOT, "plotting", "cumulative_plot.py")
+            try:
+                child_processes.run([sys.executable, cumulative_script, cumulative_data_log, barcode, barcode_agg_dir],
+                                    timeout=_subprocess_timeout(config))
+            except subprocess.TimeoutExpired:
+                logger.error(f"Cumulative plot for {barcode} timed out.")
+
+            # --- AMR Aggregation ---
+            if config.getboolean('WorkflowSteps', 'run_amr', fallback=False):
+                try:
+                    batch_amr_dir = os.path.join(batch_result_dir, "3_classification", "amr", barcode)
+                    agg_amr_dir = os.path.join(barcode_agg_dir, "amr_batches")
+                    os.makedirs(agg_amr_dir, exist_ok=True)
+                    
+                    # Copy AMR batch text files
+                    if os.path.exists(batch_amr_dir):
+                        # Suffixed with the batch folder name for traceability
+                        for f in os.listdir(batch_amr_dir):
+                            if f.endswith(".txt"):
+                                base, ext = os.path.splitext(f)
+                                new_f = f"{base}_{batch_id}{ext}"
+                                shutil.copy2(os.path.join(batch_amr_dir, f), os.path.join(agg_amr_dir, new_f))
+                    
+                    # Glob all collected amr files
+                    all_amr_files = glob.glob(os.path.join(agg_amr_dir, "*.allele_mapping_data*.txt"))
+                    amr_df_list = []
+                    for amr_f in all_amr_files:
+                        try:
+                            df = pd.read_csv(amr_f, sep='\t')
+                            if not df.empty:
+                                amr_df_list.append(df)
+                        except Exception as e:
+                            logger.warning(f"Failed to read AMR file {amr_f}: {e}")
+                            
+                    if amr_df_list:
+                        master_amr = pd.concat(amr_df_list, ignore_index=True)
+                        
+                        # Dynamically map RGI column names which vary by version
+                        ref_col = next((c for c in ['Reference', 'Reference Sequence', 'Reference Allele', 'Allele'] if c in master_amr.columns), None)
+                        cov_col = next((c for c in ['Percent Coverage', 'Percentage Length of Reference Sequence', 'Coverage'] if c in master_amr.columns), None)
+                        depth_col = next((c for c in ['Depth', 'Average Depth'] if c in master_amr.columns), None)
+                        reads_col = next((c for c in ['All Mapped Reads', 'Mapped Reads', 'Completely Mapped Reads'] if c in master_amr.columns), None)
+                        
+                        # Extract the highly specific ARO Term, falling back to Gene Family if missing
+                        aro_col = next((c for c in ['ARO Term', 'ARO_Term', 'ARO Name', 'Gene'] if c in master_amr.columns), None)
+
+                        if not ref_col or not cov_col or not depth_col or not reads_col:
+                            logger.error(f"Missing required AMR columns. Found: {list(master_amr.columns)}")
+                        elif 'AMR Gene Family' in master_amr.columns:
+                            # Include ARO Term in the groupby so we don't lose the specific allele variants
+                            group_cols = [c for c in [aro_col, 'AMR Gene Family', 'Drug Class', 'Resistance Mechanism', ref_col] if c in master_amr.columns and c is not None]
+                            
+                            agg_amr = master_amr.groupby(group_cols).agg({
+                                reads_col: 'sum',
+                                cov_col: 'mean',
+                                depth_col: 'mean'
+                            }).reset_index()
+                            
+                            min_cov = config.getfloat('AmrParams', 'min_coverage', fallback=80.0)
+                            min_depth = config.getfloat('AmrParams', 'min_depth', fallback=2.0)
+                            
+                            # RGI leaves 'Depth' completely blank in some outputs. Cast to numeric and use reads_col instead.
+                            agg_amr[cov_col] = pd.to_numeric(agg_amr[cov_col], errors='coerce').fillna(0)
+                            agg_amr[reads_col] = pd.to_numeric(agg_amr[reads_col], errors='coerce').fillna(0)
+
+                            filtered_amr = agg_amr[(agg_amr[cov_col] >= min_cov) & 
+                                                   (agg_amr[reads_col] >= min_depth)]
+                                                   
+                            amr_summary_path = os.path.join(barcode_agg_dir, f"master_{barcode}.amr_summary.csv")
+                            _safe_write_csv(filtered_amr, amr_summary_path)
+                            logger.info(f"Aggregated AMR data saved to {amr_summary_path}")
+
+                            # --- Batch Read-Level Join (Kraken + AMR BAM) ---
+                            batch_kraken_tsv = os.path.join(barcode_batch_dir, f"{barcode}.kraken2.tsv")
+                            batch_bam_files = glob.glob(os.path.join(batch_amr_dir, "*.bam"))
+                            master_join_path = os.path.join(barcode_agg_dir, f"master_{barcode}.amr_reads.csv")
+                            
+                            # Ensure absolute path to samtools to bypass PATH drops in non-interactive python shells
+                            samtools_bin = os.path.join(PROJECT_ROOT, "nextflow_pipeline", "bin", "conda-env", "bin", "samtools")
+                            if not os.path.exists(samtools_bin):
+                                samtools_bin = "samtools"
+
+                            if os.path.exists(batch_kraken_tsv) and batch_bam_files:
+                                try:
+                                    k_df = pd.read_csv(batch_kraken_tsv, sep='\t', header=None, usecols=[1, 2], names=['ReadID', 'TaxID'])
+                                    
+                                    # Clean TaxID: Handle Kraken's '--use-names' flag outputs like 'Staphylococcus aureus (taxid 1280)'
+                                    extracted_tax = k_df['TaxID'].astype(str).str.extract(r'taxid (\d+)')
+                                    k_df['TaxID'] = extracted_tax[0].fillna(k_df['TaxID'])
+                                    
+                                    bam_records = []
+                                    for bam in batch_bam_files:
+                                        # Execute robustly using list arguments instead of shell pipe
+                                        res = child_processes.run([samtools_bin, "view", "-F", "4", bam], capture_output=True, text=True)
+                                        for line in res.stdout.strip().split('\n'):
+                                            parts = line.split('\t')
+                                            if len(parts) >= 3:
+                                                bam_records.append({'ReadID': parts[0], 'Allele': parts[2]})
+                                    
+                                    if bam_records:
+                                        bam_df = pd.DataFrame(bam_records)
+                                        joined_df = pd.merge(bam_df, k_df, on='ReadID', how='left')
+                                        # Coerce the safely extracted string back into an integer
+                                        joined_df['TaxID'] = pd.to_numeric(joined_df['TaxID'], errors='coerce').fillna(0).astype(int)
+                                        _append_csv_once(joined_df, master_join_path, batch_id, index=False)
+                                except Exception as e:
+                                    logger.warning(f"Failed to join batch reads for Antibiogram: {e}")
+
+                            # --- Generate Antibiogram JSON ---
+                            if not filtered_amr.empty:
+                                try:
+                                    import json
+                                    antibiogram = {}
+                                    tax_dict = {0: "Unassigned / Mobile Elements"}
+                                    if os.path.exists(master_report_tsv):
+                                        rep_df = pd.read_csv(master_report_tsv, sep='\t', header=None, names=['pct', 'reads', 'lreads', 'lvl', 'taxid', 'name'])
+                                        tax_dict.update(dict(zip(rep_df['taxid'], rep_df['name'].str.strip())))
+                                        
+                                    # # BRACKEN FILTER: Get validated species names for filtering and strain-rollup
+                                    # allowed_species_names = set()
+                                    # if final_bracken_output and os.path.exists(final_bracken_output):
+                                    #     try:
+                                    #         b_df = pd.read_csv(final_bracken_output, sep='\t')
+                                    #         if 'name' in b_df.columns and 'new_est_reads' in b_df.columns:
+                                    #             allowed_species_names = set(b_df[b_df['new_est_reads'] > 0]['name'].str.strip())
+                                    #     except Exception as e:
+                                    #         logger.warning(f"Could not load Bracken for AMR filtering: {e}")
+                                    
+                                    if os.path.exists(master_join_path):
+                                        # We have BAM files, link directly to Kraken TaxID
+                                        amr_reads_df = pd.read_csv(master_join_path)
+                                        hit_counts = amr_reads_df.groupby(['TaxID', 'Allele']).size().reset_index(name='count')
+                                        
+                                        for _, row in hit_counts.iterrows():
+                                            allele_str = str(row['Allele'])
+                                            matching_amr = filtered_amr[filtered_amr[ref_col].astype(str) == allele_str]
+                                            if matching_amr.empty:
+                                                continue 
+                                            
+                                            raw_taxid = int(row['TaxID'])
+                                            tax_name = tax_dict.get(raw_taxid, "Unassigned / Mobile Elements")
+                                            
+                                            # # BRACKEN FILTER & ROLLUP
+                                            # if raw_taxid != 0 and allowed_species_names:
+                                            #     is_validated = False
+                                            #     for b_name in allowed_species_names:
+                                            #         # Strain string matching: "Klebsiella pneumoniae subsp..." contains "Klebsiella pneumoniae"
+                                            #         if b_name in tax_name or tax_name in b_name:
+                                            #             is_validated = True
+                                            #             tax_name = b_name  # Clean rollup to species level!
+                                            #             break
+                                            #     if not is_validated:
+                                            #         tax_name = "Unassigned / Mobile Elements"
+
+                                            dc_str = matching_amr.iloc[0]['Drug Class']
+                                            drug_classes = [c.strip().capitalize() for c in str(dc_str).split(';')]
+                                            
+                                            # Extract the highly specific ARO Term, falling back to Gene Family if missing
+                                            gene_name = matching_amr.iloc[0][aro_col] if aro_col else matching_amr.iloc[0].get('AMR Gene Family', 'Unknown')
+                                            
+                                            if tax_name not in antibiogram:
+                                                antibiogram[tax_name] = {}
+                                            
+                                            for dc in drug_classes:
+                                                if dc not in antibiogram[tax_name]:
+                                                    antibiogram[tax_name][dc] = {}
+                                                if gene_name not in antibiogram[tax_name][dc]:
+                                                    antibiogram[tax_name][dc][gene_name] = 0
+                                                antibiogram[tax_name][dc][gene_name] += row['count']
+                                    else:
+                                        # Fallback if no BAM files are found. Assign to Unassigned.
+                                        logger.info(f"Fallback AMR mapping engaged for {barcode} (Read-level join missing).")
+                                        tax_name = "Unassigned / Mobile Elements"
+                                        if tax_name not in antibiogram:
+                                            antibiogram[tax_name] = {}
+                                        for _, row in filtered_amr.iterrows():
+                                            dc_str = row['Drug Class']
+                                            drug_classes = [c.strip().capitalize() for c in str(dc_str).split(';')]
+                                            
+                                            # Extract the highly specific ARO Term, falling back to Gene Family if missing
+                                            gene_name = row[aro_col] if aro_col else row.get('AMR Gene Family', 'Unknown')
+                                            
+                                            reads_count = int(row[reads_col])
+                                            
+                                            for dc in drug_classes:
+                                                if dc not in antibiogram[tax_name]:
+                                                    antibiogram[tax_name][dc] = {}
+                                                if gene_name not in antibiogram[tax_name][dc]:
+                                                    antibiogram[tax_name][dc][gene_name] = 0
+                                                antibiogram[tax_name][dc][gene_name] += reads_count
+
+                                    # Convert dicts back to formatted lists for JSON serialization
+                                    for org in antibiogram:
+                                        for dc in antibiogram[org]:
+                                            antibiogram[org][dc] = [f"{g} ({c}x)" for g, c in antibiogram[org][dc].items()]
+                                            
+                                    anti_json_path = os.path.join(barcode_agg_dir, f"master_{barcode}.antibiogram.json")
+                                    with open(anti_json_path + '.tmp', 'w') as f:
+                                        json.dump(antibiogram, f, indent=2)
+                                    os.rename(anti_json_path + '.tmp', anti_json_path)
+                                    logger.info(f"Generated Antibiogram JSON for {barcode}")
+                                    
+                                    # --- NEW: Export Antibiogram as CSV for external viewing ---
+                                    all_drug_classes = set()
+                                    for org, dc_dict in antibiogram.items():
+                                        all_drug_classes.update(dc_dict.keys())
+                                    all_drug_classes = sorted(list(all_drug_classes))
+                                    
+                                    csv_rows = []
+                                    # Sort organisms, ensuring Unassigned is at the bottom
+                                    unassigned_key = "Unassigned / Mobile Elements"
+                                    orgs_sorted = [o for o in sorted(antibiogram.keys()) if o != unassigned_key]
+                                    if unassigned_key in antibiogram:
+                                        orgs_sorted.append(unassigned_key)
+                                        
+                                    for org in orgs_sorted:
+                                        row = {'Organism': org}
+                                        for dc in all_drug_classes:
+                                            genes = antibiogram[org].get(dc, [])
+                                            row[dc] = " ; ".join(genes) if genes else "-"
+                                        csv_rows.append(row)
+                                        
+                                    if csv_rows:
+                                        csv_df = pd.DataFrame(csv_rows)
+                                        csv_df = csv_df[['Organism'] + all_drug_classes]
+                                        anti_csv_path = os.path.join(barcode_agg_dir, f"master_{barcode}.antibiogram.csv")
+                                        _safe_write_csv(csv_df, anti_csv_path)
+                                        logger.info(f"Generated Antibiogram CSV for {barcode}")
+
+                                except Exception as e:
+                                    logger.error(f"Failed to generate Antibiogram outputs: {e}")
+                except Exception as e:
+                    logger.error(f"AMR Aggregation failed for {barcode}: {e}", exc_info=True)
+
+
+# --- Aggregation worker pool ---
+
+_POOLS = {}
+_POOLS_LOCK = Lock()
+
+def _aggregation_workers(config: configparser.ConfigParser) -> int:
+    return max(1, config.getint('Settings', 'aggregation_workers', fallback=1))
+
+def _get_pool(workers: int) -> ProcessPoolExecutor:
+    """Returns the process-wide worker pool, kept across batches so workers keep their imports and caches."""
+    with _POOLS_LOCK:
+        if workers not in _POOLS:
+            # spawn, not fork: the backend forks from a process full of threads
+            _POOLS[workers] = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+        return _POOLS[workers]
+
+def _stop_pool(pool: ProcessPoolExecutor):
+    # Without terminating the workers, interpreter exit would still wait for their running tasks
+    processes = list((getattr(pool, '_processes', None) or {}).values())
+    pool.shutdown(wait=False, cancel_futures=True)
+    for process in processes:
+        if process.is_alive():
+            process.terminate()
+
+def _discard_pool(workers: int):
+    with _POOLS_LOCK:
+        pool = _POOLS.pop(workers, None)
+    if pool:
+        _stop_pool(pool)
+
+def shutdown_pools():
+    """Stops every aggregation worker pool at once, abandoning running barcodes (the journal redoes them)."""
+    with _POOLS_LOCK:
+        pools = list(_POOLS.values())
+        _POOLS.clear()
+    for pool in pools:
+        _stop_pool(pool)
+
+def _merge_task(batch_result_dir: str, barcode: str, aggregated_output_dir: str, config: configparser.ConfigParser):
+    start = time.monotonic()
+    master_report, read_counts = _merge_barcode(batch_result_dir, barcode, aggregated_output_dir, config)
+    return master_report, read_counts, time.monotonic() - start
+
+def _aggregate_task(*args):
+    start = time.monotonic()
+    _aggregate_barcode(*args)
+    return time.monotonic() - start
+
+def _map_barcodes(task, jobs: dict, workers: int):
+    """
+    Runs task(*args) for each {barcode: args} and yields (barcode, result) as each one
+    finishes: on the worker pool when workers > 1, else one after another in this process.
+    If the pool breaks, only the barcodes that did not finish are re-run here, and the
+    pool is replaced next time.
+    """
+    if workers <= 1 or len(jobs) <= 1:
+        for barcode, args in jobs.items():
+            yield barcode, task(*args)
+        return
+    try:
+        futures = {_get_pool(workers).submit(task, *args): barcode for barcode, args in jobs.items()}
+    except (BrokenProcessPool, RuntimeError) as e:
+        logger.error(f"Aggregation pool unavailable ({e}); aggregating in-process.")
+        _discard_pool(workers)
+        futures = {}
+    unfinished = [] if futures else list(jobs)
+    for future in as_completed(futures):
+        try:
+            result = future.result()
+        except (BrokenProcessPool, CancelledError):
+            unfinished.append(futures[future])
+            continue
+        yield futures[future], result
+    if futures and unfinished:
+        logger.error(f"Aggregation pool broke; retrying {', '.join(unfinished)} in-process.")
+        _discard_pool(workers)
+    for barcode in unfinished:
+        yield barcode, task(*jobs[barcode])
 
 # --- Main aggregation function ---
 
-def aggregate_and_plot(batch_result_dir: str, config: configparser.ConfigParser):
-    """Main aggregation function. Finds barcodes and aggregates their results individually."""
+def aggregate_and_plot(batch_result_dir: str, config: configparser.ConfigParser, barcodes: list = None, on_barcode_done=None):
+    """
+    Main aggregation function. Finds barcodes and aggregates their results individually.
+
+    Barcodes are merged and analysed concurrently on a pool of aggregation_workers
+    processes; Bracken, read_stats.csv and the cross-barcode plots are done once per
+    batch in between and after. `barcodes` restricts aggregation to a subset (used when
+    resuming a half-aggregated batch) and `on_barcode_done(barcode)` is called as each
+    barcode is folded in.
+    """
     if not batch_result_dir or not os.path.isdir(batch_result_dir):
         logger.warning("Batch result directory is invalid. Skipping aggregation.")
         return
@@ -241,7 +758,8 @@ def aggregate_and_plot(batch_result_dir: str, config: configparser.ConfigParser)
         logger.info("run_kraken is false in config; skipping classification aggregation.")
         return
 
-    barcodes = _get_barcodes_in_batch(batch_result_dir)
+    found_barcodes = _get_barcodes_in_batch(batch_result_dir)
+    barcodes = found_barcodes if barcodes is None else [b for b in found_barcodes if b in barcodes]
     if not barcodes:
         logger.warning("No barcode subdirectories found in classification results for this batch.")
 
@@ -250,359 +768,54 @@ def aggregate_and_plot(batch_result_dir: str, config: configparser.ConfigParser)
 
     cumulative_data_log = os.path.join(aggregated_output_dir, "cumulative_species_data.csv")
     rarefaction_data_log = os.path.join(aggregated_output_dir, "rarefaction_data.csv")
-    
-    now_timestamp = datetime.now().isoformat()
-
-    for barcode in barcodes:
-        logger.info(f"--- Processing barcode: {barcode} ---")
-        
-        barcode_batch_dir = os.path.join(batch_result_dir, "3_classification", "kraken2", barcode)
-        barcode_agg_dir = os.path.join(aggregated_output_dir, barcode)
-        os.makedirs(barcode_agg_dir, exist_ok=True)
-
-        new_kraken_tsv = os.path.join(barcode_batch_dir, f"{barcode}.kraken2.tsv")
-        master_kraken_tsv = os.path.join(barcode_agg_dir, f"master_{barcode}.kraken2.tsv")
-        _concatenate_files(new_kraken_tsv, master_kraken_tsv)
-
-        new_report_tsv = os.path.join(barcode_batch_dir, f"{barcode}.report.tsv")
-        master_report_tsv = os.path.join(barcode_agg_dir, f"master_{barcode}.report.tsv")
-        
-        # --- Tally Read Stats Before Cleanup ---
+    # Histories are time series now; runs started before keep theirs
+    for data_log in (cumulative_data_log, rarefaction_data_log):
         try:
-            _update_read_stats(batch_result_dir, barcode, aggregated_output_dir, config)
+            get_series(data_log).import_csv(data_log)
         except Exception as e:
-            logger.error(f"Failed to update read stats for {barcode}: {e}")
+            logger.error(f"Could not import {os.path.basename(data_log)}: {e}")
+    
+    now_timestamp = datetime.now().isoformat()
 
-        if _combine_kraken_reports_executable(new_report_tsv, master_report_tsv):
-            kraken_db_path = config.get('DatabasePaths', 'kraken_db')
-            final_bracken_output = _rerun_bracken(master_report_tsv, kraken_db_path, barcode_agg_dir, barcode, config)
+    workers = _aggregation_workers(config)
 
-            if final_bracken_output:
-                try:
-                    logger.info(f"--- Generating combined analysis for {barcode} ---")
-                    
-                    # --- NEW DYNAMIC TAXONOMY RESOLUTION ---
-                    taxonomy_dir = config.get('DatabasePaths', 'taxonomy_dir', fallback=None)
-                    
-                    # 1. Did the user specify a valid dir in config?
-                    if taxonomy_dir and os.path.exists(os.path.join(taxonomy_dir, "nodes.dmp")):
-                        taxonomy_path = os.path.join(taxonomy_dir, "nodes.dmp")
-                    else:
-                        # 2. Look in standard kraken_db/taxonomy/nodes.dmp
-                        # 3. Look in root kraken_db/nodes.dmp
-                        # 4. Fallback to the project's internal scripts/kraken2/data/nodes.dmp backup
-                        p1 = os.path.join(kraken_db_path, "taxonomy", "nodes.dmp")
-                        p2 = os.path.join(kraken_db_path, "nodes.dmp")
-                        p3 = os.path.join(PROJECT_ROOT, "scripts", "kraken2", "data", "nodes.dmp")
-                        
-                        if os.path.exists(p1): taxonomy_path = p1
-                        elif os.path.exists(p2): taxonomy_path = p2
-                        else: taxonomy_path = p3
-                    # ----------------------------------------
-                        
-                    state_file_path = os.path.join(barcode_agg_dir, "minimizer_state.json")
-                    raw_minimizer_file = os.path.join(barcode_batch_dir, f"{barcode}.minimizers.tsv")
-                    
-                    tracker = MinimizerTracker(taxonomy_path=taxonomy_path, state_path=state_file_path)
-                    tracker.update_with_batch(raw_minimizer_file=raw_minimizer_file)
-                    
-                    current_report_df = tracker.generate_confidence_report(
-                        bracken_report_file=final_bracken_output,
-                        timestamp=now_timestamp 
-                    )
-                    
-                    if current_report_df.empty:
-                        logger.warning(f"No species-level data for {barcode} in this batch. Analysis not updated.")
-                        continue
-
-                    combined_report_path = os.path.join(barcode_agg_dir, f"master_{barcode}.combined_analysis.tsv")
-                    historical_df = pd.DataFrame()
-                    if os.path.exists(combined_report_path):
-                        historical_df = pd.read_csv(combined_report_path, sep='\t')
-
-                    slopes = []
-                    p_values = []
-                    for _, current_row in current_report_df.iterrows():
-                        taxid = current_row['taxonomy_id']
-                        
-                        species_history = pd.DataFrame()
-                        if not historical_df.empty:
-                            species_history = historical_df[historical_df['taxonomy_id'] == taxid]
-                        
-                        full_history = pd.concat([species_history, pd.DataFrame([current_row])], ignore_index=True)
-                        slope, p_value = _calculate_trend(full_history)
-                        slopes.append(slope)
-                        p_values.append(p_value)
-
-                    current_report_df['regression_slope'] = slopes
-                    current_report_df['p_value'] = p_values
-
-                    cols_order = [
-                        'timestamp', 'name', 'taxonomy_id', 
-                        'cumulative_bracken_reads', 'cumulative_total_minimizers', 'cumulative_distinct_minimizers',
-                        'diversity_ratio', 'abundance_pct', 'complexity_pct', 'confidence_score',
-                        'regression_slope', 'p_value'
-                    ]
-                    final_df = current_report_df[cols_order]
-
-                    final_df.to_csv(
-                        combined_report_path, 
-                        sep='\t', 
-                        index=False, 
-                        mode='a', 
-                        header=not os.path.exists(combined_report_path)
-                    )
-                    logger.info(f"Appended combined analysis report to {combined_report_path}")
-
-                    tracker.save_state()
-                    
-                except Exception as e:
-                    logger.error(f"Analysis failed for {barcode}: {e}", exc_info=True)
-                
-                # Update interactive plot data files
-                _update_cumulative_data(final_bracken_output, barcode, cumulative_data_log)
-                _update_rarefaction_data(final_bracken_output, barcode, rarefaction_data_log)
-
-                # Regenerate static cumulative plot for this barcode
-                cumulative_script = os.path.join(PROJECT_ROOT, "plotting", "cumulative_plot.py")
-                subprocess.run([sys.executable, cumulative_script, cumulative_data_log, barcode, barcode_agg_dir])
-
-                # --- AMR Aggregation ---
-                if config.getboolean('WorkflowSteps', 'run_amr', fallback=False):
-                    try:
-                        batch_amr_dir = os.path.join(batch_result_dir, "3_classification", "amr", barcode)
-                        agg_amr_dir = os.path.join(barcode_agg_dir, "amr_batches")
-                        os.makedirs(agg_amr_dir, exist_ok=True)
-                        
-                        # Copy AMR batch text files
-                        if os.path.exists(batch_amr_dir):
-                            # Extract the batch folder name for traceability
-                            batch_id = os.path.basename(os.path.normpath(batch_result_dir))
-                            for f in os.listdir(batch_amr_dir):
-                                if f.endswith(".txt"):
-                                    base, ext = os.path.splitext(f)
-                                    new_f = f"{base}_{batch_id}{ext}"
-                                    shutil.copy2(os.path.join(batch_amr_dir, f), os.path.join(agg_amr_dir, new_f))
-                        
-                        # Glob all collected amr files
-                        all_amr_files = glob.glob(os.path.join(agg_amr_dir, "*.allele_mapping_data*.txt"))
-                        amr_df_list = []
-                        for amr_f in all_amr_files:
-                            try:
-                                df = pd.read_csv(amr_f, sep='\t')
-                                if not df.empty:
-                                    amr_df_list.append(df)
-                            except Exception as e:
-                                logger.warning(f"Failed to read AMR file {amr_f}: {e}")
-                                
-                        if amr_df_list:
-                            master_amr = pd.concat(amr_df_list, ignore_index=True)
-                            
-                            # Dynamically map RGI column names which vary by version
-                            ref_col = next((c for c in ['Reference', 'Reference Sequence', 'Reference Allele', 'Allele'] if c in master_amr.columns), None)
-                            cov_col = next((c for c in ['Percent Coverage', 'Percentage Length of Reference Sequence', 'Coverage'] if c in master_amr.columns), None)
-                            depth_col = next((c for c in ['Depth', 'Average Depth'] if c in master_amr.columns), None)
-                            reads_col = next((c for c in ['All Mapped Reads', 'Mapped Reads', 'Completely Mapped Reads'] if c in master_amr.columns), None)
-                            
-                            # Extract the highly specific ARO Term, falling back to Gene Family if missing
-                            aro_col = next((c for c in ['ARO Term', 'ARO_Term', 'ARO Name', 'Gene'] if c in master_amr.columns), None)
-
-                            if not ref_col or not cov_col or not depth_col or not reads_col:
-                                logger.error(f"Missing required AMR columns. Found: {list(master_amr.columns)}")
-                            elif 'AMR Gene Family' in master_amr.columns:
-                                # Include ARO Term in the groupby so we don't lose the specific allele variants
-                                group_cols = [c for c in [aro_col, 'AMR Gene Family', 'Drug Class', 'Resistance Mechanism', ref_col] if c in master_amr.columns and c is not None]
-                                
-                                agg_amr = master_amr.groupby(group_cols).agg({
-                                    reads_col: 'sum',
-                                    cov_col: 'mean',
-                                    depth_col: 'mean'
-                                }).reset_index()
-                                
-                                min_cov = config.getfloat('AmrParams', 'min_coverage', fallback=80.0)
-                                min_depth = config.getfloat('AmrParams', 'min_depth', fallback=2.0)
-                                
-                                # RGI leaves 'Depth' completely blank in some outputs. Cast to numeric and use reads_col instead.
-                                agg_amr[cov_col] = pd.to_numeric(agg_amr[cov_col], errors='coerce').fillna(0)
-                                agg_amr[reads_col] = pd.to_numeric(agg_amr[reads_col], errors='coerce').fillna(0)
-
-                                filtered_amr = agg_amr[(agg_amr[cov_col] >= min_cov) & 
-                                                       (agg_amr[reads_col] >= min_depth)]
-                                                       
-                                amr_summary_path = os.path.join(barcode_agg_dir, f"master_{barcode}.amr_summary.csv")
-                                _safe_write_csv(filtered_amr, amr_summary_path)
-                                logger.info(f"Aggregated AMR data saved to {amr_summary_path}")
-
-                                # --- Batch Read-Level Join (Kraken + AMR BAM) ---
-                                batch_kraken_tsv = os.path.join(barcode_batch_dir, f"{barcode}.kraken2.tsv")
-                                batch_bam_files = glob.glob(os.path.join(batch_amr_dir, "*.bam"))
-                                master_join_path = os.path.join(barcode_agg_dir, f"master_{barcode}.amr_reads.csv")
-                                
-                                # Ensure absolute path to samtools to bypass PATH drops in non-interactive python shells
-                                samtools_bin = os.path.join(PROJECT_ROOT, "nextflow_pipeline", "bin", "conda-env", "bin", "samtools")
-                                if not os.path.exists(samtools_bin):
-                                    samtools_bin = "samtools"
-
-                                if os.path.exists(batch_kraken_tsv) and batch_bam_files:
-                                    try:
-                                        k_df = pd.read_csv(batch_kraken_tsv, sep='\t', header=None, usecols=[1, 2], names=['ReadID', 'TaxID'])
-                                        
-                                        # Clean TaxID: Handle Kraken's '--use-names' flag outputs like 'Staphylococcus aureus (taxid 1280)'
-                                        extracted_tax = k_df['TaxID'].astype(str).str.extract(r'taxid (\d+)')
-                                        k_df['TaxID'] = extracted_tax[0].fillna(k_df['TaxID'])
-                                        
-                                        bam_records = []
-                                        for bam in batch_bam_files:
-                                            # Execute robustly using list arguments instead of shell pipe
-                                            res = subprocess.run([samtools_bin, "view", "-F", "4", bam], capture_output=True, text=True)
-                                            for line in res.stdout.strip().split('\n'):
-                                                parts = line.split('\t')
-                                                if len(parts) >= 3:
-                                                    bam_records.append({'ReadID': parts[0], 'Allele': parts[2]})
-                                        
-                                        if bam_records:
-                                            bam_df = pd.DataFrame(bam_records)
-                                            joined_df = pd.merge(bam_df, k_df, on='ReadID', how='left')
-                                            # Coerce the safely extracted string back into an integer
-                                            joined_df['TaxID'] = pd.to_numeric(joined_df['TaxID'], errors='coerce').fillna(0).astype(int)
-                                            joined_df.to_csv(master_join_path, mode='a', index=False, header=not os.path.exists(master_join_path))
-                                    except Exception as e:
-                                        logger.warning(f"Failed to join batch reads for Antibiogram: {e}")
-
-                                # --- Generate Antibiogram JSON ---
-                                if not filtered_amr.empty:
-                                    try:
-                                        import json
-                                        antibiogram = {}
-                                        tax_dict = {0: "Unassigned / Mobile Elements"}
-                                        if os.path.exists(master_report_tsv):
-                                            rep_df = pd.read_csv(master_report_tsv, sep='\t', header=None, names=['pct', 'reads', 'lreads', 'lvl', 'taxid', 'name'])
-                                            tax_dict.update(dict(zip(rep_df['taxid'], rep_df['name'].str.strip())))
-                                            
-                                        # # BRACKEN FILTER: Get validated species names for filtering and strain-rollup
-                                        # allowed_species_names = set()
-                                        # if final_bracken_output and os.path.exists(final_bracken_output):
-                                        #     try:
-                                        #         b_df = pd.read_csv(final_bracken_output, sep='\t')
-                                        #         if 'name' in b_df.columns and 'new_est_reads' in b_df.columns:
-                                        #             allowed_species_names = set(b_df[b_df['new_est_reads'] > 0]['name'].str.strip())
-                                        #     except Exception as e:
-                                        #         logger.warning(f"Could not load Bracken for AMR filtering: {e}")
-                                        
-                                        if os.path.exists(master_join_path):
-                                            # We have BAM files, link directly to Kraken TaxID
-                                            amr_reads_df = pd.read_csv(master_join_path)
-                                            hit_counts = amr_reads_df.groupby(['TaxID', 'Allele']).size().reset_index(name='count')
-                                            
-                                            for _, row in hit_counts.iterrows():
-                                                allele_str = str(row['Allele'])
-                                                matching_amr = filtered_amr[filtered_amr[ref_col].astype(str) == allele_str]
-                                                if matching_amr.empty:
-                                                    continue 
-                                                
-                                                raw_taxid = int(row['TaxID'])
-                                                tax_name = tax_dict.get(raw_taxid, "Unassigned / Mobile Elements")
-                                                
-                                                # # BRACKEN FILTER & ROLLUP
-                                                # if raw_taxid != 0 and allowed_species_names:
-                                                #     is_validated = False
-                                                #     for b_name in allowed_species_names:
-                                                #         # Strain string matching: "Klebsiella pneumoniae subsp..." contains "Klebsiella pneumoniae"
-                                                #         if b_name in tax_name or tax_name in b_name:
-                                                #             is_validated = True
-                                                #             tax_name = b_name  # Clean rollup to species level!
-                                                #             break
-                                                #     if not is_validated:
-                                                #         tax_name = "Unassigned / Mobile Elements"
-
-                                                dc_str = matching_amr.iloc[0]['Drug Class']
-                                                drug_classes = [c.strip().capitalize() for c in str(dc_str).split(';')]
-                                                
-                                                # Extract the highly specific ARO Term, falling back to Gene Family if missing
-                                                gene_name = matching_amr.iloc[0][aro_col] if aro_col else matching_amr.iloc[0].get('AMR Gene Family', 'Unknown')
-                                                
-                                                if tax_name not in antibiogram:
-                                                    antibiogram[tax_name] = {}
-                                                
-                                                for dc in drug_classes:
-                                                    if dc not in antibiogram[tax_name]:
-                                                        antibiogram[tax_name][dc] = {}
-                                                    if gene_name not in antibiogram[tax_name][dc]:
-                                                        antibiogram[tax_name][dc][gene_name] = 0
-                                                    antibiogram[tax_name][dc][gene_name] += row['count']
-                                        else:
-                                            # Fallback if no BAM files are found. Assign to Unassigned.
-                                            logger.info(f"Fallback AMR mapping engaged for {barcode} (Read-level join missing).")
-                                            tax_name = "Unassigned / Mobile Elements"
-                                            if tax_name not in antibiogram:
-                                                antibiogram[tax_name] = {}
-                                            for _, row in filtered_amr.iterrows():
-                                                dc_str = row['Drug Class']
-                                                drug_classes = [c.strip().capitalize() for c in str(dc_str).split(';')]
-                                                
-                                                # Extract the highly specific ARO Term, falling back to Gene Family if missing
-                                                gene_name = row[aro_col] if aro_col else row.get('AMR Gene Family', 'Unknown')
-                                                
-                                                reads_count = int(row[reads_col])
-                                                
-                                                for dc in drug_classes:
-                                                    if dc not in antibiogram[tax_name]:
-                                                        antibiogram[tax_name][dc] = {}
-                                                    if gene_name not in antibiogram[tax_name][dc]:
-                                                        antibiogram[tax_name][dc][gene_name] = 0
-                                                    antibiogram[tax_name][dc][gene_name] += reads_count
-
-                                        # Convert dicts back to formatted lists for JSON serialization
-                                        for org in antibiogram:
-                                            for dc in antibiogram[org]:
-                                                antibiogram[org][dc] = [f"{g} ({c}x)" for g, c in antibiogram[org][dc].items()]
-                                                
-                                        anti_json_path = os.path.join(barcode_agg_dir, f"master_{barcode}.antibiogram.json")
-                                        with open(anti_json_path + '.tmp', 'w') as f:
-                                            json.dump(antibiogram, f, indent=2)
-                                        os.rename(anti_json_path + '.tmp', anti_json_path)
-                                        logger.info(f"Generated Antibiogram JSON for {barcode}")
-                                        
-                                        # --- NEW: Export Antibiogram as CSV for external viewing ---
-                                        all_drug_classes = set()
-                                        for org, dc_dict in antibiogram.items():
-                                            all_drug_classes.update(dc_dict.keys())
-                                        all_drug_classes = sorted(list(all_drug_classes))
-                                        
-                                        csv_rows = []
-                                        # Sort organisms, ensuring Unassigned is at the bottom
-                                        unassigned_key = "Unassigned / Mobile Elements"
-                                        orgs_sorted = [o for o in sorted(antibiogram.keys()) if o != unassigned_key]
-                                        if unassigned_key in antibiogram:
-                                            orgs_sorted.append(unassigned_key)
-                                            
-                                        for org in orgs_sorted:
-                                            row = {'Organism': org}
-                                            for dc in all_drug_classes:
-                                                genes = antibiogram[org].get(dc, [])
-                                                row[dc] = " ; ".join(genes) if genes else "-"
-                                            csv_rows.append(row)
-                                            
-                                        if csv_rows:
-                                            csv_df = pd.DataFrame(csv_rows)
-                                            csv_df = csv_df[['Organism'] + all_drug_classes]
-                                            anti_csv_path = os.path.join(barcode_agg_dir, f"master_{barcode}.antibiogram.csv")
-                                            _safe_write_csv(csv_df, anti_csv_path)
-                                            logger.info(f"Generated Antibiogram CSV for {barcode}")
-
-                                    except Exception as e:
-                                        logger.error(f"Failed to generate Antibiogram outputs: {e}")
-                    except Exception as e:
-                        logger.error(f"AMR Aggregation failed for {barcode}: {e}", exc_info=True)
+    # Merge every barcode first so Bracken re-estimates them all in one pass
+    master_reports, read_counts, merge_seconds = {}, {}, {}
+    merge_jobs = {barcode: (batch_result_dir, barcode, aggregated_output_dir, config) for barcode in barcodes}
+    for barcode, (master_report, counts, seconds) in _map_barcodes(_merge_task, merge_jobs, workers):
+        master_reports[barcode], merge_seconds[barcode] = master_report, seconds
+        if counts is not None:
+            read_counts[barcode] = counts
+    try:
+        _update_read_stats(aggregated_output_dir, os.path.basename(os.path.normpath(batch_result_dir)),
+                           {b: read_counts[b] for b in barcodes if b in read_counts})
+    except Exception as e:
+        logger.error(f"Failed to update read stats: {e}")
+    bracken_outputs = _rerun_bracken({b: master_reports[b] for b in barcodes if master_reports[b]}, config)
+
+    aggregate_jobs = {barcode: (batch_result_dir, barcode, aggregated_output_dir, config,
+                                cumulative_data_log, rarefaction_data_log, now_timestamp,
+                                master_reports[barcode], bracken_outputs.get(barcode))
+                      for barcode in barcodes}
+    for barcode, seconds in _map_barcodes(_aggregate_task, aggregate_jobs, workers):
+        REGISTRY.observe("nanort_aggregation_seconds", seconds + merge_seconds[barcode], {'barcode': barcode},
+                         help_text="Wall time of aggregating one barcode's batch results")
+        REGISTRY.set("nanort_last_result_timestamp_seconds", time.time(),
+                     help_text="Unix time aggregated results were last updated")
+        if on_barcode_done:
+            on_barcode_done(barcode)
     
     if barcodes:
         logger.info("--- Updating summary plots for all barcodes ---")
 
         abundance_script = os.path.join(PROJECT_ROOT, "plotting", "abundance_barplots.py")
-        subprocess.run([sys.executable, abundance_script, aggregated_output_dir, aggregated_output_dir])
-
         rarefaction_script = os.path.join(PROJECT_ROOT, "plotting", "rarefaction_plot.py")
-        subprocess.run([sys.executable, rarefaction_script, rarefaction_data_log, aggregated_output_dir])
+        for plot_command in ([sys.executable, abundance_script, aggregated_output_dir, aggregated_output_dir],
+                             [sys.executable, rarefaction_script, rarefaction_data_log, aggregated_output_dir]):
+            try:
+                child_processes.run(plot_command, timeout=_subprocess_timeout(config))
+            except subprocess.TimeoutExpired:
+                logger.error(f"{os.path.basename(plot_command[1])} timed out.")
 
     # --- BATCH CLEANUP ---
     if CLEANUP_BATCH_FOLDERS:
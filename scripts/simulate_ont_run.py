@@ -1,18 +1,26 @@
 import os
+import sys
+import json
+import math
 import shutil
 import time
 import random
+import argparse
 from pathlib import Path
 from datetime import datetime
 
 # --- CONFIGURATION ---
 SOURCE_ROOT = Path("/mnt/Drive20T/ont_data/20250603_JPL_Samples_Rap_Kit/no_sample_id/20250603_1138_MN45557_FBC24299_2c138b3f/fastq_pass")
 DEST_ROOT = Path("/var/lib/minknow/data/20250603_JPL_Samples_Rap_Kit/no_sample_id/20250603_1138_MN45557_FBC24299_2c138b3f/fastq_pass")
+JOURNAL_PATH = Path("output/batch_journal.jsonl")
 
 # Rate settings
-BATCH_SIZE = 30        # Number of files to copy per interval
-INTERVAL_SECONDS = 60  # 1 minute between batches
-INITIAL_DELAY_SECONDS = 60 # 1 minute wait before first batch
+FILES_PER_MINUTE = 30      # Mean arrival rate for the constant and bursty profiles
+BURST_SIZE = 30            # Files released together by the bursty profile
+INITIAL_DELAY_SECONDS = 60 # 1 minute wait before first file
+RESULT_WAIT_SECONDS = 1800 # How long to wait for results after the last copy
+
+PERCENTILES = (50, 90, 95, 99)
 
 def get_all_files(source_dir):
     """
@@ -21,7 +29,7 @@ def get_all_files(source_dir):
     """
     file_list = []
     print(f"Scanning source directory: {source_dir} ...")
-    
+
     for root, dirs, files in os.walk(source_dir):
         for file in files:
             if "fastq" in file: # Simple check for fastq files
@@ -29,65 +37,221 @@ def get_all_files(source_dir):
                 # Get path relative to the source root (e.g., "barcode01/file.fastq")
                 relative_path = full_path.relative_to(source_dir)
                 file_list.append((full_path, relative_path))
-                
+
     print(f"Found {len(file_list)} files.")
-    return file_list
+    # Sorted so a given seed always produces the same order, whatever os.walk returns
+    return sorted(file_list, key=lambda f: str(f[1]))
+
+# --- Arrival profiles: each returns [(offset_seconds, src_path, rel_path), ...] ---
+
+def constant_schedule(files, rng, files_per_minute):
+    """Shuffled files, evenly spaced at the given rate."""
+    files = list(files)
+    rng.shuffle(files)
+    spacing = 60.0 / files_per_minute
+    return [(i * spacing, src, rel) for i, (src, rel) in enumerate(files)]
+
+def bursty_schedule(files, rng, files_per_minute, burst_size):
+    """Shuffled files released in bursts, with exponentially distributed gaps keeping the same mean rate."""
+    files = list(files)
+    rng.shuffle(files)
+    mean_gap = burst_size * 60.0 / files_per_minute
+    schedule, offset = [], 0.0
+    for start in range(0, len(files), burst_size):
+        for src, rel in files[start:start + burst_size]:
+            schedule.append((offset, src, rel))
+        offset += rng.expovariate(1.0 / mean_gap)
+    return schedule
+
+def replay_schedule(files, speedup):
+    """Files in their original order, spaced by their original mtimes (compressed by `speedup`)."""
+    stamped = sorted(((src.stat().st_mtime, src, rel) for src, rel in files), key=lambda f: (f[0], str(f[2])))
+    if not stamped:
+        return []
+    first = stamped[0][0]
+    return [((mtime - first) / speedup, src, rel) for mtime, src, rel in stamped]
+
+# --- Result collection ---
+
+def _file_key(path):
+    """(barcode folder, file name): identifies a file the same way in the source, destination and journal."""
+    path = Path(path)
+    return path.parent.name, path.name
+
+def read_result_times(journal_path):
+    """
+    Reads the backend's batch journal and returns {(barcode, file name): unix time} for every
+    file whose barcode has been folded into aggregated_results. Falls back to the batch's
+    'aggregated' record when no per-barcode record exists (e.g. classification is disabled).
+    """
+    batches = {}
+    try:
+        with open(journal_path, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                entry = batches.setdefault(record['batch'], {'files': [], 'barcodes': {}, 'aggregated': None})
+                if record['state'] == 'queued':
+                    entry['files'] = record.get('files', [])
+                elif record['state'] == 'barcode_aggregated' and 'ts' in record:
+                    entry['barcodes'][record['barcode']] = record['ts']
+                elif record['state'] == 'aggregated' and 'ts' in record:
+                    entry['aggregated'] = record['ts']
+    except IOError:
+        return {}
+
+    results = {}
+    for entry in batches.values():
+        for file_path in entry['files']:
+            key = _file_key(file_path)
+            done = entry['barcodes'].get(key[0], entry['aggregated'])
+            if done is not None:
+                results[key] = done
+    return results
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return float('nan')
+    rank = max(1, math.ceil(pct / 100.0 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+def latency_report(copies, results):
+    """Builds the per-file records and the percentile summary."""
+    records = []
+    for key, copied_at in copies.items():
+        done = results.get(key)
+        records.append({
+            'barcode': key[0], 'file': key[1], 'copied_at': copied_at,
+            'aggregated_at': done, 'latency_seconds': (done - copied_at) if done else None
+        })
+
+    def summarize(rows):
+        latencies = sorted(r['latency_seconds'] for r in rows if r['latency_seconds'] is not None)
+        summary = {'files': len(rows), 'aggregated': len(latencies)}
+        for pct in PERCENTILES:
+            summary[f'p{pct}'] = percentile(latencies, pct)
+        summary['max'] = latencies[-1] if latencies else float('nan')
+        summary['mean'] = sum(latencies) / len(latencies) if latencies else float('nan')
+        return summary
+
+    per_barcode = {}
+    for record in records:
+        per_barcode.setdefault(record['barcode'], []).append(record)
+    return records, summarize(records), {b: summarize(rows) for b, rows in sorted(per_barcode.items())}
+
+def print_report(summary, per_barcode, arrival_rate):
+    print("-" * 40)
+    print(f"Achieved arrival rate: {arrival_rate:.1f} files/min")
+    print(f"Files aggregated: {summary['aggregated']}/{summary['files']}")
+    header = f"{'':<12}" + "".join(f"{f'p{p}':>9}" for p in PERCENTILES) + f"{'max':>9}{'mean':>9}"
+    print(header)
+    rows = [("all", summary)] + list(per_barcode.items())
+    for name, s in rows:
+        values = [s[f'p{p}'] for p in PERCENTILES] + [s['max'], s['mean']]
+        print(f"{name:<12}" + "".join(f"{v:>9.1f}" for v in values))
+    print("Latency in seconds, from file copy to the barcode's results appearing in aggregated_results.")
+
+# --- Main ---
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Replays a sequencing run into a watched directory and reports "
+                                                 "copy-to-aggregated_results latency percentiles.")
+    parser.add_argument("--source", type=Path, default=SOURCE_ROOT, help="fastq_pass folder of a finished run.")
+    parser.add_argument("--dest", type=Path, default=DEST_ROOT, help="Folder the backend is watching.")
+    parser.add_argument("--journal", type=Path, default=JOURNAL_PATH,
+                        help="The backend's batch_journal.jsonl (in its output directory).")
+    parser.add_argument("--profile", choices=["constant", "bursty", "replay"], default="constant",
+                        help="Arrival profile: evenly spaced, bursts with random gaps, or original file mtimes.")
+    parser.add_argument("--rate", type=float, default=FILES_PER_MINUTE,
+                        help="Mean files per minute for constant/bursty (a PromethION flow cell pair is in the hundreds).")
+    parser.add_argument("--burst-size", type=int, default=BURST_SIZE, help="Files per burst for the bursty profile.")
+    parser.add_argument("--speedup", type=float, default=1.0, help="Time compression factor for the replay profile.")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for file order and burst gaps.")
+    parser.add_argument("--limit", type=int, default=None, help="Only replay the first N scheduled files.")
+    parser.add_argument("--initial-delay", type=float, default=INITIAL_DELAY_SECONDS, help="Seconds to wait before the first copy.")
+    parser.add_argument("--wait", type=float, default=RESULT_WAIT_SECONDS,
+                        help="Seconds to keep waiting for results after the last copy.")
+    parser.add_argument("--report", type=Path, default=None, help="Optional JSON file for the summary and per-file latencies.")
+    return parser.parse_args()
 
 def simulate_run():
-    # 1. Gather and Randomize Files
-    all_files = get_all_files(SOURCE_ROOT)
-    random.shuffle(all_files) # Randomize order to simulate mixed real-time output
+    args = parse_args()
+    rng = random.Random(args.seed)
 
+    # 1. Gather files and build the arrival schedule
+    all_files = get_all_files(args.source)
     if not all_files:
         print("No files found. Exiting.")
         return
-    
+
+    if args.profile == "constant":
+        schedule = constant_schedule(all_files, rng, args.rate)
+    elif args.profile == "bursty":
+        schedule = bursty_schedule(all_files, rng, args.rate, args.burst_size)
+    else:
+        schedule = replay_schedule(all_files, args.speedup)
+    if args.limit:
+        schedule = schedule[:args.limit]
+
     # --- INITIAL DELAY ---
     print("-" * 40)
-    print(f"Files ready. Waiting {INITIAL_DELAY_SECONDS} seconds before starting data transfer...")
+    print(f"{len(schedule)} files scheduled ({args.profile}, seed {args.seed}) over {schedule[-1][0]:.0f} seconds.")
+    print(f"Waiting {args.initial_delay:.0f} seconds before starting data transfer...")
     print("Time to start your pipeline!")
     print("-" * 40)
-    time.sleep(INITIAL_DELAY_SECONDS)
-
-    # 2. Process in Batches
-    total_files = len(all_files)
-    processed_count = 0
-    
-    print(f"Starting simulation. Copying {BATCH_SIZE} files every {INTERVAL_SECONDS} seconds.")
-    print(f"Source: {SOURCE_ROOT}")
-    print(f"Destination: {DEST_ROOT}")
-    print("-" * 40)
+    time.sleep(args.initial_delay)
 
+    # 2. Copy files on schedule, recording when each one landed
+    print(f"Source: {args.source}")
+    print(f"Destination: {args.dest}")
+    copies = {}
+    start = time.monotonic()
     try:
-        while processed_count < total_files:
-            # Slice the next batch of files
-            batch = all_files[processed_count : processed_count + BATCH_SIZE]
-            
-            print(f"[{datetime.now().strftime('%H:%M:%S')}] Copying batch of {len(batch)} files...")
-
-            for src_path, rel_path in batch:
-                # Construct destination path
-                dest_path = DEST_ROOT / rel_path
-                
-                # Ensure the barcode subdirectory exists
-                dest_path.parent.mkdir(parents=True, exist_ok=True)
-                
-                # Copy the file
-                shutil.copy2(src_path, dest_path)
-                # print(f"  Copied: {rel_path}") # Uncomment for verbose output
-
-            processed_count += len(batch)
-            remaining = total_files - processed_count
-            print(f"Progress: {processed_count}/{total_files} ({remaining} remaining)")
-
-            if remaining > 0:
-                # print(f"Sleeping for {INTERVAL_SECONDS} seconds...\n")
-                time.sleep(INTERVAL_SECONDS)
-            else:
-                print("\nSimulation complete. All files copied.")
+        for i, (offset, src_path, rel_path) in enumerate(schedule, 1):
+            delay = start + offset - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+            dest_path = args.dest / rel_path
+            # Ensure the barcode subdirectory exists
+            dest_path.parent.mkdir(parents=True, exist_ok=True)
+            shutil.copy2(src_path, dest_path)
+            copies[_file_key(dest_path)] = time.time()
+
+            if i % 50 == 0 or i == len(schedule):
+                print(f"[{datetime.now().strftime('%H:%M:%S')}] Progress: {i}/{len(schedule)} copied")
+        copy_seconds = time.monotonic() - start
+
+        # 3. Wait for the backend to fold everything into aggregated_results
+        print(f"\nAll files copied. Waiting up to {args.wait:.0f} seconds for results...")
+        deadline = time.monotonic() + args.wait
+        results = read_result_times(args.journal)
+        while time.monotonic() < deadline and any(key not in results for key in copies):
+            time.sleep(5)
+            results = read_result_times(args.journal)
 
     except KeyboardInterrupt:
-        print("\nSimulation stopped by user.")
+        print("\nSimulation stopped by user; reporting on the files copied so far.")
+        copy_seconds = time.monotonic() - start
+        results = read_result_times(args.journal)
+
+    # 4. Report
+    records, summary, per_barcode = latency_report(copies, results)
+    arrival_rate = len(copies) / copy_seconds * 60 if copy_seconds > 0 else float('nan')
+    print_report(summary, per_barcode, arrival_rate)
+
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump({'profile': args.profile, 'seed': args.seed, 'rate': args.rate,
+                       'arrival_rate_files_per_min': arrival_rate, 'summary': summary,
+                       'per_barcode': per_barcode, 'files': records}, f, indent=2)
+        print(f"Wrote latency report to {args.report}")
+
+    if summary['aggregated'] < summary['files']:
+        sys.exit(1)
 
 if __name__ == "__main__":
-    simulate_run()
\ No newline at end of file
+    simulate_run()
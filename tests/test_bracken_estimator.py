@@ -0,0 +1,121 @@
+# tests/test_bracken_estimator.py
+import os
+import sys
+
+import pytest
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_ROOT)
+
+from bracken_estimator import BrackenEstimator, write_bracken_output
+
+# (depth, level, taxid, name, reads at the node)
+REPORTS = {
+    'barcode01': [(0, 'R', 1, 'root', 5), (1, 'D', 2, 'Bacteria', 10), (2, 'G', 561, 'Escherichia', 20),
+                  (3, 'S', 562, 'Escherichia coli', 50), (4, 'S1', 83333, 'Escherichia coli K-12', 10),
+                  (2, 'G', 620, 'Shigella', 0), (3, 'S', 623, 'Shigella flexneri', 30),
+                  (2, 'G', 590, 'Salmonella', 2), (3, 'S', 28901, 'Salmonella enterica', 4),
+                  (2, 'G', 1279, 'Staphylococcus', 6), (3, 'S', 1280, 'Staphylococcus aureus', 15)],
+    'barcode02': [(0, 'R', 1, 'root', 0), (1, 'D', 2, 'Bacteria', 40), (2, 'G', 561, 'Escherichia', 0),
+                  (3, 'S', 562, 'Escherichia coli', 12), (2, 'G', 1279, 'Staphylococcus', 9),
+                  (3, 'S', 1280, 'Staphylococcus aureus', 70)],
+}
+
+# For each taxon, genome taxid:kmers mapped there:total kmers of that genome
+KMER_DISTRIB = {
+    2: {562: (30, 100), 83333: (25, 100), 623: (40, 100), 28901: (10, 100), 1280: (50, 100)},
+    561: {562: (60, 100), 83333: (55, 100), 623: (45, 100)},
+    590: {28901: (70, 100)},
+    1279: {1280: (80, 100)},
+    562: {562: (10, 100), 83333: (15, 100)},
+}
+
+def _write_report(path, nodes):
+    clade = [reads for *_, reads in nodes]
+    for i in reversed(range(len(nodes))):
+        for j in range(i + 1, len(nodes)):
+            if nodes[j][0] <= nodes[i][0]:
+                break
+            if nodes[j][0] == nodes[i][0] + 1:
+                clade[i] += clade[j]
+    total = clade[0]
+    with open(path, 'w') as f:
+        for (depth, level, taxid, name, reads), all_reads in zip(nodes, clade):
+            f.write(f"{all_reads / total * 100:0.2f}\t{all_reads}\t{reads}\t0\t0\t{level}\t{taxid}\t{'  ' * depth}{name}\n")
+    return clade
+
+def _reference(nodes, clade, threshold: int):
+    """est_abundance.py's redistribution, one node at a time over the taxonomy tree."""
+    parents, path = [], []
+    for depth, *_ in nodes:
+        del path[depth:]
+        parents.append(path[-1] if path else None)
+        path.append(len(parents) - 1)
+
+    def species_of(i):
+        while i is not None:
+            if nodes[i][1] == 'S':
+                return i
+            i = parents[i]
+        return None
+
+    kept = [i for i, node in enumerate(nodes) if node[1] == 'S' and clade[i] >= threshold]
+    genomes = {nodes[i][2]: (nodes[species_of(i)][2], nodes[i][4]) for i in range(len(nodes)) if species_of(i) in kept}
+    added = {nodes[i][2]: 0.0 for i in kept}
+    for i, (_, _, taxid, _, reads) in enumerate(nodes):
+        if species_of(i) is not None or not reads or taxid not in KMER_DISTRIB:
+            continue
+        probability = {genome: mapped / total * genomes[genome][1]
+                       for genome, (mapped, total) in KMER_DISTRIB[taxid].items() if genome in genomes}
+        all_probability = sum(probability.values())
+        for genome, p in probability.items():
+            if all_probability > 0:
+                added[genomes[genome][0]] += reads * p / all_probability
+    return [[nodes[i][3], nodes[i][2], clade[i], added[nodes[i][2]], clade[i] + added[nodes[i][2]]] for i in kept]
+
+@pytest.fixture
+def kmer_distrib(tmp_path):
+    path = tmp_path / "database150mers.kmer_distrib"
+    with open(path, 'w') as f:
+        f.write("mapped_taxid\tgenome_taxids:kmers_mapped:total_genome_kmers\n")
+        for taxid, genomes in KMER_DISTRIB.items():
+            f.write(f"{taxid}\t{' '.join(f'{g}:{m}:{t}' for g, (m, t) in genomes.items())}\n")
+    return str(path)
+
+def test_estimate_matches_est_abundance(tmp_path, kmer_distrib):
+    reports, expected = {}, {}
+    for barcode, nodes in REPORTS.items():
+        reports[barcode] = str(tmp_path / f"{barcode}.kreport")
+        expected[barcode] = _reference(nodes, _write_report(reports[barcode], nodes), threshold=10)
+
+    results = BrackenEstimator(kmer_distrib).estimate(reports, level='S', threshold=10)
+
+    for barcode, rows in expected.items():
+        assert [row[:3] for row in results[barcode]] == [row[:3] for row in rows]
+        assert [row[3:] for row in results[barcode]] == [pytest.approx(row[3:]) for row in rows]
+
+def test_cached_distribution_gives_the_same_estimate(tmp_path, kmer_distrib):
+    report = str(tmp_path / "barcode01.kreport")
+    _write_report(report, REPORTS['barcode01'])
+    cache_dir = str(tmp_path / "bracken_cache")
+
+    first = BrackenEstimator(kmer_distrib, cache_dir=cache_dir).estimate({'b': report})
+    assert len(os.listdir(cache_dir)) == 1
+    assert BrackenEstimator(kmer_distrib, cache_dir=cache_dir).estimate({'b': report}) == first
+
+def test_no_species_above_threshold(tmp_path, kmer_distrib):
+    report = str(tmp_path / "barcode01.kreport")
+    _write_report(report, REPORTS['barcode01'])
+
+    assert BrackenEstimator(kmer_distrib).estimate({'b': report}, threshold=1000) == {'b': None}
+
+def test_output_has_est_abundance_columns(tmp_path):
+    output = str(tmp_path / "barcode01.bracken")
+    write_bracken_output([['Escherichia coli', 562, 60, 14.6, 74.6], ['Shigella flexneri', 623, 30, 5.4, 35.4]], output)
+
+    with open(output) as f:
+        lines = [line.rstrip('\n').split('\t') for line in f]
+    assert lines[0] == ['name', 'taxonomy_id', 'taxonomy_lvl', 'kraken_assigned_reads', 'added_reads',
+                        'new_est_reads', 'fraction_total_reads']
+    assert lines[1] == ['Escherichia coli', '562', 'S', '60', '14', '74', '0.67818']
+    assert lines[2] == ['Shigella flexneri', '623', 'S', '30', '5', '35', '0.32182']
@@ -0,0 +1,73 @@
+# tests/test_kreport_merger.py
+import os
+import sys
+import subprocess
+
+import pytest
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_ROOT)
+
+import kreport_merger
+
+# (depth, level, taxid, name, reads at the node); clade counts are summed from the nodes below
+BATCHES = [
+    [(0, 'R', 1, 'root', 0), (1, 'D', 2, 'Bacteria', 5), (2, 'G', 561, 'Escherichia', 10),
+     (3, 'S', 562, 'Escherichia coli', 75), (2, 'G', 1279, 'Staphylococcus', 0),
+     (3, 'S', 1280, 'Staphylococcus aureus', 20)],
+    # Ties with the first batch's order, and a genus and species it did not have
+    [(0, 'R', 1, 'root', 2), (1, 'D', 2, 'Bacteria', 0), (2, 'G', 1279, 'Staphylococcus', 0),
+     (3, 'S', 1280, 'Staphylococcus aureus', 65), (2, 'G', 1386, 'Bacillus', 4),
+     (3, 'S', 1423, 'Bacillus subtilis', 8), (4, 'S1', 224308, 'Bacillus subtilis 168', 3)],
+    [(0, 'R', 1, 'root', 0), (1, 'D', 2, 'Bacteria', 1), (2, 'G', 561, 'Escherichia', 0),
+     (3, 'S', 562, 'Escherichia coli', 12), (2, 'G', 1386, 'Bacillus', 30)],
+]
+
+def _write_report(path, nodes, unclassified: int):
+    clade = [reads for *_, reads in nodes]
+    for i in reversed(range(len(nodes))):
+        for j in range(i + 1, len(nodes)):
+            if nodes[j][0] <= nodes[i][0]:
+                break
+            if nodes[j][0] == nodes[i][0] + 1:
+                clade[i] += clade[j]
+    total = unclassified + clade[0]
+    with open(path, 'w') as f:
+        f.write(f"{unclassified / total * 100:0.2f}\t{unclassified}\t{unclassified}\t{unclassified * 4}\t{unclassified * 4}\tU\t0\tunclassified\n")
+        for (depth, level, taxid, name, reads), all_reads in zip(nodes, clade):
+            f.write(f"{all_reads / total * 100:0.2f}\t{all_reads}\t{reads}\t{all_reads * 4}\t{reads * 4}\t"
+                    f"{level}\t{taxid}\t{'  ' * depth}{name}\n")
+
+def _combine_kreports(reports: list, output: str):
+    subprocess.run([sys.executable, os.path.join(PROJECT_ROOT, "combine_kreports.py"), "-r", *reports,
+                    "-o", output, "--no-headers", "--only-combined"], check=True, capture_output=True)
+
+@pytest.fixture
+def batch_reports(tmp_path):
+    paths = []
+    for i, nodes in enumerate(BATCHES):
+        paths.append(str(tmp_path / f"batch{i}.kreport"))
+        _write_report(paths[-1], nodes, unclassified=10 * (i + 1))
+    return paths
+
+def test_merge_matches_combine_kreports(tmp_path, batch_reports):
+    master = str(tmp_path / "master.kreport")
+    expected = str(tmp_path / "expected.kreport")
+    for i, report in enumerate(batch_reports):
+        assert kreport_merger.merge_into_master(report, master, batch_id=f"batch{i}")
+        # What aggregation did before: the master report re-combined with each batch report
+        _combine_kreports([expected, report] if i else [report], expected)
+        with open(master) as f, open(expected) as g:
+            assert f.read() == g.read()
+
+def test_redone_batch_is_not_merged_twice(tmp_path, batch_reports):
+    master = str(tmp_path / "master.kreport")
+    kreport_merger.merge_into_master(batch_reports[0], master, batch_id="batch0")
+    kreport_merger.merge_into_master(batch_reports[1], master, batch_id="batch1")
+    with open(master) as f:
+        merged = f.read()
+
+    assert not kreport_merger.merge_into_master(batch_reports[1], master, batch_id="batch1")
+    with open(master) as f:
+        assert f.read() == merged
+    assert kreport_merger.merged_batches(master) == ["batch0", "batch1"]
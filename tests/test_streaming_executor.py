@@ -0,0 +1,97 @@
+# tests/test_streaming_executor.py
+import os
+import sys
+import gzip
+import shutil
+import subprocess
+import configparser
+
+import pytest
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_ROOT)
+
+import pipeline_runner
+
+KRAKEN2_BIN = os.path.join(PROJECT_ROOT, "scripts", "kraken2", "bin")
+
+# Stands in for the compiled classifier behind the real kraken2 wrapper: records its
+# arguments and writes one output line per read found in the file it was given
+FAKE_CLASSIFY = r"""#!/usr/bin/env bash
+set -euo pipefail
+out= report=
+args=("$@")
+for ((i = 0; i < ${#args[@]}; i++)); do
+  case "${args[i]}" in
+    -O) out="${args[i+1]}" ;;
+    -R) report="${args[i+1]}" ;;
+  esac
+done
+input="${args[-1]}"
+printf '%s\n' "$@" > "$(dirname "$0")/classify.args"
+awk 'NR % 4 == 1 { print "C\t" substr($1, 2) "\t562\t150\t562:116" }' "$input" > "$out"
+printf '100.00\t%s\t0\t0\t0\tR\t1\troot\n' "$(wc -l < "$out")" > "$report"
+"""
+
+@pytest.fixture
+def pipeline_dir(tmp_path):
+    """A nextflow_pipeline folder whose bin/ has the real kraken2 wrapper and a fake classify."""
+    bin_dir = tmp_path / "pipeline" / "bin"
+    bin_dir.mkdir(parents=True)
+    for name in ("kraken2", "kraken2lib.pm"):
+        shutil.copy(os.path.join(KRAKEN2_BIN, name), bin_dir / name)
+    (bin_dir / "classify").write_text(FAKE_CLASSIFY)
+    (bin_dir / "classify").chmod(0o755)
+    db = tmp_path / "kraken_db"
+    db.mkdir()
+    for name in ("hash.k2d", "opts.k2d", "taxo.k2d"):
+        (db / name).write_bytes(b"")
+    return tmp_path
+
+def _config(tmp_path) -> configparser.ConfigParser:
+    config = configparser.ConfigParser()
+    config.read_dict({
+        'Paths': {'nextflow_script': str(tmp_path / "pipeline" / "main.nf"), 'output_directory': str(tmp_path / "out")},
+        'DatabasePaths': {'kraken_db': str(tmp_path / "kraken_db")},
+        'Streaming': {'threads': '1'},
+        'WorkflowSteps': {'run_classification': 'true', 'run_kraken': 'true'},
+    })
+    return config
+
+def _fastq_gz(path, reads: int):
+    with gzip.open(path, 'wt') as f:
+        for i in range(reads):
+            f.write(f"@read{i}\n{'ACGT' * 40}\n+\n{'I' * 160}\n")
+
+def test_stream_script_runs_the_kraken2_wrapper_on_stdin(pipeline_dir):
+    config = _config(pipeline_dir)
+    fastq = pipeline_dir / "barcode01.fastq.gz"
+    _fastq_gz(fastq, reads=25)
+    batch_dir = pipeline_dir / "batch"
+
+    script, _ = pipeline_runner._barcode_stream_script("barcode01", [str(fastq)], config, str(batch_dir))
+    result = subprocess.run(["bash", "-c", script], capture_output=True, text=True)
+
+    assert result.returncode == 0, result.stderr
+    outputs = pipeline_runner._kraken_outputs("barcode01", str(batch_dir))
+    with open(outputs['kraken_output']) as f:
+        assert [line.split('\t')[1] for line in f] == [f"read{i}" for i in range(25)]
+    assert os.path.getsize(outputs['report']) > 0
+    with open(pipeline_dir / "pipeline" / "bin" / "classify.args") as f:
+        assert f.read().split('\n')[-2] == "/dev/stdin"
+
+def test_read_gates_stop_barcodes_with_too_few_reads(pipeline_dir):
+    config = _config(pipeline_dir)
+    config.set('WorkflowSteps', 'run_host_depletion', 'true')
+    batch_dir = pipeline_dir / "batch"
+    no_host = batch_dir / "1_host_depletion" / "barcode01"
+    no_host.mkdir(parents=True)
+    _fastq_gz(no_host / "barcode01.noHost.fastq.gz", reads=0)
+    outputs = pipeline_runner._kraken_outputs("barcode01", str(batch_dir))
+    open(outputs['report'], 'w').close()
+
+    assert not pipeline_runner._passes_read_gates("barcode01", config, str(batch_dir))
+    assert not os.path.exists(os.path.dirname(outputs['report']))
+
+    _fastq_gz(no_host / "barcode01.noHost.fastq.gz", reads=25)
+    assert pipeline_runner._passes_read_gates("barcode01", config, str(batch_dir))
@@ -0,0 +1,78 @@
+# tests/test_timeseries_store.py
+import os
+import sys
+
+import pandas as pd
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_ROOT)
+
+import timeseries_store
+from timeseries_store import get_series, read_frame
+
+TIMES = ["2024-05-01T10:00:00.250000", "2024-05-01T10:05:00", "2024-05-01T10:10:00.125000"]
+
+def _legacy_species_csv(path):
+    """Writes cumulative_species_data.csv the way aggregation appended it before the store."""
+    rows = []
+    for i, timestamp in enumerate(TIMES):
+        for barcode in ("barcode01", "barcode02"):
+            for name, reads in (("Escherichia coli", 10 * i + 3), ("Staphylococcus aureus", 7 * i), ("Homo sapiens", i)):
+                rows.append({'name': name, 'cumulative_reads': reads, 'timestamp': timestamp, 'barcode': barcode})
+        rows.append({'name': "Bacillus subtilis", 'cumulative_reads': 100 + i, 'timestamp': timestamp, 'barcode': "barcode03"})
+    pd.DataFrame(rows).to_csv(path, index=False)
+
+def _sorted(df):
+    df = df.assign(timestamp=pd.to_datetime(df['timestamp'], format='ISO8601').astype('datetime64[ns]'))
+    return df.sort_values(['barcode', 'timestamp', 'name']).reset_index(drop=True)
+
+def test_imported_csv_reads_back_unchanged(tmp_path):
+    csv_path = str(tmp_path / "cumulative_species_data.csv")
+    _legacy_species_csv(csv_path)
+    legacy = pd.read_csv(csv_path)
+    # Output folders from before the store are read from the CSV itself
+    assert read_frame(csv_path).equals(legacy)
+
+    get_series(csv_path).import_csv(csv_path)
+
+    assert not os.path.exists(csv_path)
+    stored = read_frame(csv_path)
+    assert list(stored.columns) == list(legacy.columns)
+    pd.testing.assert_frame_equal(_sorted(stored), _sorted(legacy))
+    pd.testing.assert_frame_equal(_sorted(read_frame(csv_path, barcode="barcode02")),
+                                  _sorted(legacy[legacy['barcode'] == "barcode02"]))
+
+def test_time_range_query(tmp_path):
+    csv_path = str(tmp_path / "rarefaction_data.csv")
+    series = get_series(csv_path)
+    for i, timestamp in enumerate(TIMES):
+        series.append("barcode01", timestamp, 5 + i)
+
+    df = read_frame(csv_path, barcode="barcode01", start=TIMES[1], end=TIMES[2])
+
+    assert list(df.columns) == ['timestamp', 'barcode', 'unique_species_count']
+    assert df['unique_species_count'].tolist() == [6, 7]
+    assert df['timestamp'].tolist() == [pd.Timestamp(t) for t in TIMES[1:]]
+
+def test_redone_batch_and_interrupted_append(tmp_path):
+    csv_path = str(tmp_path / "cumulative_species_data.csv")
+    series = get_series(csv_path)
+    assert series.append("barcode01", TIMES[0], {"Escherichia coli": 3}, batch_id="batch1")
+    assert not series.append("barcode01", TIMES[1], {"Escherichia coli": 3}, batch_id="batch1")
+
+    # A writer that died after writing data and names but before committing the manifest
+    entry = series.manifest()['barcodes']["barcode01"]
+    with open(os.path.join(series.directory, entry['file']), 'ab') as f:
+        f.write(b"\xff" * 40)
+    with open(os.path.join(series.directory, "names.txt"), 'ab') as f:
+        f.write(b"Never committed\n")
+    assert len(read_frame(csv_path)) == 1
+
+    # Another process (a fresh series object) picks up where the committed data ends
+    reopened = timeseries_store.TimeSeries(series.directory, key='name', value='cumulative_reads',
+                                           columns=series.columns)
+    reopened.append("barcode01", TIMES[2], {"Escherichia coli": 9, "Bacillus subtilis": 2}, batch_id="batch2")
+
+    df = read_frame(csv_path)
+    assert df[['name', 'cumulative_reads']].values.tolist() == [["Escherichia coli", 3], ["Escherichia coli", 9],
+                                                                 ["Bacillus subtilis", 2]]
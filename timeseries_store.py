@@ -0,0 +1,241 @@
+# timeseries_store.py
+import os
+import json
+import fcntl
+import logging
+from datetime import datetime
+from threading import Lock
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+STORE_DIR = "timeseries"
+_EPOCH = datetime(1970, 1, 1)
+
+# Series that used to be CSV files in aggregated_results, with the columns readers expect.
+# 'key' is a dictionary-encoded column (one code per distinct value), 'value' the count
+SERIES = {
+    'cumulative_species_data.csv': {'key': 'name', 'value': 'cumulative_reads',
+                                    'columns': ['name', 'cumulative_reads', 'timestamp', 'barcode']},
+    'rarefaction_data.csv': {'key': None, 'value': 'unique_species_count',
+                             'columns': ['timestamp', 'barcode', 'unique_species_count']},
+}
+
+# Batch ids remembered per barcode so a redone aggregation does not add its time point twice
+_BATCHES_KEPT = 64
+
+_OPEN = {}
+_OPEN_LOCK = Lock()
+
+def get_series(csv_path: str) -> "TimeSeries":
+    """
+    Returns the process-wide series that replaces a legacy history CSV (for example
+    aggregated_results/rarefaction_data.csv), stored under aggregated_results/timeseries.
+    """
+    agg_dir, name = os.path.split(os.path.abspath(csv_path))
+    spec = SERIES[name]
+    directory = os.path.join(agg_dir, STORE_DIR, os.path.splitext(name)[0])
+    with _OPEN_LOCK:
+        if directory not in _OPEN:
+            _OPEN[directory] = TimeSeries(directory, key=spec['key'], value=spec['value'], columns=spec['columns'])
+        return _OPEN[directory]
+
+def read_frame(csv_path: str, barcode: str = None, start=None, end=None) -> pd.DataFrame:
+    """
+    Reads a series as a DataFrame with the legacy CSV's columns, optionally for one barcode
+    and a time range. Output folders from before the store are read from the CSV itself.
+    """
+    series = get_series(csv_path)
+    if not series.exists() and os.path.exists(csv_path):
+        df = pd.read_csv(csv_path)
+        if barcode is not None and 'barcode' in df.columns:
+            df = df[df['barcode'].astype(str) == barcode]
+        return df
+    return series.query(barcode=barcode, start=start, end=end)
+
+def _seconds(timestamp) -> float:
+    """Naive local time as seconds since 1970, so reads give back the same wall-clock times as the CSVs."""
+    if isinstance(timestamp, str):
+        timestamp = datetime.fromisoformat(timestamp)
+    if isinstance(timestamp, pd.Timestamp):
+        timestamp = timestamp.to_pydatetime()
+    return (timestamp.replace(tzinfo=None) - _EPOCH).total_seconds()
+
+class TimeSeries:
+    """
+    Append-only history of per-barcode counts over time.
+
+    Each barcode has its own file of fixed-width records (time, key code, value), so a
+    barcode's history is read without touching the others and a time range is found by
+    binary search. Key values (species names) are dictionary-encoded in an append-only
+    names file. A small manifest holds how many records and name bytes are committed;
+    it is replaced atomically after the data is written, so readers never see a partial
+    append, and a writer that died mid-append is rolled back by the next one. Appends
+    from several processes are serialized with a lock file.
+    """
+    def __init__(self, directory: str, key: str = None, value: str = 'value', columns: list = None):
+        self.directory = directory
+        self.key = key
+        self.value = value
+        self.columns = columns or ([key] if key else []) + ['timestamp', 'barcode', value]
+        self.dtype = np.dtype([('t', '<f8'), ('key', '<u4'), ('value', '<i8')] if key else
+                              [('t', '<f8'), ('value', '<i8')])
+        self._names = []  # code -> key value, as far as it has been read
+        self._names_bytes = 0
+        self._lock = Lock()
+
+    # --- Manifest ---
+
+    def _manifest_path(self) -> str:
+        return os.path.join(self.directory, "manifest.json")
+
+    def exists(self) -> bool:
+        return os.path.exists(self._manifest_path())
+
+    def manifest(self) -> dict:
+        """{'barcodes': {barcode: {file, rows, batches}}, 'names_bytes': n}; what readers may see."""
+        try:
+            with open(self._manifest_path()) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {'barcodes': {}, 'names_bytes': 0}
+
+    def version(self) -> float:
+        """Changes whenever an append is committed; lets readers skip reloading unchanged data."""
+        try:
+            return os.path.getmtime(self._manifest_path())
+        except OSError:
+            return 0.0
+
+    def _write_manifest(self, manifest: dict):
+        tmp_path = self._manifest_path() + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._manifest_path())
+
+    # --- Dictionary ---
+
+    def _names_path(self) -> str:
+        return os.path.join(self.directory, "names.txt")
+
+    def _load_names(self, committed_bytes: int):
+        """Reads dictionary entries appended since the last call, up to the committed size."""
+        if committed_bytes <= self._names_bytes:
+            return
+        with open(self._names_path(), 'rb') as f:
+            f.seek(self._names_bytes)
+            chunk = f.read(committed_bytes - self._names_bytes)
+        self._names.extend(line.decode('utf-8') for line in chunk.split(b'\n')[:-1])
+        self._names_bytes = committed_bytes
+
+    # --- Writing ---
+
+    def append(self, barcode: str, timestamp, values, batch_id: str = None) -> bool:
+        """
+        Appends one time point for a barcode: values is {key: count} for a keyed series,
+        or a single count otherwise. With batch_id, a batch already appended for this
+        barcode is skipped; returns False if it was.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        t = _seconds(timestamp)
+        with self._lock, open(os.path.join(self.directory, ".lock"), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                return self._append_locked(barcode, t, values, batch_id)
+            except BaseException:
+                # Names cached during a failed append may never have been committed
+                self._names, self._names_bytes = [], 0
+                raise
+
+    def _append_locked(self, barcode: str, t: float, values, batch_id: str = None) -> bool:
+        manifest = self.manifest()
+        entry = manifest['barcodes'].get(barcode) or {'file': f"{len(manifest['barcodes']):04d}.bin", 'rows': 0}
+        if batch_id and batch_id in entry.get('batches', []):
+            return False
+
+        if self.key:
+            self._load_names(manifest['names_bytes'])
+            codes = {name: code for code, name in enumerate(self._names)}
+            new_names = [name for name in dict.fromkeys(str(k) for k in values) if name not in codes]
+            if new_names:
+                with open(self._names_path(), 'ab') as f:
+                    # Drop anything a failed append left past the committed size
+                    f.truncate(manifest['names_bytes'])
+                    f.write("".join(f"{name}\n" for name in new_names).encode('utf-8'))
+                for name in new_names:
+                    codes[name] = len(codes)
+                self._names.extend(new_names)
+                manifest['names_bytes'] = os.path.getsize(self._names_path())
+                self._names_bytes = manifest['names_bytes']
+            records = np.zeros(len(values), dtype=self.dtype)
+            records['t'] = t
+            records['key'] = [codes[str(k)] for k in values]
+            records['value'] = [int(v) for v in values.values()]
+        else:
+            records = np.zeros(1, dtype=self.dtype)
+            records['t'] = t
+            records['value'] = int(values)
+
+        data_path = os.path.join(self.directory, entry['file'])
+        with open(data_path, 'ab') as f:
+            f.truncate(entry['rows'] * self.dtype.itemsize)
+            f.write(records.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        entry['rows'] += len(records)
+        if batch_id:
+            entry['batches'] = (entry.get('batches', []) + [batch_id])[-_BATCHES_KEPT:]
+        manifest['barcodes'][barcode] = entry
+        self._write_manifest(manifest)
+        return True
+
+    # --- Reading ---
+
+    def barcodes(self) -> list:
+        return list(self.manifest()['barcodes'])
+
+    def query(self, barcode: str = None, start=None, end=None) -> pd.DataFrame:
+        """Committed records for one or all barcodes, with start <= time <= end when given."""
+        manifest = self.manifest()
+        frames = []
+        for name, entry in manifest['barcodes'].items():
+            if barcode is not None and name != barcode:
+                continue
+            records = np.fromfile(os.path.join(self.directory, entry['file']), dtype=self.dtype, count=entry['rows'])
+            if start is not None or end is not None:
+                # Records are appended in time order
+                lo = np.searchsorted(records['t'], _seconds(start), 'left') if start is not None else 0
+                hi = np.searchsorted(records['t'], _seconds(end), 'right') if end is not None else len(records)
+                records = records[lo:hi]
+            frame = pd.DataFrame({'timestamp': pd.to_datetime(records['t'], unit='s'), 'barcode': name,
+                                  self.value: records['value']})
+            if self.key:
+                frame[self.key] = records['key']
+            frames.append(frame)
+        if not frames:
+            return pd.DataFrame(columns=self.columns)
+        df = pd.concat(frames, ignore_index=True)
+        if self.key:
+            with self._lock:
+                self._load_names(manifest['names_bytes'])
+                df[self.key] = np.array(self._names, dtype=object)[df[self.key].to_numpy(dtype=np.int64)]
+        return df[self.columns]
+
+    # --- Migration ---
+
+    def import_csv(self, csv_path: str):
+        """Loads a legacy history CSV into an empty series, then renames the CSV to *.imported."""
+        if self.exists() or not os.path.exists(csv_path) or os.path.getsize(csv_path) == 0:
+            return
+        df = pd.read_csv(csv_path)
+        for (timestamp, barcode), group in df.groupby(['timestamp', 'barcode'], sort=False):
+            if self.key:
+                self.append(str(barcode), timestamp, dict(zip(group[self.key], group[self.value])))
+            else:
+                self.append(str(barcode), timestamp, int(group[self.value].iloc[-1]))
+        os.replace(csv_path, csv_path + ".imported")
+        logger.info(f"Imported {len(df)} rows from {os.path.basename(csv_path)} into {self.directory}.")
@@ -0,0 +1,207 @@
+# trace_ledger.py
+import os
+import re
+import csv
+import sys
+import time
+import sqlite3
+import logging
+import argparse
+import configparser
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+# Trace columns requested from Nextflow. With trace.raw = true durations are milliseconds,
+# memory and I/O are bytes and %cpu is a plain number
+TRACE_FIELDS = ["hash", "name", "process", "tag", "status", "exit", "attempt", "duration", "realtime",
+                "%cpu", "peak_rss", "peak_vmem", "rchar", "wchar", "read_bytes", "write_bytes"]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    batch TEXT,
+    hash TEXT,
+    barcode TEXT,
+    process TEXT,
+    status TEXT,
+    exit INTEGER,
+    attempt INTEGER,
+    duration_ms INTEGER,
+    realtime_ms INTEGER,
+    cpu_percent REAL,
+    peak_rss INTEGER,
+    peak_vmem INTEGER,
+    rchar INTEGER,
+    wchar INTEGER,
+    read_bytes INTEGER,
+    write_bytes INTEGER,
+    recorded_at REAL,
+    PRIMARY KEY (batch, hash)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS tasks_process ON tasks (process, recorded_at);
+"""
+
+_LEDGERS = {}
+_LEDGERS_LOCK = Lock()
+
+def trace_ledger_path(config: configparser.ConfigParser) -> str:
+    return config.get('Settings', 'trace_ledger',
+                      fallback=os.path.join(config.get('Paths', 'output_directory'), 'trace_ledger.db'))
+
+def get_trace_ledger(db_path: str) -> "TraceLedger":
+    """Returns the process-wide trace ledger for db_path, opening it on first use."""
+    db_path = os.path.abspath(db_path)
+    with _LEDGERS_LOCK:
+        if db_path not in _LEDGERS:
+            _LEDGERS[db_path] = TraceLedger(db_path)
+        return _LEDGERS[db_path]
+
+def write_trace_config(config_path: str, trace_path: str):
+    """Writes a Nextflow config (for -c) that enables a raw-unit trace file at trace_path."""
+    with open(config_path, 'w') as f:
+        f.write("trace {\n"
+                "    enabled = true\n"
+                f"    file = '{trace_path}'\n"
+                f"    fields = '{','.join(TRACE_FIELDS)}'\n"
+                "    raw = true\n"
+                # -resume retries rewrite the same file
+                "    overwrite = true\n"
+                "}\n")
+
+def _number(value: str, cast=int):
+    value = (value or "").strip().rstrip('%')
+    if value in ("", "-"):
+        return None
+    try:
+        return cast(float(value))
+    except ValueError:
+        return None
+
+def _barcode(tag: str, barcodes: set):
+    """Finds the sample id in a task tag such as 'Kraken2 on barcode01'."""
+    for token in re.split(r"[\s,()]+", tag or ""):
+        if token in barcodes:
+            return token
+    return None
+
+class TraceLedger:
+    """
+    SQLite ledger of Nextflow task metrics (realtime, CPU%, peak RSS, I/O), one row per
+    task keyed by batch and task hash, with the barcode and process it belongs to.
+    Kept across batches so stage costs can be compared over a whole run.
+    """
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._lock = Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(_SCHEMA)
+
+    def ingest(self, trace_path: str, batch: str, barcodes=()) -> int:
+        """Loads a trace file into the ledger. Cached tasks from -resume are skipped. Returns the rows stored."""
+        barcodes = set(barcodes)
+        rows = []
+        now = time.time()
+        with open(trace_path, 'r', newline='') as f:
+            for task in csv.DictReader(f, delimiter='\t'):
+                if task.get('status') == 'CACHED':
+                    continue
+                rows.append((
+                    batch, task.get('hash'), _barcode(task.get('tag') or task.get('name'), barcodes),
+                    # Processes inside a named workflow are reported as WORKFLOW:PROCESS
+                    (task.get('process') or '').split(':')[-1], task.get('status'),
+                    _number(task.get('exit')), _number(task.get('attempt')),
+                    _number(task.get('duration')), _number(task.get('realtime')),
+                    _number(task.get('%cpu'), float), _number(task.get('peak_rss')), _number(task.get('peak_vmem')),
+                    _number(task.get('rchar')), _number(task.get('wchar')),
+                    _number(task.get('read_bytes')), _number(task.get('write_bytes')), now,
+                ))
+        with self._lock:
+            with self.conn:
+                self.conn.executemany(f"INSERT OR REPLACE INTO tasks VALUES ({', '.join('?' * 17)})", rows)
+        return len(rows)
+
+    def summary(self, since: float = None, batch: str = None, by_barcode: bool = False) -> list:
+        """Per-process (and optionally per-barcode) totals, largest total realtime first."""
+        group = "process, barcode" if by_barcode else "process"
+        columns = "process, barcode" if by_barcode else "process, NULL"
+        where, args = ["1"], []
+        if since is not None:
+            where.append("recorded_at >= ?")
+            args.append(since)
+        if batch:
+            where.append("batch LIKE ?")
+            args.append(f"%{batch}%")
+        query = (f"SELECT {columns}, COUNT(*), "
+                 "SUM(status != 'COMPLETED'), SUM(realtime_ms), AVG(realtime_ms), MAX(realtime_ms), "
+                 "AVG(cpu_percent), MAX(peak_rss), SUM(rchar), SUM(wchar) "
+                 f"FROM tasks WHERE {' AND '.join(where)} GROUP BY {group} ORDER BY SUM(realtime_ms) DESC")
+        keys = ("process", "barcode", "tasks", "failed", "total_realtime_ms", "mean_realtime_ms",
+                "max_realtime_ms", "mean_cpu_percent", "max_peak_rss", "rchar", "wchar")
+        with self._lock:
+            return [dict(zip(keys, row)) for row in self.conn.execute(query, args)]
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+# --- Summary CLI ---
+
+def _human_bytes(value) -> str:
+    if value is None:
+        return "-"
+    for unit in ("B", "KB", "MB", "GB"):
+        if value < 1024:
+            return f"{value:.0f} {unit}"
+        value /= 1024
+    return f"{value:.1f} TB"
+
+def _human_seconds(ms) -> str:
+    if ms is None:
+        return "-"
+    seconds = ms / 1000
+    return f"{seconds / 3600:.1f}h" if seconds >= 3600 else f"{seconds / 60:.1f}m" if seconds >= 60 else f"{seconds:.1f}s"
+
+def print_summary(rows: list):
+    if not rows:
+        print("No Nextflow tasks recorded.")
+        return
+    total = sum(r['total_realtime_ms'] or 0 for r in rows) or 1
+    print(f"{'process':<20}{'barcode':<14}{'tasks':>6}{'failed':>7}{'realtime':>10}{'share':>7}"
+          f"{'mean':>9}{'max':>9}{'cpu%':>7}{'peak RSS':>11}{'read':>10}{'written':>10}")
+    for r in rows:
+        print(f"{r['process']:<20}{r['barcode'] or '':<14}{r['tasks']:>6}{r['failed']:>7}"
+              f"{_human_seconds(r['total_realtime_ms']):>10}{100 * (r['total_realtime_ms'] or 0) / total:>6.0f}%"
+              f"{_human_seconds(r['mean_realtime_ms']):>9}{_human_seconds(r['max_realtime_ms']):>9}"
+              f"{r['mean_cpu_percent'] or 0:>7.0f}{_human_bytes(r['max_peak_rss']):>11}"
+              f"{_human_bytes(r['rchar']):>10}{_human_bytes(r['wchar']):>10}")
+    slowest = rows[0]
+    hungriest = max(rows, key=lambda r: r['max_peak_rss'] or 0)
+    print(f"\nWall time is dominated by {slowest['process']} "
+          f"({100 * (slowest['total_realtime_ms'] or 0) / total:.0f}% of task realtime); "
+          f"peak memory by {hungriest['process']} ({_human_bytes(hungriest['max_peak_rss'])}).")
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarizes Nextflow task metrics recorded for a run.")
+    parser.add_argument("--config", default="config.ini", help="Backend config; locates the ledger in the output directory.")
+    parser.add_argument("--db", default=None, help="Trace ledger database (overrides --config).")
+    parser.add_argument("--since-hours", type=float, default=None, help="Only tasks recorded in the last N hours.")
+    parser.add_argument("--batch", default=None, help="Only batches whose name contains this text.")
+    parser.add_argument("--by-barcode", action="store_true", help="Break each process down by barcode.")
+    args = parser.parse_args()
+
+    db_path = args.db
+    if not db_path:
+        config = configparser.ConfigParser()
+        if not config.read(args.config):
+            sys.exit(f"Could not read {args.config}; pass --db instead.")
+        db_path = trace_ledger_path(config)
+    if not os.path.exists(db_path):
+        sys.exit(f"No trace ledger at {db_path}.")
+
+    since = time.time() - args.since_hours * 3600 if args.since_hours else None
+    print_summary(TraceLedger(db_path).summary(since=since, batch=args.batch, by_barcode=args.by_barcode))
+
+if __name__ == "__main__":
+    main()
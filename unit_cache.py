@@ -0,0 +1,152 @@
+# unit_cache.py
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+import configparser
+from threading import Lock
+from contextlib import contextmanager
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+_CACHES = {}
+_CACHES_LOCK = Lock()
+
+def get_unit_cache(config: configparser.ConfigParser):
+    """Returns the process-wide unit cache, or None when per-file processing is off."""
+    if not config.getboolean('UnitCache', 'enabled', fallback=False):
+        return None
+    root = os.path.abspath(config.get('UnitCache', 'directory', fallback='') or
+                           os.path.join(config.get('Paths', 'output_directory'), "unit_cache"))
+    with _CACHES_LOCK:
+        if root not in _CACHES:
+            _CACHES[root] = UnitCache(root, budget_bytes=int(config.getfloat('UnitCache', 'budget_gb', fallback=50) * 1024**3))
+        return _CACHES[root]
+
+def stage_key(stage: str, upstream: str, params) -> str:
+    """Key of a stage's output: the stage name, the key (or content hash) of its input and its parameters."""
+    blob = json.dumps([stage, upstream, params], sort_keys=True, default=str)
+    return hashlib.sha256(blob.encode()).hexdigest()
+
+def file_identity(path: str) -> list:
+    """Cheap identity of a reference file (database, index) for use in stage parameters."""
+    try:
+        st = os.stat(path)
+        return [os.path.abspath(path), st.st_size, st.st_mtime_ns]
+    except OSError:
+        return [path]
+
+class UnitCache:
+    """
+    Content-addressed store of per-file stage outputs. Each input FASTQ is identified by
+    the SHA-256 of its bytes; each stage's output directory is keyed by its input's key
+    and its parameters, so the same file in another batch, a retried batch, or a rerun
+    with only downstream parameters changed finds every upstream stage already done.
+
+    Entries are written to a temporary directory and renamed into place, so an
+    interrupted stage never leaves a half-written entry. Least recently used entries
+    are evicted past budget_bytes.
+    """
+    def __init__(self, root: str, budget_bytes: int):
+        self.root = root
+        self.budget_bytes = budget_bytes
+        self._hashes = {}  # (path, size, mtime_ns) -> sha256
+        self._lock = Lock()
+        self._evict_lock = Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def content_hash(self, path: str) -> str:
+        st = os.stat(path)
+        identity = (path, st.st_size, st.st_mtime_ns)
+        with self._lock:
+            if identity in self._hashes:
+                return self._hashes[identity]
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(8 * 1024 * 1024), b""):
+                digest.update(chunk)
+        with self._lock:
+            self._hashes[identity] = digest.hexdigest()
+        return self._hashes[identity]
+
+    def entry_path(self, stage: str, key: str) -> str:
+        return os.path.join(self.root, stage, key[:2], key)
+
+    def lookup(self, stage: str, key: str):
+        """The entry's directory if it exists, marking it as recently used. Otherwise None."""
+        path = self.entry_path(stage, key)
+        if not os.path.isdir(path):
+            REGISTRY.inc("nanort_unit_cache_misses_total", labels={'stage': stage}, help_text="Per-file stage cache misses")
+            return None
+        os.utime(path)
+        REGISTRY.inc("nanort_unit_cache_hits_total", labels={'stage': stage}, help_text="Per-file stage cache hits")
+        return path
+
+    @contextmanager
+    def produce(self, stage: str, key: str):
+        """Yields a scratch directory for the stage's outputs and publishes it under the key on success."""
+        final = self.entry_path(stage, key)
+        os.makedirs(os.path.dirname(final), exist_ok=True)
+        scratch = f"{final}.tmp{os.getpid()}_{time.monotonic_ns()}"
+        os.makedirs(scratch)
+        try:
+            yield scratch
+            try:
+                os.rename(scratch, final)
+            except OSError:
+                # Someone else produced the same entry first; theirs is just as good
+                if not os.path.isdir(final):
+                    raise
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+    @staticmethod
+    def _listdir(directory: str) -> list:
+        try:
+            return [os.path.join(directory, name) for name in os.listdir(directory)]
+        except OSError:
+            return []
+
+    def evict(self, protect_seconds: float = 3600) -> int:
+        """
+        Removes least recently used entries until the cache fits its budget. Entries used
+        within protect_seconds may belong to a batch still being assembled and are kept.
+        Returns the bytes freed. Only one eviction runs at a time; a call made while another
+        is running returns 0 straight away.
+        """
+        if not self._evict_lock.acquire(blocking=False):
+            return 0
+        try:
+            return self._evict(protect_seconds)
+        finally:
+            self._evict_lock.release()
+
+    def _evict(self, protect_seconds: float) -> int:
+        protect_since = time.time() - protect_seconds
+        entries = []
+        for stage_dir in self._listdir(self.root):
+            for prefix_dir in self._listdir(stage_dir):
+                for path in self._listdir(prefix_dir):
+                    if ".tmp" in os.path.basename(path):
+                        continue
+                    # Entries can disappear under us: a scratch directory being renamed or removed
+                    try:
+                        size = sum(os.path.getsize(f) for f in self._listdir(path))
+                        entries.append((os.path.getmtime(path), size, path))
+                    except OSError:
+                        continue
+        total = sum(size for _, size, _ in entries)
+        freed = 0
+        for mtime, size, path in sorted(entries):
+            if total - freed <= self.budget_bytes or mtime >= protect_since:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            freed += size
+        REGISTRY.set("nanort_unit_cache_bytes", total - freed, help_text="Size of the per-file stage cache")
+        if freed:
+            logger.info(f"Unit cache: evicted {freed / 1024**3:.2f} GB.")
+        return freed
@@ -0,0 +1,153 @@
+# work_cache.py
+import os
+import time
+import shutil
+import logging
+import configparser
+from contextlib import contextmanager
+from threading import Thread, Event, Lock
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+# One cache per work directory, shared by every pipeline run in the process
+_CACHES = {}
+_CACHES_LOCK = Lock()
+
+def get_work_cache(config: configparser.ConfigParser):
+    """Returns the process-wide WorkCache for the configured work directory, or None if the mode is off."""
+    if not config.getboolean('WorkCache', 'enabled', fallback=False):
+        return None
+    output_dir = config.get('Paths', 'output_directory')
+    work_dir = os.path.abspath(config.get('Paths', 'work_directory', fallback=os.path.join(output_dir, "work")))
+    with _CACHES_LOCK:
+        if work_dir not in _CACHES:
+            cache = WorkCache(
+                work_dir,
+                budget_bytes=int(config.getfloat('WorkCache', 'budget_gb', fallback=100) * 1024**3),
+                cleanup_interval=config.getfloat('WorkCache', 'cleanup_interval_seconds', fallback=300),
+            )
+            cache.start()
+            _CACHES[work_dir] = cache
+        return _CACHES[work_dir]
+
+def _tree_size(path: str) -> int:
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files + dirs:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+class WorkCache:
+    """
+    Persistent Nextflow work directory. Instead of deleting work/, .nextflow/ and
+    .nextflow.log after every batch, task directories are kept in one shared work dir
+    and each run keeps its launch directory (session history and cache DB) under
+    work/launch/<run name>, so a failed run can be retried with -resume and only its
+    failed processes are executed again.
+
+    A background thread keeps the cache under `budget_bytes` by evicting task and
+    launch directories least recently written first. Anything belonging to a run that
+    is still in progress is never evicted.
+    """
+    def __init__(self, work_dir: str, budget_bytes: int, cleanup_interval: float = 300):
+        self.work_dir = work_dir
+        self.budget_bytes = budget_bytes
+        self.cleanup_interval = cleanup_interval
+        self._active = {}  # launch dir -> start time
+        self._lock = Lock()
+        self._wake = Event()
+        self._stop = Event()
+        self._thread = Thread(target=self._run, name="work-cache-cleaner", daemon=True)
+        os.makedirs(os.path.join(work_dir, "launch"), exist_ok=True)
+
+    def launch_dir(self, run_name: str = None) -> str:
+        path = os.path.join(self.work_dir, "launch", run_name or "default")
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    @contextmanager
+    def session(self, launch_dir: str):
+        """Marks a run as in progress for its whole lifetime, retries included."""
+        with self._lock:
+            self._active[launch_dir] = time.time()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._active.pop(launch_dir, None)
+            self._wake.set()
+
+    # --- Eviction ---
+
+    def _entries(self):
+        """Evictable entries as (last written, path): task dirs work/xx/<hash> and launch dirs."""
+        entries = []
+        try:
+            tops = os.listdir(self.work_dir)
+        except OSError:
+            return entries
+        for top in tops:
+            top_path = os.path.join(self.work_dir, top)
+            # Nextflow task directories live under two-character hash prefixes
+            if not (top == "launch" or len(top) == 2) or not os.path.isdir(top_path):
+                continue
+            for name in os.listdir(top_path):
+                path = os.path.join(top_path, name)
+                try:
+                    entries.append((os.lstat(path).st_mtime, path))
+                except OSError:
+                    pass
+        return entries
+
+    def evict(self) -> int:
+        """One cleanup pass. Returns the number of bytes freed."""
+        with self._lock:
+            active = dict(self._active)
+        # Task dirs written since the oldest active run started may still be needed by it
+        protect_since = min(active.values()) if active else float('inf')
+
+        entries = sorted(self._entries())
+        sizes = {path: _tree_size(path) for _, path in entries}
+        total = sum(sizes.values())
+        REGISTRY.set("nanort_work_cache_bytes", total, help_text="Size of the persistent Nextflow work cache")
+
+        freed = 0
+        for mtime, path in entries:
+            if total - freed <= self.budget_bytes:
+                break
+            if path in active or mtime >= protect_since:
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+            freed += sizes[path]
+
+        if freed:
+            REGISTRY.inc("nanort_work_cache_evicted_bytes_total", freed, help_text="Bytes evicted from the work cache")
+            logger.info(f"Work cache: evicted {freed / 1024**3:.2f} GB (now {(total - freed) / 1024**3:.2f} GB "
+                        f"of a {self.budget_bytes / 1024**3:.0f} GB budget).")
+        if total - freed > self.budget_bytes:
+            logger.warning("Work cache is over budget, but the remaining entries belong to runs in progress.")
+        return freed
+
+    def start(self):
+        self._thread.start()
+        logger.info(f"Persistent Nextflow work cache at {self.work_dir} (budget {self.budget_bytes / 1024**3:.0f} GB).")
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.cleanup_interval)
+            self._wake.clear()
+            if self._stop.is_set():
+                return
+            try:
+                self.evict()
+            except Exception as e:
+                logger.warning(f"Work cache cleanup failed: {e}")